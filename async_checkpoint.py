@@ -0,0 +1,158 @@
+import dataclasses
+import glob
+import json
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from huggingface_hub import split_torch_state_dict_into_shards
+from safetensors.torch import save_file
+from transformers import Trainer
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME
+
+def clone_tensors(obj):
+    """คัดลอก tensor ทุกตัวใน dict/list ซ้อนกัน (เช่น optimizer.state_dict()) เพื่อให้การฝึกต่อไม่กระทบ snapshot"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {key: clone_tensors(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_tensors(value) for value in obj)
+    return obj
+
+def snapshot_model_state(model):
+    """คัดลอก state dict ของโมเดล โดยเก็บ weight ที่ผูกกัน (tied) เพียงชุดเดียวแบบเดียวกับ save_pretrained"""
+    state_dict = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if key in seen:
+            continue
+        seen.add(key)
+        state_dict[name] = tensor.detach().clone().contiguous()
+    return state_dict
+
+def write_sharded_safetensors(state_dict, output_dir, max_shard_size="2GB"):
+    """บันทึก state dict เป็น safetensors แบ่งไฟล์ตาม max_shard_size พร้อม index แบบเดียวกับ save_pretrained"""
+    split = split_torch_state_dict_into_shards(state_dict, max_shard_size=max_shard_size)
+    for filename, names in split.filename_to_tensors.items():
+        shard = {name: state_dict[name] for name in names}
+        save_file(shard, os.path.join(output_dir, filename), metadata={"format": "pt"})
+    if split.is_sharded:
+        index = {"metadata": split.metadata, "weight_map": split.tensor_to_filename}
+        with open(os.path.join(output_dir, SAFE_WEIGHTS_INDEX_NAME), 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+def rng_snapshot():
+    """สถานะ RNG ในรูปแบบเดียวกับ rng_state.pth ของ Trainer"""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+
+class AsyncCheckpointTrainer(Trainer):
+    """
+    Trainer ที่บันทึก checkpoint ในเธรดเบื้องหลัง
+
+    ตอนถึง save_steps จะคัดลอก weight, optimizer state, scheduler, RNG และ trainer state ไว้ในหน่วยความจำ
+    (ใช้หน่วยความจำเพิ่มเท่ากับขนาดโมเดลและ optimizer state) แล้วฝึกต่อทันที
+    ส่วนการเขียน safetensors แบบแบ่งไฟล์และไฟล์อื่น ๆ ทำในเธรดเบื้องหลังลงโฟลเดอร์ .tmp
+    แล้วเปลี่ยนชื่อเป็น checkpoint-N เมื่อเขียนครบ จึงไม่มี checkpoint ที่เขียนค้างครึ่งเดียวให้ resume
+    ไฟล์ที่ได้อยู่ในรูปแบบเดียวกับ Trainer จึงใช้ trainer.train(resume_from_checkpoint=...) ได้ตามปกติ
+
+    โมเดล LoRA ใช้การบันทึกปกติของ Trainer เพราะ adapter และ optimizer state มีขนาดเล็ก
+    """
+
+    def __init__(self, *args, max_shard_size="2GB", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_shard_size = max_shard_size
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending_checkpoint = None
+
+    def train(self, *args, **kwargs):
+        # ลบโฟลเดอร์ .tmp ที่ค้างจากการรันที่ถูกหยุดกลางคันระหว่างเขียน checkpoint
+        if self.args.should_save:
+            for tmp_dir in glob.glob(os.path.join(self.args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-*.tmp")):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            self.wait_for_checkpoint()
+
+    def wait_for_checkpoint(self):
+        """รอให้ checkpoint ที่กำลังเขียนเสร็จ (ส่งต่อ exception จากเธรดเบื้องหลังถ้ามี)"""
+        if self._pending_checkpoint is not None:
+            pending, self._pending_checkpoint = self._pending_checkpoint, None
+            pending.result()
+
+    def _save_checkpoint(self, model, trial):
+        # เก็บ snapshot ได้ครั้งละหนึ่งชุด เพื่อไม่ให้หน่วยความจำโตเมื่อเขียนดิสก์ช้ากว่า save_steps
+        self.wait_for_checkpoint()
+        unwrapped = self.accelerator.unwrap_model(self.model)
+        if hasattr(unwrapped, "peft_config"):
+            return super()._save_checkpoint(model, trial)
+
+        start = time.perf_counter()
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+
+        # ทุก rank ส่งสถานะ RNG ให้ rank 0 เป็นผู้เขียน
+        rng_states = [rng_snapshot()]
+        if self.args.world_size > 1:
+            rng_states = [None] * self.args.world_size
+            torch.distributed.all_gather_object(rng_states, rng_snapshot())
+        if not self.args.should_save:
+            return
+
+        for cb in [cb for cb in self.callback_handler.callbacks + [self.control] if isinstance(cb, ExportableState)]:
+            cb_name = cb.__class__.__name__
+            if isinstance(self.state.stateful_callbacks[cb_name], list):
+                self.state.stateful_callbacks[cb_name].append(cb.state())
+            else:
+                self.state.stateful_callbacks[cb_name] = cb.state()
+
+        snapshot = {
+            'model': snapshot_model_state(unwrapped),
+            'config': unwrapped.config,
+            'optimizer': clone_tensors(self.optimizer.state_dict()),
+            'scheduler': clone_tensors(self.lr_scheduler.state_dict()),
+            'rng_states': rng_states,
+            'trainer_state': json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n",
+        }
+        print(f"snapshot checkpoint step {self.state.global_step} ใช้เวลา {time.perf_counter() - start:.2f} วินาที "
+              f"กำลังเขียนลง {output_dir} ในเบื้องหลัง")
+        self._pending_checkpoint = self._checkpoint_executor.submit(
+            self._write_checkpoint, snapshot, output_dir, run_dir
+        )
+
+    def _write_checkpoint(self, snapshot, output_dir, run_dir):
+        start = time.perf_counter()
+        tmp_dir = f"{output_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        write_sharded_safetensors(snapshot['model'], tmp_dir, self.max_shard_size)
+        snapshot['config'].save_pretrained(tmp_dir)
+        torch.save(snapshot['optimizer'], os.path.join(tmp_dir, OPTIMIZER_NAME))
+        torch.save(snapshot['scheduler'], os.path.join(tmp_dir, SCHEDULER_NAME))
+        if len(snapshot['rng_states']) == 1:
+            torch.save(snapshot['rng_states'][0], os.path.join(tmp_dir, "rng_state.pth"))
+        else:
+            for rank, rng_states in enumerate(snapshot['rng_states']):
+                torch.save(rng_states, os.path.join(tmp_dir, f"rng_state_{rank}.pth"))
+        with open(os.path.join(tmp_dir, TRAINER_STATE_NAME), 'w', encoding='utf-8') as f:
+            f.write(snapshot['trainer_state'])
+
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(tmp_dir, output_dir)
+        self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+        print(f"บันทึก checkpoint {output_dir} เสร็จ ({time.perf_counter() - start:.1f} วินาทีในเบื้องหลัง)")
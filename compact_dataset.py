@@ -0,0 +1,130 @@
+import json
+from collections import OrderedDict
+from convert_to_autotrain import HOLDOUT_FRACTION, TASKS, PromptExporter, _iter_chunks, is_held_out, iter_lessons
+from prompt_templates import TEMPLATES
+
+COMPACT_FORMAT = "gracer-compact"
+COMPACT_VERSION = 1
+# ฟิลด์ของบทเรียนที่ใช้สร้างคู่ instruction/response (ไม่เก็บ materials, video_url ฯลฯ)
+LESSON_FIELDS = ('lesson_id', 'lesson_name', 'subject', 'grade', 'content')
+
+def write_compact_dataset(input_path, output_path, tasks=('summary',), holdout_fraction=HOLDOUT_FRACTION, profiler=None,
+                          chunk_size=10000):
+    """
+    เขียนข้อมูลฝึกแบบกะทัดรัด: เก็บฟิลด์ของแต่ละบทเรียนครั้งเดียว และเก็บแต่ละคู่เป็นเพียงการอ้างอิง
+
+    คู่หนึ่งรายการคือ (ลำดับบทเรียน, task, part) โดย part คือลำดับของคู่ใน task นั้นของบทเรียน
+    (เช่น qa part 0 คือทั้งบทเรียน ถัดไปเป็นหัวข้อ สาระสำคัญ จุดประสงค์ และกิจกรรมที่บทเรียนมี)
+    ข้อความ prompt ไม่ถูกเก็บ จะ render ด้วยแม่แบบที่เลือกตอน tokenize (ดู CompactRenderer)
+    ไฟล์จึงไม่ซ้ำ preamble ของแม่แบบและเนื้อหาบทเรียนในทุกคู่แบบไฟล์ CSV และ training_pairs.json
+    stage ของ profiler ใช้ชื่อเดียวกับ convert_to_autotrain: อ่านบทเรียนทีละ chunk_size นับใน load
+    สร้างคู่นับใน clean และเขียนไฟล์นับใน write
+
+    Returns:
+        จำนวนคู่ที่เขียน
+    """
+    from pipeline_profiler import StageProfiler
+    profiler = profiler or StageProfiler()
+    unknown_tasks = [task for task in tasks if task not in TASKS]
+    if unknown_tasks:
+        raise ValueError(f"ไม่รู้จัก task {', '.join(unknown_tasks)} (มี {', '.join(TASKS)})")
+
+    exporter = PromptExporter((), tasks)
+    lessons = []
+    pairs = {'lesson': [], 'task': [], 'part': []}
+    source = iter_lessons(input_path)
+    if holdout_fraction > 0:
+        source = (lesson for lesson in source if not is_held_out(lesson, holdout_fraction))
+    chunks = _iter_chunks(source, chunk_size)
+
+    def next_chunk():
+        with profiler.stage("load", accumulate=True):
+            return next(chunks, None)
+
+    while (chunk := next_chunk()) is not None:
+        with profiler.stage("clean", accumulate=True):
+            for lesson in chunk:
+                parts = {}
+                for task, _, _ in exporter.lesson_task_pairs(lesson):
+                    pairs['lesson'].append(len(lessons))
+                    pairs['task'].append(task)
+                    pairs['part'].append(parts.get(task, 0))
+                    parts[task] = parts.get(task, 0) + 1
+                lessons.append([lesson.get(field) for field in LESSON_FIELDS])
+
+    # format อยู่ต้นไฟล์ is_compact_dataset จึงตรวจได้โดยไม่ต้องอ่านทั้งไฟล์
+    data = {
+        'format': COMPACT_FORMAT,
+        'version': COMPACT_VERSION,
+        'tasks': list(tasks),
+        'lesson_fields': list(LESSON_FIELDS),
+        'lessons': lessons,
+        'pairs': pairs,
+    }
+    with profiler.stage("write", accumulate=True):
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    print(f"เขียน {len(pairs['task'])} คู่จาก {len(lessons)} บทเรียนแบบกะทัดรัดไปที่ {output_path}")
+    return len(pairs['task'])
+
+def is_compact_dataset(path):
+    """ไฟล์นี้เขียนด้วย write_compact_dataset หรือไม่ (อ่านเฉพาะส่วนต้นไฟล์)"""
+    if not path.endswith('.json'):
+        return False
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            head = f.read(64)
+    except (OSError, UnicodeDecodeError):
+        return False
+    return head.replace(' ', '').startswith(f'{{"format":"{COMPACT_FORMAT}"')
+
+def load_compact_dataset(path):
+    """อ่านไฟล์กะทัดรัด คืน (list ของบทเรียนเป็น dict, dict ของคอลัมน์ lesson/task/part, tasks)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('format') != COMPACT_FORMAT or data.get('version') != COMPACT_VERSION:
+        raise ValueError(f"{path} ไม่ใช่ไฟล์ {COMPACT_FORMAT} เวอร์ชัน {COMPACT_VERSION}")
+    fields = data['lesson_fields']
+    lessons = [dict(zip(fields, values)) for values in data['lessons']]
+    return lessons, data['pairs'], tuple(data['tasks'])
+
+class CompactRenderer:
+    """
+    render ข้อความฝึกจากการอ้างอิง (lesson, task, part) ด้วยแม่แบบใน prompt_templates
+
+    ใช้ PromptExporter ตัวเดียวกับ convert_to_autotrain.py ข้อความจึงตรงกับไฟล์ที่ export ด้วยแม่แบบเดียวกัน
+    คู่ของบทเรียนถูกสร้างครั้งเดียวแล้วเก็บไว้ (LRU) เพราะคู่จากบทเรียนเดียวกันอยู่ติดกันในไฟล์
+    """
+
+    def __init__(self, lessons, tasks, template_name='alpaca', chat_template_model=None, max_cached_lessons=256):
+        if template_name not in TEMPLATES:
+            raise ValueError(f"ไม่รู้จักแม่แบบ {template_name} (มี {', '.join(TEMPLATES)})")
+        if TEMPLATES[template_name].columns != ('text',):
+            raise ValueError(f"แม่แบบ {template_name} ไม่ได้สร้างคอลัมน์ text จึงใช้ฝึกโดยตรงไม่ได้")
+        self.lessons = lessons
+        self.exporter = PromptExporter((template_name,), tasks, chat_template_model)
+        self.template = self.exporter.templates[template_name]
+        self.max_cached_lessons = max_cached_lessons
+        self.cache = OrderedDict()
+
+    def _lesson_pairs(self, index):
+        pairs = self.cache.get(index)
+        if pairs is not None:
+            self.cache.move_to_end(index)
+            return pairs
+        pairs = {}
+        for task, instruction, response in self.exporter.lesson_task_pairs(self.lessons[index]):
+            pairs.setdefault(task, []).append((instruction, response))
+        self.cache[index] = pairs
+        if len(self.cache) > self.max_cached_lessons:
+            self.cache.popitem(last=False)
+        return pairs
+
+    def render(self, lesson, task, part):
+        instruction, response = self._lesson_pairs(lesson)[task][part]
+        return self.template.render(instruction, response)['text']
+
+    def render_batch(self, examples):
+        """ใช้ใน Dataset.map แบบ batched: คืน list ของข้อความตามคอลัมน์ lesson/task/part"""
+        return [self.render(lesson, task, part)
+                for lesson, task, part in zip(examples['lesson'], examples['task'], examples['part'])]
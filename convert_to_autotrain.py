@@ -1,40 +1,410 @@
+import argparse
+import csv
+import hashlib
 import json
-import pandas as pd
-import re
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pipeline_profiler import StageProfiler, add_profile_arguments, profiler_from_args
+from prompt_templates import SUMMARY_INSTRUCTION, TEMPLATES, build_templates
+
+TASKS = ('summary', 'qa', 'summarize', 'create_lesson_plan')
+# สัดส่วนบทเรียน held-out ค่าเริ่มต้นของทุกสคริปต์ (convert, eval, distill, main.py)
+# ข้อมูลฝึกที่ convert ด้วยค่าเริ่มต้นจึงไม่มีบทเรียนที่ gracer_ai_eval.py ใช้ประเมิน
+HOLDOUT_FRACTION = 0.05
 
 def clean_text(text):
     # ลบตัวขึ้นบรรทัดใหม่และช่องว่างที่มากเกินไป
-    text = re.sub(r'\n+', ' ', text)
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
-
-def convert_to_autotrain():
-    # อ่านไฟล์ JSON
-    with open('dltv_dataset/dltv_dataset.json', 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    # สร้าง list สำหรับเก็บข้อมูลที่จะแปลงเป็น CSV
-    rows = []
-    
-    # วนลูปข้อมูลแต่ละบทเรียน
-    for lesson in data['data']:
-        # ทำความสะอาดข้อความ
-        content = clean_text(lesson['content'])
-        
-        # สร้าง instruction
-        instruction = f"Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n### Instruction: สรุปเนื้อหาบทเรียน {lesson['lesson_name']} วิชา{lesson['subject']} ระดับชั้น{lesson['grade']}\n\n### Response: {content}"
-        
-        # เพิ่มข้อมูลลงใน list
-        rows.append({
-            'text': instruction
-        })
-    
-    # สร้าง DataFrame
-    df = pd.DataFrame(rows)
-    
-    # บันทึกเป็นไฟล์ CSV
-    df.to_csv('dltv_dataset/dltv_dataset_autotrain.csv', index=False, encoding='utf-8')
-    print(f"แปลงข้อมูลเสร็จสิ้น จำนวน {len(rows)} บทเรียน")
+    # str.split() แยกด้วยอักขระช่องว่างชุดเดียวกับ \s ของ regex แต่เร็วกว่าหลายเท่า
+    return ' '.join(text.split())
+
+def is_held_out(lesson, fraction):
+    """
+    บทเรียนนี้อยู่ในชุด held-out สำหรับประเมินผลหรือไม่
+
+    ตัดสินจาก hash ของ (grade, lesson_id) จึงได้ชุดเดิมทุกครั้งไม่ว่าลำดับหรือจำนวนบทเรียนจะเปลี่ยน
+    และแบ่งทั้งบทเรียน คู่ข้อมูลจากบทเรียนเดียวกันจึงไม่อยู่ทั้งชุดฝึกและชุดประเมิน
+    """
+    if fraction <= 0:
+        return False
+    key = f"{lesson.get('grade', '')}\x00{lesson.get('lesson_id') or lesson.get('lesson_name', '')}"
+    bucket = int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big') / 2 ** 64
+    return bucket < fraction
+
+class PromptExporter:
+    """
+    สร้างคู่ instruction/response ของแต่ละบทเรียนแล้ว render ผ่านทุกแม่แบบในรอบเดียว
+
+    task 'summary' คือคำสั่งสรุปบทเรียนแบบเดิมของไฟล์ AutoTrain ส่วน qa, summarize และ
+    create_lesson_plan มาจาก DLTVDatasetProcessor
+    """
+
+    def __init__(self, template_names, tasks=('summary',), chat_template_model=None):
+        self.templates = build_templates(template_names, chat_template_model=chat_template_model)
+        self.tasks = tuple(tasks)
+        self.processor_tasks = {task for task in self.tasks if task != 'summary'}
+        self.processor = None
+        if self.processor_tasks:
+            from dltv_scraper import DLTVDatasetProcessor
+            # เรียกใช้เฉพาะเมธอดสร้างคู่ข้อมูล จึงไม่ต้องผ่าน __init__ ที่สร้างโฟลเดอร์ output
+            self.processor = DLTVDatasetProcessor.__new__(DLTVDatasetProcessor)
+
+    def lesson_task_pairs(self, lesson):
+        """คืน (task, instruction, response) ของบทเรียนตาม task ที่เลือก"""
+        pairs = []
+        if 'summary' in self.tasks:
+            pairs.append((
+                'summary',
+                SUMMARY_INSTRUCTION.format(
+                    lesson_name=lesson['lesson_name'], subject=lesson['subject'], grade=lesson['grade']),
+                clean_text(lesson['content']),
+            ))
+        if self.processor is not None:
+            for pair in self.processor.create_lesson_pairs(lesson):
+                if pair['task'] in self.processor_tasks:
+                    pairs.append((pair['task'], pair['input'], pair['output']))
+        return pairs
+
+    def lesson_pairs(self, lesson):
+        """คืนคู่ (instruction, response) ของบทเรียนตาม task ที่เลือก"""
+        return [(instruction, response) for _, instruction, response in self.lesson_task_pairs(lesson)]
+
+    def render_chunk(self, lessons):
+        """render บทเรียนทั้งก้อน คืน dict ชื่อแม่แบบ -> list ของ record"""
+        rendered = {name: [] for name in self.templates}
+        for lesson in lessons:
+            for instruction, response in self.lesson_pairs(lesson):
+                for name, template in self.templates.items():
+                    rendered[name].append(template.render(instruction, response))
+        return rendered
+
+_worker_exporter = None
+
+def _init_worker(template_names, tasks, chat_template_model):
+    global _worker_exporter
+    _worker_exporter = PromptExporter(template_names, tasks, chat_template_model)
+
+def _render_in_worker(lessons):
+    return _worker_exporter.render_chunk(lessons)
+
+class _JsonStream:
+    """อ่านไฟล์ JSON ทีละส่วน แล้ว decode ค่าออกมาทีละค่าด้วย raw_decode"""
+
+    def __init__(self, f, read_size=1 << 20):
+        self.f = f
+        self.read_size = read_size
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """คืนอักขระถัดไปที่ไม่ใช่ช่องว่าง (ไม่เลื่อนตำแหน่ง)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"รูปแบบ JSON ไม่ถูกต้อง: ต้องการ '{char}' ที่ตำแหน่ง {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        """decode ค่า JSON ถัดไป อ่านไฟล์เพิ่มจนกว่าค่านั้นจะครบ"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # ตัวเลขที่อยู่ท้าย buffer อาจถูกตัดกลางคัน ต้องอ่านต่อก่อน
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+def iter_lessons(input_path):
+    """
+    อ่านบทเรียนทีละรายการโดยไม่โหลดทั้งไฟล์เข้าหน่วยความจำ
+
+    รองรับ .jsonl (หนึ่งบทเรียนต่อบรรทัด), .json ที่เป็น {"metadata": ..., "data": [...]}
+    และ .json แบบเก่าที่เป็น list ของบทเรียน
+    """
+    with open(input_path, 'r', encoding='utf-8') as f:
+        if input_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        stream = _JsonStream(f)
+        if stream.peek() == '[':
+            yield from _iter_array(stream)
+            return
+
+        stream.expect('{')
+        while stream.peek() != '}':
+            key = stream.value()
+            stream.expect(':')
+            if key == 'data':
+                yield from _iter_array(stream)
+            else:
+                stream.value()  # ข้าม metadata และคีย์อื่น ๆ
+            if stream.peek() == ',':
+                stream.pos += 1
+
+def _iter_array(stream):
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.pos += 1
+        return
+    while True:
+        yield stream.value()
+        if stream.peek() == ',':
+            stream.pos += 1
+        else:
+            stream.expect(']')
+            return
+
+def _iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _iter_rendered_chunks(exporter_args, lessons, chunk_size, workers, profiler):
+    """
+    render ทีละก้อน ถ้ามี workers จะกระจายงานไปหลาย process โดยจำกัดงานค้างไว้ไม่เกิน 2 ก้อนต่อ worker
+
+    เวลาอ่านบทเรียนนับใน stage load และเวลา render นับใน stage clean (สะสมทุกก้อน)
+    ถ้ามี workers stage clean คือเวลาที่รอผลจาก worker
+    """
+    chunks = _iter_chunks(lessons, chunk_size)
+
+    def next_chunk():
+        with profiler.stage("load", accumulate=True):
+            return next(chunks, None)
+
+    if workers <= 1:
+        exporter = PromptExporter(*exporter_args)
+        while (chunk := next_chunk()) is not None:
+            with profiler.stage("clean", accumulate=True):
+                rendered = exporter.render_chunk(chunk)
+            yield rendered
+        return
+
+    # แม่แบบถูกสร้าง (และคอมไพล์) ครั้งเดียวต่อ worker ใน initializer
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=exporter_args) as executor:
+        pending = deque()
+
+        def next_result():
+            with profiler.stage("clean", accumulate=True):
+                return pending.popleft().result()
+
+        while (chunk := next_chunk()) is not None:
+            pending.append(executor.submit(_render_in_worker, chunk))
+            if len(pending) >= workers * 2:
+                yield next_result()
+        while pending:
+            yield next_result()
+
+class _CsvSink:
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.f = open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f, lineterminator='\n')
+        self.writer.writerow(columns)
+
+    def write(self, records):
+        columns = self.columns
+        # ค่าที่ไม่ใช่ข้อความ (เช่น messages ของแม่แบบ chat) เขียนเป็น JSON แทน repr ของ Python
+        self.writer.writerows(
+            [value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+             for value in (record[column] for column in columns)]
+            for record in records)
+
+    def close(self):
+        self.f.close()
+
+class _JsonlSink:
+    def __init__(self, path, columns):
+        self.f = open(path, 'w', encoding='utf-8')
+
+    def write(self, records):
+        self.f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+    def close(self):
+        self.f.close()
+
+class _ParquetSink:
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.writer = None
+
+    def write(self, records):
+        if not records:
+            return
+        # หนึ่งก้อนเท่ากับหนึ่ง row group โดยใช้ schema ของก้อนแรก
+        if self.writer is None:
+            table = self.pa.Table.from_pylist(records)
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = self.pa.Table.from_pylist(records, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+SINKS = {
+    'csv': _CsvSink,
+    'jsonl': _JsonlSink,
+    'parquet': _ParquetSink,
+}
+
+def open_sink(output_path, columns=('text',), output_format=None):
+    """เปิดไฟล์ปลายทางตามรูปแบบ (csv, jsonl, parquet) ถ้าไม่ระบุจะดูจากนามสกุลไฟล์"""
+    if output_format is None:
+        output_format = os.path.splitext(output_path)[1].lstrip('.').lower() or 'csv'
+    if output_format not in SINKS:
+        raise ValueError(f"ไม่รองรับรูปแบบไฟล์ {output_format} (รองรับ {', '.join(SINKS)})")
+    return SINKS[output_format](output_path, columns)
+
+def export_prompts(input_path, exports, tasks=('summary',), chat_template_model=None,
+                   chunk_size=10000, workers=0, profiler=None, holdout_fraction=HOLDOUT_FRACTION):
+    """
+    อ่านบทเรียนครั้งเดียวแล้วเขียนออกหลายรูปแบบพร้อมกัน
+
+    Args:
+        exports: list ของคู่ (ชื่อแม่แบบ, path หรือ (path, format)) หรือ dict ชื่อแม่แบบ -> ปลายทาง
+            แม่แบบเดียวกันเขียนได้หลายไฟล์ (เช่น alpaca เป็นทั้ง csv และ parquet) โดย render ครั้งเดียว
+        tasks: task ที่จะสร้าง ('summary', 'qa', 'summarize', 'create_lesson_plan')
+        holdout_fraction: สัดส่วนบทเรียนที่กันไว้สำหรับ gracer_ai_eval.py และไม่เขียนลงไฟล์
+
+    Returns:
+        dict ชื่อแม่แบบ -> จำนวน record ที่เขียน
+    """
+    profiler = profiler or StageProfiler()
+    if isinstance(exports, dict):
+        exports = exports.items()
+    exports = [(name, *(target if isinstance(target, tuple) else (target, None))) for name, target in exports]
+    paths = [path for _, path, _ in exports]
+    if len(set(paths)) != len(paths):
+        raise ValueError("มีไฟล์ปลายทางซ้ำกันใน exports")
+    template_names = tuple(dict.fromkeys(name for name, _, _ in exports))
+    unknown_tasks = [task for task in tasks if task not in TASKS]
+    if unknown_tasks:
+        raise ValueError(f"ไม่รู้จัก task {', '.join(unknown_tasks)} (มี {', '.join(TASKS)})")
+
+    exporter_args = (template_names, tuple(tasks), chat_template_model)
+    counts = {name: 0 for name in template_names}
+    sinks = []
+    try:
+        for name, path, output_format in exports:
+            sinks.append((name, open_sink(path, TEMPLATES[name].columns, output_format or None)))
+        lessons = iter_lessons(input_path)
+        if holdout_fraction > 0:
+            lessons = (lesson for lesson in lessons if not is_held_out(lesson, holdout_fraction))
+        for rendered in _iter_rendered_chunks(exporter_args, lessons, chunk_size, workers, profiler):
+            with profiler.stage("write", accumulate=True):
+                for name, sink in sinks:
+                    sink.write(rendered[name])
+            for name, records in rendered.items():
+                counts[name] += len(records)
+    finally:
+        with profiler.stage("write", accumulate=True):
+            for _, sink in sinks:
+                sink.close()
+
+    for name, path, _ in exports:
+        print(f"เขียน {counts[name]} รายการในรูปแบบ {name} ไปที่ {path}")
+    return counts
+
+def convert_to_autotrain(input_path='dltv_dataset/dltv_dataset.json',
+                         output_path='dltv_dataset/dltv_dataset_autotrain.csv',
+                         profiler=None, output_format=None, chunk_size=10000, workers=0,
+                         holdout_fraction=HOLDOUT_FRACTION):
+    """
+    แปลงบทเรียนเป็นข้อมูลสำหรับ AutoTrain แบบ streaming
+
+    อ่านบทเรียน ทำความสะอาด และเขียนลงไฟล์ทีละก้อนขนาด chunk_size
+    หน่วยความจำที่ใช้จึงคงที่ไม่ว่าข้อมูลจะมีกี่บทเรียน บทเรียนในชุด held-out (holdout_fraction) ไม่ถูกเขียน
+    """
+    counts = export_prompts(input_path, {'alpaca': (output_path, output_format)},
+                            chunk_size=chunk_size, workers=workers, profiler=profiler,
+                            holdout_fraction=holdout_fraction)
+    count = counts['alpaca']
+    print(f"แปลงข้อมูลเสร็จสิ้น จำนวน {count} บทเรียน")
+    return count
+
+def _parse_export(value):
+    """แปลงอาร์กิวเมนต์ --export รูปแบบ ชื่อแม่แบบ=path"""
+    name, sep, path = value.partition('=')
+    if not sep or name not in TEMPLATES:
+        raise argparse.ArgumentTypeError(f"ต้องอยู่ในรูป <{'|'.join(TEMPLATES)}>=<path>")
+    return name, path
 
 if __name__ == "__main__":
-    convert_to_autotrain() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='แปลงข้อมูล DLTV เป็นไฟล์ CSV สำหรับ AutoTrain')
+    parser.add_argument('--input', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียน (.json หรือ .jsonl)')
+    parser.add_argument('--output', type=str, default='dltv_dataset/dltv_dataset_autotrain.csv',
+                        help='ไฟล์ที่จะบันทึก')
+    parser.add_argument('--format', type=str, choices=list(SINKS), default=None,
+                        help='รูปแบบไฟล์ปลายทาง (ค่าเริ่มต้นดูจากนามสกุลไฟล์)')
+    parser.add_argument('--export', type=_parse_export, action='append', default=None,
+                        help='เขียนหลายรูปแบบในรอบเดียว เช่น --export alpaca=a.csv --export chat=b.jsonl '
+                             '--export gemma=c.jsonl (ถ้าระบุจะไม่ใช้ --output)')
+    parser.add_argument('--tasks', type=str, nargs='+', choices=list(TASKS), default=['summary'],
+                        help='ชนิดคู่ instruction/response ที่จะสร้างจากแต่ละบทเรียน')
+    parser.add_argument('--chat-template-model', type=str, default=None,
+                        help='โมเดลที่จะใช้ chat template สำหรับแม่แบบ gemma เช่น google/gemma-3-1b-it')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='จำนวนบทเรียนต่อก้อนที่เขียนลงไฟล์')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='จำนวน process สำหรับทำความสะอาดข้อความ (0 = ทำใน process หลัก)')
+    parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                        help='กันบทเรียนสัดส่วนนี้ไว้ประเมินผลด้วย gracer_ai_eval.py (ใช้ค่าเดียวกันทั้งสองฝั่ง, 0 = ไม่กัน)')
+    parser.add_argument('--compact', type=str, default=None,
+                        help='เขียนไฟล์ .json แบบกะทัดรัด (ฟิลด์บทเรียนครั้งเดียว + การอ้างอิงของแต่ละคู่) '
+                             'ที่ gracer_ai_trainer.py render ด้วย --template ตอน tokenize (ถ้าระบุจะไม่ใช้ --output)')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    profiler = profiler_from_args(args)
+    if args.compact:
+        from compact_dataset import write_compact_dataset
+        write_compact_dataset(args.input, args.compact, args.tasks, args.holdout_fraction, profiler,
+                              args.chunk_size)
+    elif args.export:
+        export_prompts(args.input, args.export, args.tasks, args.chat_template_model,
+                       args.chunk_size, args.workers, profiler, args.holdout_fraction)
+    elif args.tasks != ['summary']:
+        export_prompts(args.input, {'alpaca': (args.output, args.format)}, args.tasks,
+                       chunk_size=args.chunk_size, workers=args.workers, profiler=profiler,
+                       holdout_fraction=args.holdout_fraction)
+    else:
+        convert_to_autotrain(args.input, args.output, profiler, args.format, args.chunk_size, args.workers,
+                             args.holdout_fraction)
+    profiler.report()
@@ -0,0 +1,425 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import random
+import resource
+import subprocess
+import time
+import tracemalloc
+
+SUBJECTS = {
+    "ภาษาไทย": ["การอ่านออกเสียง", "การเขียนพยัญชนะ สระ วรรณยุกต์", "การเขียนสื่อสาร", "การอ่านจับใจความ",
+                "คำคล้องจอง", "นิทานพื้นบ้าน", "การแต่งประโยค", "มารยาทในการฟัง"],
+    "คณิตศาสตร์": ["จำนวนนับ 1 ถึง 10", "การบวกจำนวนที่มีผลบวกไม่เกิน 9", "การลบจำนวนที่มีตัวตั้งไม่เกิน 9",
+                   "รูปเรขาคณิต", "การวัดความยาว", "เศษส่วน", "ทศนิยม", "การคูณและการหาร"],
+    "วิทยาศาสตร์และเทคโนโลยี": ["สิ่งมีชีวิตและสิ่งไม่มีชีวิต", "พืชและสัตว์", "วัสดุรอบตัวเรา",
+                                 "ดวงอาทิตย์และดวงจันทร์", "แรงและการเคลื่อนที่", "วงจรไฟฟ้าอย่างง่าย"],
+    "สังคมศึกษา ศาสนาและวัฒนธรรม": ["ครอบครัวของเรา", "ศาสนาที่เรานับถือ", "สินค้าและบริการ",
+                                     "วันสำคัญของชาติ", "ชุมชนของเรา", "หน้าที่พลเมือง"],
+    "ประวัติศาสตร์": ["ประวัติความเป็นมาของครอบครัว", "บุคคลสำคัญในอดีต", "บุคคลสำคัญของชุมชน",
+                      "ปีที่ผ่านมาฉันเป็นอย่างไร", "สมัยสุโขทัย", "สมัยอยุธยา"],
+    "สุขศึกษาและพลศึกษา": ["ร่างกายของเรา", "การดูแลรักษาร่างกาย", "ความปลอดภัยในชีวิตประจำวัน",
+                           "กิจกรรมทางกาย", "การเคลื่อนไหวร่างกายขั้นพื้นฐาน"],
+    "ศิลปะ": ["การวาดภาพระบายสี", "สีและรูปร่าง", "ทักษะดนตรี", "การแสดงนาฏศิลป์", "งานปั้น"],
+    "ภาษาอังกฤษ": ["Hello!", "My Family", "My School", "My Body", "Animals", "Colors", "Numbers"],
+    "การงานอาชีพ": ["งานบ้าน", "งานประดิษฐ์", "งานเกษตร", "การใช้อุปกรณ์อย่างปลอดภัย"],
+}
+
+GRADES = [
+    "อนุบาลศึกษาปีที่ 1", "อนุบาลศึกษาปีที่ 2", "อนุบาลศึกษาปีที่ 3",
+    "ประถมศึกษาปีที่ 1", "ประถมศึกษาปีที่ 2", "ประถมศึกษาปีที่ 3",
+    "ประถมศึกษาปีที่ 4", "ประถมศึกษาปีที่ 5", "ประถมศึกษาปีที่ 6",
+    "มัธยมศึกษาปีที่ 1", "มัธยมศึกษาปีที่ 2", "มัธยมศึกษาปีที่ 3",
+    "ชมล่วงหน้า", "ชมย้อนหลัง", "ชม VOD",
+]
+
+# Section headers recognised by DLTVDatasetProcessor, with sentence fragments to fill them
+SECTIONS = {
+    "สาระสำคัญ": [
+        "การเรียน{subject}ในระดับชั้น{grade} มุ่งเน้นให้นักเรียนเข้าใจเรื่อง{lesson}อย่างเป็นระบบ",
+        "นักเรียนสามารถนำความรู้เรื่อง{lesson}ไปใช้ในชีวิตประจำวันได้อย่างเหมาะสม",
+        "บทเรียนนี้ช่วยพัฒนาทักษะการคิด การสื่อสาร และการทำงานร่วมกับผู้อื่น",
+    ],
+    "จุดประสงค์การเรียนรู้": [
+        "นักเรียนสามารถอธิบายเรื่อง{lesson}ได้ถูกต้อง",
+        "นักเรียนสามารถยกตัวอย่างที่เกี่ยวข้องกับ{lesson}ได้",
+        "นักเรียนมีเจตคติที่ดีต่อการเรียนวิชา{subject}",
+        "นักเรียนสามารถทำงานกลุ่มและนำเสนอผลงานได้",
+    ],
+    "กิจกรรมการเรียนรู้": [
+        "ครูนำเข้าสู่บทเรียนด้วยคำถามเกี่ยวกับ{lesson}",
+        "นักเรียนแบ่งกลุ่มศึกษาใบความรู้และอภิปรายร่วมกัน",
+        "นักเรียนทำแบบฝึกหัดและนำเสนอผลงานหน้าชั้นเรียน",
+        "ครูและนักเรียนร่วมกันสรุปสาระสำคัญของบทเรียน",
+    ],
+    "การวัดและประเมินผล": [
+        "สังเกตพฤติกรรมการเรียน",
+        "ตรวจผลงานและแบบฝึกหัด",
+        "ทดสอบความเข้าใจเรื่อง{lesson}",
+    ],
+    "สื่อการเรียนรู้": [
+        "หนังสือเรียนวิชา{subject}",
+        "ใบความรู้และใบงาน",
+        "สื่อมัลติมีเดีย DLTV",
+        "บัตรคำและภาพประกอบ",
+    ],
+}
+
+SIZE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+
+def parse_size(value):
+    """Parse a corpus size such as 10k, 1M or 250000"""
+    value = value.strip().lower()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _build_lesson(rng, index, section_coverage):
+    """Build one synthetic lesson record in the scraper's schema"""
+    subject = rng.choice(list(SUBJECTS))
+    lesson_name = rng.choice(SUBJECTS[subject])
+    grade = rng.choice(GRADES)
+    lesson_number = index + 1
+    fields = {"subject": subject, "lesson": lesson_name, "grade": grade}
+
+    parts = [f"บทเรียนเรื่อง {lesson_name} (ระดับชั้น{grade})"]
+    for header, sentences in SECTIONS.items():
+        if rng.random() >= section_coverage:
+            continue
+        count = rng.randint(1, len(sentences))
+        chosen = rng.sample(sentences, count)
+        if header == "สาระสำคัญ":
+            body = " ".join(s.format(**fields) for s in chosen)
+        else:
+            body = "\n".join(f"{i}. {s.format(**fields)}" for i, s in enumerate(chosen, 1))
+        parts.append(f"{header}:\n{body}")
+
+    slug = subject.replace(" ", "_").lower()
+    return {
+        "lesson_id": f"{slug}{lesson_number}",
+        "lesson_name": lesson_name,
+        "content": "\n\n".join(parts) + "\n\n",
+        "subject": subject,
+        "grade": grade,
+        "materials": [
+            {"name": f"คู่มือครูวิชา{subject} บทที่ {lesson_number}",
+             "url": f"https://www.dltv.ac.th/download/teacher_guide_{slug}_{lesson_number}.pdf"},
+            {"name": f"ใบงานสำหรับนักเรียน บทที่ {lesson_number}",
+             "url": f"https://www.dltv.ac.th/download/student_worksheet_{slug}_{lesson_number}.pdf"},
+        ],
+        "video_url": f"https://www.youtube.com/embed/sample_{slug}_{lesson_number}",
+    }
+
+
+def iter_synthetic_lessons(count, duplicate_rate=0.0, section_coverage=1.0, seed=0):
+    """
+    Yield synthetic lesson records
+
+    Args:
+        count: Number of records to produce
+        duplicate_rate: Fraction of records that repeat an earlier lesson, half of
+            them verbatim and half as a re-scrape with slightly different content
+        section_coverage: Probability that each content section is present
+        seed: Random seed, so the same arguments always give the same corpus
+    """
+    rng = random.Random(seed)
+    recent = []
+    unique = 0
+    for _ in range(count):
+        if recent and rng.random() < duplicate_rate:
+            lesson = dict(rng.choice(recent))
+            if rng.random() < 0.5:
+                lesson["content"] = lesson["content"] + "หมายเหตุ: ปรับปรุงเนื้อหาล่าสุด\n\n"
+            yield lesson
+            continue
+        lesson = _build_lesson(rng, unique, section_coverage)
+        unique += 1
+        # Keep a bounded window of earlier lessons to duplicate from
+        if len(recent) < 1000:
+            recent.append(lesson)
+        else:
+            recent[rng.randrange(1000)] = lesson
+        yield lesson
+
+
+def generate_corpus(output_file, count, duplicate_rate=0.0, section_coverage=1.0, seed=0):
+    """Stream a synthetic dataset to output_file in the dltv_dataset.json layout"""
+    metadata = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "version": "1.0",
+        "source": "synthetic",
+        "duplicate_rate": duplicate_rate,
+        "section_coverage": section_coverage,
+        "seed": seed,
+    }
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write('{"metadata": ' + json.dumps(metadata, ensure_ascii=False) + ', "data": [\n')
+        for i, lesson in enumerate(iter_synthetic_lessons(count, duplicate_rate, section_coverage, seed)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(lesson, ensure_ascii=False))
+        f.write("\n]}\n")
+    return output_file
+
+
+# Each stage setup returns a zero-argument callable; only that callable is measured.
+# Setup runs in the same child process, so inputs are loaded before timing starts.
+
+def _setup_processor_load(paths):
+    from dltv_scraper import DLTVDatasetProcessor
+    processor = DLTVDatasetProcessor(paths["workdir"])
+    return lambda: len(processor.load_dataset(paths["corpus"])["data"])
+
+
+def _setup_training_pairs(paths):
+    from dltv_scraper import DLTVDatasetProcessor
+    processor = DLTVDatasetProcessor(paths["workdir"])
+    dataset = processor.load_dataset(paths["corpus"])
+    return lambda: len(processor.create_training_pairs(dataset))
+
+
+def _setup_convert(paths):
+    from convert_to_autotrain import convert_to_autotrain
+    return lambda: convert_to_autotrain(paths["corpus"], paths["csv"], holdout_fraction=0)
+
+
+def _setup_trainer_load(paths):
+    from gracer_ai_trainer import load_dataset
+    return lambda: len(load_dataset(paths["csv"]))
+
+
+def _setup_prepare_dataset(paths):
+    from gracer_ai_trainer import load_dataset, prepare_dataset
+    data = load_dataset(paths["csv"])
+    return lambda: len(prepare_dataset(data))
+
+
+STAGES = {
+    "processor.load_dataset": _setup_processor_load,
+    "processor.create_training_pairs": _setup_training_pairs,
+    "convert_to_autotrain": _setup_convert,
+    "trainer.load_dataset": _setup_trainer_load,
+    "trainer.prepare_dataset": _setup_prepare_dataset,
+}
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux only); returns False if unsupported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if platform.system() == "Darwin" else maxrss / 1024
+
+
+def _run_stage(stage, paths, trace_memory, queue):
+    """Child-process entry point: set up, then measure one stage"""
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            run = STAGES[stage](paths)
+            _reset_peak_rss()
+            if trace_memory:
+                tracemalloc.start()
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            records = run()
+            seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            if trace_memory:
+                tracemalloc.stop()
+        queue.put({
+            "records": records,
+            "seconds": round(seconds, 4),
+            "cpu_seconds": round(cpu_seconds, 4),
+            "throughput": round(records / seconds, 2) if seconds else None,
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "tracemalloc_peak_mb": round(traced_peak / (1024 * 1024), 1) if traced_peak is not None else None,
+        })
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def measure_stage(stage, paths, trace_memory=False, timeout=None):
+    """
+    Run a stage in a fresh process so its peak memory is not polluted by earlier stages
+
+    A child that dies without reporting (e.g. OOM-killed at the larger corpus sizes) or
+    runs past timeout seconds is recorded as a failed stage instead of hanging the run.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(stage, paths, trace_memory, queue))
+    process.start()
+    start = time.perf_counter()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except queue_module.Empty:
+            if timeout is not None and time.perf_counter() - start > timeout:
+                process.terminate()
+                result = {"error": f"timed out after {timeout:g}s"}
+            elif not process.is_alive():
+                # the result may have been put just before the child exited
+                try:
+                    result = queue.get(timeout=1)
+                except queue_module.Empty:
+                    result = {"error": _exit_reason(process.exitcode)}
+    process.join()
+    return result
+
+
+def _exit_reason(exitcode):
+    if exitcode is not None and exitcode < 0:
+        return f"stage process killed by signal {-exitcode} (possibly out of memory)"
+    return f"stage process exited with code {exitcode} without a result"
+
+
+def current_commit():
+    """Short hash of the checked-out commit, or None outside a git tree"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, stages, workdir="benchmarks", results_file="benchmarks/results.jsonl",
+                   duplicate_rate=0.05, section_coverage=0.9, seed=0, trace_memory=False, stage_timeout=None):
+    """
+    Generate a corpus for each size and record per-stage timings to results_file
+
+    The generator parameters are kept next to each corpus in corpus.json; a cached corpus
+    built with different parameters is regenerated so results are never mislabelled.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(os.path.dirname(results_file) or ".", exist_ok=True)
+    commit = current_commit()
+
+    for size in sizes:
+        size_dir = os.path.join(workdir, f"corpus_{size}")
+        os.makedirs(size_dir, exist_ok=True)
+        paths = {
+            "workdir": size_dir,
+            "corpus": os.path.join(size_dir, "dltv_dataset.json"),
+            "csv": os.path.join(size_dir, "dltv_dataset_autotrain.csv"),
+        }
+        corpus_params = {"size": size, "duplicate_rate": duplicate_rate,
+                         "section_coverage": section_coverage, "seed": seed}
+        params_path = os.path.join(size_dir, "corpus.json")
+        try:
+            with open(params_path, encoding="utf-8") as f:
+                cached_params = json.load(f)
+        except (OSError, ValueError):
+            cached_params = None
+        if cached_params != corpus_params or not os.path.exists(paths["corpus"]):
+            print(f"Generating {size} synthetic lessons...")
+            generate_corpus(paths["corpus"], size, duplicate_rate, section_coverage, seed)
+            with open(params_path, "w", encoding="utf-8") as f:
+                json.dump(corpus_params, f, indent=2)
+
+        for stage in stages:
+            result = measure_stage(stage, paths, trace_memory, stage_timeout)
+            record = {
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "commit": commit,
+                "python": platform.python_version(),
+                "size": size,
+                "stage": stage,
+                "duplicate_rate": duplicate_rate,
+                "section_coverage": section_coverage,
+                "seed": seed,
+                **result,
+            }
+            with open(results_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            if "error" in result:
+                print(f"{stage:34s} {size:>10,d}  failed: {result['error']}")
+            else:
+                print(f"{stage:34s} {size:>10,d}  {result['seconds']:9.2f}s  "
+                      f"{result['throughput'] or 0:12,.0f} rec/s  {result['peak_rss_mb']:9.1f} MB")
+
+
+def compare_results(results_file, base_commit, head_commit=None):
+    """Print the change in time and memory per stage and size between two commits"""
+    head_commit = head_commit or current_commit()
+    latest = {}
+    with open(results_file, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("commit") in (base_commit, head_commit) and "error" not in record:
+                latest[(record["commit"], record["stage"], record["size"])] = record
+
+    print(f"{'stage':34s} {'size':>10s} {'time':>9s} {'memory':>9s}   ({base_commit} -> {head_commit})")
+    for (commit, stage, size), head in sorted(latest.items(), key=lambda kv: (kv[0][2], kv[0][1])):
+        base = latest.get((base_commit, stage, size))
+        if commit != head_commit or base is None:
+            continue
+        time_change = (head["seconds"] / base["seconds"] - 1) * 100 if base["seconds"] else 0
+        memory_change = (head["peak_rss_mb"] / base["peak_rss_mb"] - 1) * 100 if base["peak_rss_mb"] else 0
+        print(f"{stage:34s} {size:>10,d} {time_change:+8.1f}% {memory_change:+8.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic DLTV corpus generator and pipeline benchmarks')
+    parser.add_argument('--action', type=str, choices=['generate', 'benchmark', 'compare'],
+                        default='benchmark', help='Action to perform')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[10_000],
+                        help='Corpus sizes, e.g. 10k 100k 1M 10M')
+    parser.add_argument('--stages', type=str, nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='Pipeline stages to benchmark')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                        help='Fraction of records that repeat an earlier lesson')
+    parser.add_argument('--section-coverage', type=float, default=0.9,
+                        help='Probability that each content section is present')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generator')
+    parser.add_argument('--output', type=str, default='dltv_dataset/synthetic_dataset.json',
+                        help='Output file for --action generate')
+    parser.add_argument('--workdir', type=str, default='benchmarks',
+                        help='Directory for generated corpora and intermediate outputs')
+    parser.add_argument('--results', type=str, default='benchmarks/results.jsonl',
+                        help='JSONL file that benchmark results are appended to')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Also record Python allocation peaks (slows stages down)')
+    parser.add_argument('--stage-timeout', type=float, default=None,
+                        help='Seconds after which a benchmarked stage is stopped and recorded as failed')
+    parser.add_argument('--base', type=str, help='Commit to compare against for --action compare')
+
+    args = parser.parse_args()
+
+    if args.action == 'generate':
+        for size in args.sizes:
+            output = args.output if len(args.sizes) == 1 else args.output.replace('.json', f'_{size}.json')
+            generate_corpus(output, size, args.duplicate_rate, args.section_coverage, args.seed)
+            print(f"Generated {size:,d} synthetic lessons at {output}")
+    elif args.action == 'benchmark':
+        run_benchmarks(args.sizes, args.stages, args.workdir, args.results,
+                       args.duplicate_rate, args.section_coverage, args.seed, args.tracemalloc,
+                       args.stage_timeout)
+    elif args.action == 'compare':
+        if not args.base:
+            parser.error('--base is required for --action compare')
+        compare_results(args.results, args.base)
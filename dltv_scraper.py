@@ -5,9 +5,11 @@ import os
 import time
 import pandas as pd
 import re
-from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 import argparse
+from pipeline_profiler import StageProfiler, add_profile_arguments, profiler_from_args
 
 class DLTVScraper:
     """
@@ -714,6 +716,46 @@ class DLTVScraper:
         print(f"Total lessons scraped: {len(dataset['data'])}")
         return dataset
 
+def _content_hash(content):
+    """Hash lesson content with whitespace normalized so re-scraped copies compare equal"""
+    return hashlib.sha256(" ".join((content or "").split()).encode("utf-8")).hexdigest()
+
+def _read_lesson_list(path):
+    """Read the list of lessons from a dataset file (dict with 'data' or legacy list)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return data.get('data') or [], data.get('metadata') or {}
+    if isinstance(data, list):
+        return data, {}
+    return [], {}
+
+def _digest_lesson_file(path):
+    """
+    Parse one dataset file and return ((grade, lesson_id), content_hash, content_length) per lesson
+
+    A file that cannot be read or parsed is reported and skipped (no lessons), so one
+    corrupt grade file does not abort the whole merge.
+    """
+    try:
+        lessons, metadata = _read_lesson_list(path)
+    except (OSError, ValueError) as e:
+        print(f"Error loading {os.path.basename(path)}: {str(e)}")
+        return [], {}
+    digests = []
+    for lesson in lessons:
+        content = lesson.get('content') or ''
+        content_hash = _content_hash(content)
+        # lesson_id is only unique within a grade (e.g. "thai1" exists for every grade)
+        key = (lesson.get('grade') or '', lesson.get('lesson_id') or content_hash)
+        digests.append((key, content_hash, len(content)))
+    return digests, metadata
+
+def _select_lessons(path, indices):
+    """Parse one dataset file and return only the lessons at the given indices"""
+    lessons, _ = _read_lesson_list(path)
+    return [(index, lessons[index]) for index in sorted(indices)]
+
 class DLTVDatasetProcessor:
     """
     Enhanced data processor for DLTV website content for use in AI model training.
@@ -805,6 +847,128 @@ class DLTVDatasetProcessor:
             print(f"Error loading dataset from {path}: {str(e)}")
             return None
         
+    def find_source_files(self):
+        """List the per-grade dataset files to merge, in a stable order"""
+        return sorted(
+            os.path.join(self.input_path, f) for f in os.listdir(self.input_path)
+            if f.endswith('.json') and f != 'dltv_dataset.json'
+        )
+
+    def plan_merge(self, files, max_workers=None):
+        """
+        Parse the input files in parallel and decide which copy of each lesson to keep
+
+        Lessons are keyed by (grade, lesson_id). When several files carry the same
+        lesson the copy with the longest content wins; ties are broken by content hash and
+        then by file name and position, so the result does not depend on the order
+        the workers finish in. Winning lessons whose content is identical to another
+        winner under a different key are dropped as well.
+
+        Returns:
+            (selected, provenance, metadata) where selected maps each file to the
+            indices to keep and provenance lists the sources of every lesson
+        """
+        candidates = {}
+        metadata = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # executor.map yields in submission order, which keeps the merge deterministic
+            for rank, (path, (digests, file_metadata)) in enumerate(
+                    zip(files, executor.map(_digest_lesson_file, files))):
+                print(f"Parsed {len(digests)} lessons from {os.path.basename(path)}")
+                if not metadata and file_metadata:
+                    metadata = dict(file_metadata)
+                for index, (key, content_hash, length) in enumerate(digests):
+                    candidates.setdefault(key, []).append({
+                        'file': os.path.basename(path),
+                        'index': index,
+                        'content_hash': content_hash,
+                        'length': length,
+                        'rank': rank,
+                    })
+
+        selected = {path: [] for path in files}
+        provenance = []
+        seen_hashes = {}
+        for key in sorted(candidates):
+            sources = candidates[key]
+            winner = min(sources, key=lambda s: (-s['length'], s['content_hash'], s['rank'], s['index']))
+            entry = {
+                'grade': key[0],
+                'lesson_id': key[1],
+                'selected': {'file': winner['file'], 'index': winner['index']},
+                'content_hash': winner['content_hash'],
+                'sources': [
+                    {'file': s['file'], 'index': s['index'], 'content_hash': s['content_hash']}
+                    for s in sources
+                ],
+            }
+            if winner['content_hash'] in seen_hashes:
+                entry['duplicate_of'] = dict(zip(('grade', 'lesson_id'), seen_hashes[winner['content_hash']]))
+            else:
+                seen_hashes[winner['content_hash']] = key
+                selected[files[winner['rank']]].append(winner['index'])
+            provenance.append(entry)
+
+        return selected, provenance, metadata
+
+    def iter_merged_lessons(self, files=None, max_workers=None, plan=None):
+        """
+        Stream deduplicated lessons from all per-grade dataset files
+
+        Files are parsed in parallel twice: once to plan the merge from lightweight
+        digests, and once to pull out only the winning lessons, so the full corpus
+        is never held in memory at once. Where each lesson came from is written to
+        processed/merge_provenance.json.
+        """
+        if files is None:
+            files = self.find_source_files()
+        if not files:
+            return
+        if plan is None:
+            plan = self.plan_merge(files, max_workers)
+        selected, provenance, _ = plan
+
+        provenance_path = os.path.join(self.output_path, "merge_provenance.json")
+        with open(provenance_path, 'w', encoding='utf-8') as f:
+            json.dump(provenance, f, ensure_ascii=False, indent=2)
+
+        duplicates = sum(len(entry['sources']) for entry in provenance) - sum(
+            len(indices) for indices in selected.values())
+        print(f"Merging {len(files)} files: {duplicates} duplicate lessons dropped, "
+              f"provenance saved to {provenance_path}")
+
+        paths = [path for path in files if selected[path]]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for lessons in executor.map(_select_lessons, paths, [selected[path] for path in paths]):
+                for _, lesson in lessons:
+                    yield lesson
+
+    def merge_datasets(self, files=None, max_workers=None):
+        """Merge all per-grade dataset files into a single deduplicated dataset"""
+        if files is None:
+            files = self.find_source_files()
+        if not files:
+            return {'metadata': {}, 'data': []}
+        plan = self.plan_merge(files, max_workers)
+        metadata = dict(plan[2])
+        metadata['merged_from'] = [os.path.basename(path) for path in files]
+        return {
+            'metadata': metadata,
+            'data': list(self.iter_merged_lessons(files, max_workers, plan)),
+        }
+
+    def write_merged_dataset(self, output_file=None, max_workers=None):
+        """Stream the merged, deduplicated lessons to a JSONL file"""
+        if output_file is None:
+            output_file = os.path.join(self.output_path, "merged_lessons.jsonl")
+        count = 0
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for lesson in self.iter_merged_lessons(max_workers=max_workers):
+                f.write(json.dumps(lesson, ensure_ascii=False) + '\n')
+                count += 1
+        print(f"Saved {count} merged lessons to {output_file}")
+        return count
+
     def clean_text(self, text):
         """Clean and normalize text content"""
         if not text:
@@ -833,33 +997,38 @@ class DLTVDatasetProcessor:
         
         # Extract lesson data
         for item in dataset['data']:
-            # Extract necessary information
-            lesson_name = item['lesson_name']
-            content = item['content']
-            subject = item['subject']
-            grade = item['grade']
-            
-            # Create input-output pairs for various training tasks
-            
-            # Task 1: Question answering based on lesson content
-            qa_pairs = self._create_qa_pairs(lesson_name, content, subject, grade)
-            training_pairs.extend(qa_pairs)
-            
-            # Task 2: Summarization
-            summary_pair = {
-                'task': 'summarize',
-                'input': f"Summarize the following lesson on {subject} ({grade}): {content}",
-                'output': self._generate_summary(content)
-            }
-            training_pairs.append(summary_pair)
-            
-            # Task 3: Lesson planning
-            lesson_plan_pair = {
-                'task': 'create_lesson_plan',
-                'input': f"Create a lesson plan for teaching {lesson_name} in {subject} for {grade} students.",
-                'output': self._generate_lesson_plan(lesson_name, content, subject, grade)
-            }
-            training_pairs.append(lesson_plan_pair)
+            training_pairs.extend(self.create_lesson_pairs(item))
+        
+        return training_pairs
+        
+    def create_lesson_pairs(self, item):
+        """Create the qa, summarize and create_lesson_plan pairs for a single lesson"""
+        # Extract necessary information
+        lesson_name = item['lesson_name']
+        content = item['content']
+        subject = item['subject']
+        grade = item['grade']
+        
+        # Create input-output pairs for various training tasks
+        
+        # Task 1: Question answering based on lesson content
+        training_pairs = self._create_qa_pairs(lesson_name, content, subject, grade)
+        
+        # Task 2: Summarization
+        summary_pair = {
+            'task': 'summarize',
+            'input': f"Summarize the following lesson on {subject} ({grade}): {content}",
+            'output': self._generate_summary(content)
+        }
+        training_pairs.append(summary_pair)
+        
+        # Task 3: Lesson planning
+        lesson_plan_pair = {
+            'task': 'create_lesson_plan',
+            'input': f"Create a lesson plan for teaching {lesson_name} in {subject} for {grade} students.",
+            'output': self._generate_lesson_plan(lesson_name, content, subject, grade)
+        }
+        training_pairs.append(lesson_plan_pair)
         
         return training_pairs
         
@@ -968,68 +1137,59 @@ class DLTVDatasetProcessor:
                 with open(subject_path, 'w', encoding='utf-8') as f:
                     json.dump(items, f, ensure_ascii=False, indent=2)
     
-    def process_all(self):
+    def process_all(self, max_workers=None, profiler=None):
         """Process all datasets in the input directory"""
+        profiler = profiler or StageProfiler()
         print("Loading dataset...")
         try:
-            # Try loading combined dataset first
-            dataset = self.load_dataset(self.input_path)
-            if dataset is None:
-                print("No combined dataset found, looking for individual grade files...")
-                dataset = {'metadata': {}, 'data': []}
-                # Find all JSON files in the input directory
-                for file in os.listdir(self.input_path):
-                    if file.endswith('.json') and file != 'dltv_dataset.json':
-                        file_path = os.path.join(self.input_path, file)
-                        try:
-                            grade_dataset = self.load_dataset(file_path)
-                            if grade_dataset and 'data' in grade_dataset:
-                                print(f"Adding data from {file}")
-                                dataset['data'].extend(grade_dataset['data'])
-                                # Merge metadata
-                                if not dataset['metadata'] and 'metadata' in grade_dataset:
-                                    dataset['metadata'] = grade_dataset['metadata']
-                        except Exception as e:
-                            print(f"Error loading {file}: {str(e)}")
-                
-                if not dataset['data']:
-                    print("No valid datasets found. Please run scraping first.")
-                    return
+            with profiler.stage("load"):
+                # Try loading combined dataset first
+                dataset = None
+                combined_path = os.path.join(self.input_path, 'dltv_dataset.json')
+                if os.path.exists(combined_path):
+                    dataset = self.load_dataset(combined_path)
+                if dataset is None:
+                    print("No combined dataset found, merging individual grade files...")
+                    dataset = self.merge_datasets(max_workers=max_workers)
+                    
+                    if not dataset['data']:
+                        print("No valid datasets found. Please run scraping first.")
+                        return
             
             # Process the data
-            print("Creating training pairs...")
-            training_data = self.create_training_pairs(dataset)
-            
-            # Save the processed data
-            print("Saving processed data...")
-            processed_path = os.path.join(self.output_path, "training_pairs.json")
-            with open(processed_path, 'w', encoding='utf-8') as f:
-                json.dump(training_data, f, ensure_ascii=False, indent=2)
-            print(f"Saved {len(training_data)} training pairs to {processed_path}")
-            
-            # Create subject datasets
-            print("Creating subject-specific datasets...")
-            subject_datasets = self.create_subject_datasets(dataset)
-            
-            # Save each subject dataset
-            for subject, data in subject_datasets.items():
-                subject_filename = re.sub(r'[^\w\s]', '', subject).replace(' ', '_').lower()
-                subject_path = os.path.join(self.output_path, f"{subject_filename}.json")
-                with open(subject_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                print(f"Saved {len(data['data'])} lessons for {subject} to {subject_path}")
+            with profiler.stage("pair generation"):
+                print("Creating training pairs...")
+                training_data = self.create_training_pairs(dataset)
                 
-            # Create grade datasets
-            print("Creating grade-specific datasets...")
-            grade_datasets = self.create_grade_datasets(dataset)
+                print("Creating subject-specific datasets...")
+                subject_datasets = self.create_subject_datasets(dataset)
+                
+                print("Creating grade-specific datasets...")
+                grade_datasets = self.create_grade_datasets(dataset)
             
-            # Save each grade dataset
-            for grade, data in grade_datasets.items():
-                grade_filename = re.sub(r'[^\w\s]', '', grade).replace(' ', '_').lower()
-                grade_path = os.path.join(self.output_path, f"{grade_filename}.json")
-                with open(grade_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                print(f"Saved {len(data['data'])} lessons for {grade} to {grade_path}")
+            with profiler.stage("write"):
+                # Save the processed data
+                print("Saving processed data...")
+                processed_path = os.path.join(self.output_path, "training_pairs.json")
+                with open(processed_path, 'w', encoding='utf-8') as f:
+                    json.dump(training_data, f, ensure_ascii=False, indent=2)
+                print(f"Saved {len(training_data)} training pairs to {processed_path}")
+                
+                # Save each subject dataset
+                for subject, data in subject_datasets.items():
+                    subject_filename = re.sub(r'[^\w\s]', '', subject).replace(' ', '_').lower()
+                    subject_path = os.path.join(self.output_path, f"{subject_filename}.json")
+                    with open(subject_path, 'w', encoding='utf-8') as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    print(f"Saved {len(data['data'])} lessons for {subject} to {subject_path}")
+                    
+                # Save each grade dataset
+                for grade, data in grade_datasets.items():
+                    grade_filename = re.sub(r'[^\w\s]', '', grade).replace(' ', '_').lower()
+                    grade_path = os.path.join(self.output_path, f"{grade_filename}.json")
+                    with open(grade_path, 'w', encoding='utf-8') as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    print(f"Saved {len(data['data'])} lessons for {grade} to {grade_path}")
                 
             print("Processing complete.")
             return True
@@ -1135,28 +1295,40 @@ class DLTVDatasetProcessor:
 # Example usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='DLTV Scraper and Dataset Processor')
-    parser.add_argument('--action', type=str, choices=['scrape', 'process', 'create-empty'], 
+    parser.add_argument('--action', type=str, choices=['scrape', 'process', 'merge', 'create-empty'], 
                         default='scrape', help='Action to perform')
     parser.add_argument('--grade', type=str, help='Specific grade level to scrape (e.g. "ประถมศึกษาปีที่ 1")')
     parser.add_argument('--max-lessons', type=int, default=5, 
                         help='Maximum number of lessons to scrape per subject')
     parser.add_argument('--output-path', type=str, default='dltv_dataset', 
                         help='Path to save or load the dataset')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes used to parse dataset files when merging')
+    add_profile_arguments(parser)
     
     args = parser.parse_args()
+    profiler = profiler_from_args(args)
     
     if args.action == 'scrape':
         scraper = DLTVScraper()
-        if args.grade:
-            print(f"Scraping content for grade: {args.grade}")
-            scraper.scrape_specific_grade(args.grade, args.output_path, args.max_lessons)
-        else:
-            print("Scraping all available content")
-            scraper.scrape_all(args.output_path, args.max_lessons)
+        with profiler.stage("scrape"):
+            if args.grade:
+                print(f"Scraping content for grade: {args.grade}")
+                scraper.scrape_specific_grade(args.grade, args.output_path, args.max_lessons)
+            else:
+                print("Scraping all available content")
+                scraper.scrape_all(args.output_path, args.max_lessons)
     elif args.action == 'process':
         processor = DLTVDatasetProcessor(args.output_path)
-        processor.process_all()
+        processor.process_all(max_workers=args.workers, profiler=profiler)
+    elif args.action == 'merge':
+        processor = DLTVDatasetProcessor(args.output_path)
+        with profiler.stage("merge"):
+            processor.write_merged_dataset(max_workers=args.workers)
     elif args.action == 'create-empty':
         processor = DLTVDatasetProcessor(args.output_path)
-        processor.create_empty_dataset()
+        with profiler.stage("write"):
+            processor.create_empty_dataset()
         print(f"Created empty dataset at {args.output_path}/dltv_dataset.json")
+    
+    profiler.report()
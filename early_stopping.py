@@ -0,0 +1,101 @@
+import glob
+import json
+import os
+import statistics
+from transformers import TrainerCallback
+
+SWEEP_CONFIG = "sweep.json"
+TRIALS_DIR = "trials"
+
+def write_json_atomic(path, data):
+    """เขียน JSON ลงไฟล์ชั่วคราวแล้วเปลี่ยนชื่อ ผู้อ่านพร้อมกันจึงไม่เห็นไฟล์ที่เขียนไม่ครบ"""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def trial_path(sweep_dir, trial_name):
+    return os.path.join(sweep_dir, TRIALS_DIR, f"{trial_name}.json")
+
+def load_trials(sweep_dir):
+    """อ่านบันทึกของทุก trial ใน sweep (dict ชื่อ -> record)"""
+    trials = {}
+    for path in sorted(glob.glob(os.path.join(sweep_dir, TRIALS_DIR, "*.json"))):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        trials[record['name']] = record
+    return trials
+
+class MedianStoppingCallback(TrainerCallback):
+    """
+    บันทึก eval loss ของ trial ลงโฟลเดอร์ sweep และหยุด trial ที่แย่กว่าค่ามัธยฐานของ trial อื่น (median stopping rule)
+
+    ทุกครั้งที่ evaluate จะเทียบ eval loss ที่ดีที่สุดของ trial นี้กับ eval loss ที่ดีที่สุดของ trial อื่น
+    ณ ความคืบหน้าเดียวกัน (นับเป็น epoch เพราะแต่ละ trial อาจใช้ batch size ต่างกัน) ถ้าแย่กว่ามัธยฐาน
+    จะหยุดฝึก เทียบเฉพาะเมื่อ evaluate มาแล้วเกิน grace_evals ครั้งและมี trial อื่นให้เทียบอย่างน้อย min_trials ตัว
+    ค่าเหล่านี้อ่านจาก sweep.json ที่ gracer_ai_sweep.py เขียนไว้
+    """
+
+    def __init__(self, sweep_dir, trial_name):
+        self.sweep_dir = sweep_dir
+        self.path = trial_path(sweep_dir, trial_name)
+        with open(os.path.join(sweep_dir, SWEEP_CONFIG), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self.record = json.load(f)
+
+    def _save(self):
+        write_json_atomic(self.path, self.record)
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.record['status'] = 'running'
+        self._save()
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if not metrics or 'eval_loss' not in metrics:
+            return
+        epoch = state.epoch or 0.0
+        evals = self.record['evals']
+        evals.append({'step': state.global_step, 'epoch': round(epoch, 4), 'eval_loss': metrics['eval_loss']})
+        self.record['best_eval_loss'] = min(e['eval_loss'] for e in evals)
+        self._save()
+        if not self.config.get('early_stopping', True) or len(evals) <= self.config.get('grace_evals', 1):
+            return
+        # การประเมินรอบสุดท้ายหลังฝึกจบไม่ต้องตัดสินหยุด
+        if self.record['status'] != 'running' or state.global_step >= state.max_steps:
+            return
+
+        others = []
+        for name, other in load_trials(self.sweep_dir).items():
+            if name == self.record['name'] or not other.get('evals'):
+                continue
+            # นับเฉพาะ trial ที่ฝึกมาถึงความคืบหน้านี้แล้ว
+            if other['evals'][-1]['epoch'] < epoch:
+                continue
+            # trial ที่ batch size ต่างกันประเมินที่ epoch ต่างกัน อาจยังไม่มีผลที่ epoch นี้หรือก่อนหน้า
+            best = min((e['eval_loss'] for e in other['evals'] if e['epoch'] <= epoch + 1e-6), default=None)
+            if best is not None:
+                others.append(best)
+        if len(others) < self.config.get('min_trials', 3):
+            return
+        median = statistics.median(others)
+        if self.record['best_eval_loss'] > median:
+            print(f"หยุด trial {self.record['name']} ที่ epoch {epoch:.2f}: eval loss ดีที่สุด "
+                  f"{self.record['best_eval_loss']:.4f} แย่กว่ามัธยฐาน {median:.4f} ของ {len(others)} trial")
+            self.record['status'] = 'stopped'
+            self.record['stopped_at_epoch'] = round(epoch, 4)
+            self._save()
+            control.should_training_stop = True
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.record['status'] == 'running':
+            self.record['status'] = 'completed'
+        losses = [entry['loss'] for entry in state.log_history if 'loss' in entry]
+        summary = next((entry for entry in reversed(state.log_history) if 'train_loss' in entry), {})
+        self.record['train_loss'] = summary.get('train_loss', losses[-1] if losses else None)
+        self.record['train_runtime'] = summary.get('train_runtime')
+        self.record['global_step'] = state.global_step
+        self._save()
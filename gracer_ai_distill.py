@@ -0,0 +1,478 @@
+import argparse
+import gc
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer, DataCollatorForSeq2Seq, Trainer, TrainingArguments
+from transformers.trainer_utils import get_last_checkpoint
+from async_checkpoint import AsyncCheckpointTrainer
+from convert_to_autotrain import HOLDOUT_FRACTION
+from gracer_ai_trainer import (PaddingStatsCollator, build_arg_parser, configure_cpu, cpu_supports_bf16,
+                               load_or_build_tokenized_dataset, tokenized_cache_key)
+from model_loader import load_causal_lm, load_in_background, warmup
+from pipeline_profiler import profiler_from_args
+from response_cache import model_version
+from training_telemetry import TelemetryCallback, percentile
+
+TEACHER_CACHE_VERSION = 1  # เพิ่มค่านี้เมื่อวิธีคำนวณหรือรูปแบบไฟล์ของ logits ครูเปลี่ยน
+
+def teacher_cache_key(args, tokenizer, teacher_path):
+    """key ของ cache logits ครู: ข้อมูลที่ tokenize แล้ว เวอร์ชันโมเดลครู และจำนวน top-k"""
+    data_digest, _ = tokenized_cache_key(args, tokenizer)
+    key = {
+        "version": TEACHER_CACHE_VERSION,
+        "data": data_digest,
+        "teacher": model_version(teacher_path),
+        "top_k": args.kd_top_k,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return digest, key
+
+def _top_k_logits(model, hidden, top_k, chunk_size=128):
+    """top-k ของ logits ทีละช่วงตำแหน่ง ไม่ต้องสร้าง logits เต็ม vocab ของทั้งลำดับพร้อมกัน"""
+    lm_head = model.get_output_embeddings()
+    softcap = getattr(model.config, 'final_logit_softcapping', None)
+    values, indices = [], []
+    for start in range(0, hidden.shape[0], chunk_size):
+        logits = lm_head(hidden[start:start + chunk_size]).float()
+        if softcap:
+            logits = torch.tanh(logits / softcap) * softcap
+        top = logits.topk(top_k, dim=-1)
+        values.append(top.values)
+        indices.append(top.indices)
+    return torch.cat(values), torch.cat(indices)
+
+@torch.inference_mode()
+def build_teacher_cache(teacher, dataset, cache_path, top_k, batch_size, pad_token_id):
+    """
+    รันโมเดลครูผ่านข้อมูลฝึกครั้งเดียวแล้วเก็บ top-k logits ของทุกตำแหน่งลงดิสก์
+
+    เก็บเป็นไฟล์ .npy สามไฟล์: values (float16) และ indices (int32) ขนาด [จำนวน token ทั้งหมด, top_k]
+    กับ offsets ที่บอกว่าตัวอย่าง i อยู่ที่แถว offsets[i]:offsets[i+1] ตอนฝึกจะเปิดแบบ memory-map
+    logits เต็ม vocab (262k ของ Gemma 3) ใหญ่เกินเก็บ และ probability mass เกือบทั้งหมดอยู่ใน top-k อยู่แล้ว
+    """
+    lengths = np.array([len(ids) for ids in dataset["input_ids"]], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(tmp_path, "values.npy"), mode='w+',
+                                       dtype=np.float16, shape=(int(offsets[-1]), top_k))
+    indices = np.lib.format.open_memmap(os.path.join(tmp_path, "indices.npy"), mode='w+',
+                                        dtype=np.int32, shape=(int(offsets[-1]), top_k))
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+
+    # เรียงตามความยาวเพื่อให้ padding น้อยที่สุด และ pad ด้านขวา ตำแหน่งของ token จริงจึงเริ่มที่ 0 เสมอ
+    order = np.argsort(lengths, kind='stable')
+    decoder = teacher.get_decoder()
+    start = time.perf_counter()
+    done_tokens = 0
+    next_report = 0.1
+    for batch_start in range(0, len(order), batch_size):
+        batch = order[batch_start:batch_start + batch_size]
+        width = int(lengths[batch].max())
+        input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, index in enumerate(batch):
+            n = int(lengths[index])
+            input_ids[row, :n] = torch.tensor(dataset[int(index)]["input_ids"])
+            attention_mask[row, :n] = 1
+        hidden = decoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        for row, index in enumerate(batch):
+            n = int(lengths[index])
+            top_values, top_indices = _top_k_logits(teacher, hidden[row, :n], top_k)
+            values[offsets[index]:offsets[index + 1]] = top_values.to(torch.float16).numpy()
+            indices[offsets[index]:offsets[index + 1]] = top_indices.to(torch.int32).numpy()
+            done_tokens += n
+        progress = (batch_start + len(batch)) / len(order)
+        if progress >= next_report:
+            elapsed = time.perf_counter() - start
+            print(f"ครู: {progress:.0%} ({done_tokens:,} token, {done_tokens / elapsed:,.0f} token/วินาที)")
+            next_report += 0.1
+    values.flush()
+    indices.flush()
+    del values, indices
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+class TeacherLogitsCollator:
+    """
+    ห่อ data collator ของ trainer แล้วเติม top-k logits ของครูที่ตำแหน่งเดียวกับ token ของแต่ละตัวอย่าง
+
+    ตัวอย่างต้องมีคอลัมน์ example_index (ลำดับใน cache) ไฟล์ cache เปิดแบบ memory-map ครั้งแรกที่ใช้
+    ใน process ที่เรียก จึงใช้กับ dataloader workers ได้
+    """
+
+    def __init__(self, collator, cache_path, padding_side='right'):
+        self.collator = collator
+        self.cache_path = cache_path
+        self.padding_side = padding_side
+        self._arrays = None
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = tuple(np.load(os.path.join(self.cache_path, f"{name}.npy"), mmap_mode='r')
+                                 for name in ("values", "indices", "offsets"))
+        return self._arrays
+
+    def __call__(self, features):
+        values, indices, offsets = self._open()
+        example_indices = [f["example_index"] for f in features]
+        batch = self.collator([{k: v for k, v in f.items() if k not in ("example_index", "length")}
+                               for f in features])
+        width = batch["input_ids"].shape[1]
+        top_k = values.shape[1]
+        teacher_values = torch.zeros((len(features), width, top_k), dtype=torch.float32)
+        teacher_indices = torch.zeros((len(features), width, top_k), dtype=torch.long)
+        for row, index in enumerate(example_indices):
+            start, end = int(offsets[index]), int(offsets[index + 1])
+            n = end - start
+            columns = slice(0, n) if self.padding_side == 'right' else slice(width - n, width)
+            teacher_values[row, columns] = torch.from_numpy(values[start:end].astype(np.float32))
+            teacher_indices[row, columns] = torch.from_numpy(indices[start:end].astype(np.int64))
+        batch["teacher_values"] = teacher_values
+        batch["teacher_indices"] = teacher_indices
+        return batch
+
+def distillation_loss(student_logits, teacher_values, teacher_indices, labels, temperature):
+    """
+    KL(ครู || นักเรียน) ต่อ token บน top-k ของครู คูณ temperature^2
+
+    ทั้งสองฝั่งเป็น softmax เฉพาะ logits ของ token ใน top-k ของครู (cache ไม่มีส่วนที่เหลือของ vocab)
+    นักเรียนที่ให้ logits เหมือนครูจึงได้ KL เป็นศูนย์ ส่วนความน่าจะเป็นของคำตอบจริงเรียนจาก cross entropy
+    logits ที่ตำแหน่ง t ทำนาย token t+1 จึงนับเฉพาะตำแหน่งที่ label ถัดไปไม่ใช่ -100
+    """
+    mask = labels[:, 1:] != -100
+    student_top = student_logits[:, :-1].float().gather(-1, teacher_indices[:, :-1])
+    student_log_probs = F.log_softmax(student_top / temperature, dim=-1)
+    teacher_log_probs = F.log_softmax(teacher_values[:, :-1] / temperature, dim=-1)
+    kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).sum(-1)
+    return (kl * mask).sum() / mask.sum().clamp(min=1) * temperature ** 2
+
+class DistillationMixin:
+    """loss = kd_alpha * KL กับ logits ครู + (1 - kd_alpha) * cross entropy กับคำตอบจริง"""
+
+    def __init__(self, *args, kd_alpha=0.5, kd_temperature=2.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kd_alpha = kd_alpha
+        self.kd_temperature = kd_temperature
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        teacher_values = inputs.pop("teacher_values")
+        teacher_indices = inputs.pop("teacher_indices")
+        outputs = model(**inputs)
+        kd_loss = distillation_loss(outputs.logits, teacher_values, teacher_indices, inputs["labels"],
+                                    self.kd_temperature)
+        loss = self.kd_alpha * kd_loss + (1 - self.kd_alpha) * outputs.loss
+        return (loss, outputs) if return_outputs else loss
+
+class DistillationTrainer(DistillationMixin, Trainer):
+    pass
+
+class AsyncDistillationTrainer(DistillationMixin, AsyncCheckpointTrainer):
+    pass
+
+def select_student_layers(config, num_layers):
+    """
+    เลือกชั้นของครูที่จะคัดลอกให้นักเรียน num_layers ชั้น กระจายเท่า ๆ กันตลอดความลึก (รวมชั้นแรกและชั้นสุดท้าย)
+
+    Gemma 3 ใน transformers รุ่นที่ล็อกไว้ไม่มี layer_types ชนิดของชั้น (sliding window หรือ global)
+    และ RoPE base ตัดสินจาก (ลำดับชั้น + 1) % sliding_window_pattern ของนักเรียนเอง
+    จึงเลือกชั้นของครูที่ชนิดตรงกับตำแหน่งในนักเรียน และใกล้ตำแหน่งที่กระจายเท่า ๆ กันที่สุด (รวมระยะห่างน้อยที่สุด)
+    ถ้า config มี layer_types จะใช้ตำแหน่งที่กระจายเท่า ๆ กันตรง ๆ แล้วคัดลอกชนิดของชั้นตามไป
+    """
+    teacher_layers = config.num_hidden_layers
+    if num_layers > teacher_layers:
+        raise ValueError(f"นักเรียน {num_layers} ชั้นมากกว่าครู ({teacher_layers} ชั้น)")
+    targets = np.linspace(0, teacher_layers - 1, num_layers)
+    pattern = getattr(config, 'sliding_window_pattern', None)
+    if getattr(config, 'layer_types', None) or not pattern:
+        return targets.round().astype(int).tolist()
+
+    def is_sliding(index):
+        return bool((index + 1) % pattern)
+
+    # best[i] = (ระยะรวม, ชั้นของครูสำหรับนักเรียนชั้นก่อนหน้า) เมื่อนักเรียนชั้นปัจจุบันใช้ชั้น i ของครู
+    # ครูมีลำดับชนิดแบบเดียวกัน การใช้ชั้นที่ตรงกันของครู (0, 1, 2, ...) จึงเป็นคำตอบที่ทำได้เสมอ
+    best = {i: (abs(i - targets[0]), None) for i in range(teacher_layers) if is_sliding(i) == is_sliding(0)}
+    history = []
+    for j in range(1, num_layers):
+        current = {}
+        for i in range(teacher_layers):
+            if is_sliding(i) != is_sliding(j):
+                continue
+            options = [(cost + abs(i - targets[j]), p) for p, (cost, _) in best.items() if p < i]
+            if options:
+                current[i] = min(options)
+        history.append(current)
+        best = current
+    index = min(best, key=lambda i: best[i][0])
+    keep = [index]
+    for step in reversed(history):
+        index = step[index][1]
+        keep.append(index)
+    return keep[::-1]
+
+def build_student(teacher, num_layers):
+    """
+    สร้างนักเรียนจาก config ของครูที่เหลือ num_layers ชั้น แล้วคัดลอก weight จากครู
+
+    ใช้ embedding, norm สุดท้าย และ decoder layer ที่เลือกด้วย select_student_layers
+    เป็นค่าเริ่มต้น นักเรียนจึงเริ่มจากจุดที่ใกล้ครูกว่าการสุ่มมาก และใช้ tokenizer เดียวกับครู
+    """
+    config = teacher.config.to_dict()
+    teacher_layers = config['num_hidden_layers']
+    config['num_hidden_layers'] = num_layers
+    keep = select_student_layers(teacher.config, num_layers)
+    if config.get('layer_types'):
+        config['layer_types'] = [config['layer_types'][i] for i in keep]
+    config = type(teacher.config).from_dict(config)
+    student = AutoModelForCausalLM.from_config(config, torch_dtype=teacher.dtype)
+    shared = {k: v for k, v in teacher.state_dict().items() if '.layers.' not in k}
+    student.load_state_dict(shared, strict=False)
+    for student_layer, teacher_index in zip(student.get_decoder().layers, keep):
+        student_layer.load_state_dict(teacher.get_decoder().layers[teacher_index].state_dict())
+    # embedding กับ lm_head ของ Gemma ใช้ weight ร่วมกัน ต้องผูกใหม่หลัง load_state_dict
+    student.tie_weights()
+    print(f"นักเรียน: {num_layers} จาก {teacher_layers} ชั้น (ชั้นของครู {keep}), "
+          f"{student.num_parameters():,} พารามิเตอร์ (ครู {teacher.num_parameters():,})")
+    return student
+
+def measure_latency(model_path, prompts, max_new_tokens=64):
+    """เวลาตอบทีละคำขอ (batch 1, greedy) แบบเดียวกับ server หลัง warmup คืน dict ของ p50/p95 และ token/วินาที"""
+    from gracer_ai_quantize import load_model
+    model = load_model(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    warmup(model, tokenizer)
+    latencies = []
+    generated = 0
+    with torch.inference_mode():
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
+            start = time.perf_counter()
+            output = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id)
+            latencies.append(time.perf_counter() - start)
+            generated += output.shape[1] - inputs['input_ids'].shape[1]
+    return {
+        'parameters': model.num_parameters(),
+        'latency_p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'latency_p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'tokens_per_second': round(generated / sum(latencies), 1),
+    }
+
+def compare_models(teacher_path, student_path, args):
+    """ประเมินครูและนักเรียนบนชุด held-out เดียวกัน (gracer_ai_eval.py) และวัดเวลาตอบทีละคำขอ"""
+    from gracer_ai_eval import evaluate, load_eval_examples
+    report = {'teacher': teacher_path, 'student': student_path, 'models': {}}
+    prompts = [e['prompt'] for e in load_eval_examples(args.report_lessons, holdout_fraction=args.holdout_fraction,
+                                                       max_per_task=args.report_max_per_task,
+                                                       template=args.template)][:args.latency_prompts]
+    for role, path in (('teacher', teacher_path), ('student', student_path)):
+        print(f"\nประเมิน{'ครู' if role == 'teacher' else 'นักเรียน'}: {path}")
+        results = evaluate(path, args.report_lessons, holdout_fraction=args.holdout_fraction,
+                           max_per_task=args.report_max_per_task, template=args.template,
+                           max_new_tokens=args.report_max_new_tokens, generate=args.report_generate)
+        if results is None:
+            return None
+        results['latency'] = measure_latency(path, prompts, args.report_max_new_tokens)
+        report['models'][role] = results
+    print_comparison(report)
+    return report
+
+def print_comparison(report):
+    teacher, student = report['models']['teacher'], report['models']['student']
+    print(f"\nครู {report['teacher']} เทียบนักเรียน {report['student']}")
+    print(f"{'':28s} {'ครู':>12s} {'นักเรียน':>12s}")
+    rows = [
+        ('พารามิเตอร์', teacher['latency']['parameters'], student['latency']['parameters'], '{:,}'),
+        ('latency p50 (ms)', teacher['latency']['latency_p50_ms'], student['latency']['latency_p50_ms'], '{:.1f}'),
+        ('latency p95 (ms)', teacher['latency']['latency_p95_ms'], student['latency']['latency_p95_ms'], '{:.1f}'),
+        ('token/วินาที (batch 1)', teacher['latency']['tokens_per_second'],
+         student['latency']['tokens_per_second'], '{:.1f}'),
+    ]
+    for task, metrics in teacher['tasks'].items():
+        student_metrics = student['tasks'].get(task, {})
+        for metric in ('perplexity', 'token_f1', 'rouge_l'):
+            if metrics.get(metric) is not None:
+                rows.append((f"{task} {metric}", metrics[metric], student_metrics.get(metric), '{:.3f}'))
+    for name, teacher_value, student_value, fmt in rows:
+        student_text = fmt.format(student_value) if student_value is not None else '-'
+        print(f"{name:28s} {fmt.format(teacher_value):>12s} {student_text:>12s}")
+    speedup = teacher['latency']['latency_p50_ms'] / student['latency']['latency_p50_ms']
+    print(f"นักเรียนตอบเร็วกว่าครู {speedup:.2f} เท่า (p50 batch 1)")
+
+def build_distill_arg_parser():
+    """argument ของ gracer_ai_trainer.py (ข้อมูล, batch, optimizer, CPU) พร้อมตัวเลือกของการกลั่นความรู้"""
+    parser = build_arg_parser()
+    parser.description = 'กลั่นความรู้ (knowledge distillation) จากโมเดล gracer-ai ลงโมเดลนักเรียนที่เล็กกว่า'
+    parser.set_defaults(model_name='gracer-ai-student', learning_rate=1e-4)
+    parser.add_argument('--teacher', type=str, default='./models/gracer-ai',
+                        help='โมเดลครูที่ฝึกแล้ว (ใช้ tokenizer ของครู --base-model จึงไม่ถูกใช้)')
+    parser.add_argument('--student-model', type=str, default=None,
+                        help='โมเดลนักเรียนที่มีอยู่แล้ว (ต้องใช้ vocab เดียวกับครู) ถ้าไม่ระบุจะสร้างจากชั้นของครู')
+    parser.add_argument('--student-layers', type=int, default=None,
+                        help='จำนวน decoder layer ของนักเรียนที่สร้างจากครู (ค่าเริ่มต้น 1/4 ของครู)')
+    parser.add_argument('--kd-alpha', type=float, default=0.5,
+                        help='น้ำหนักของ KL กับครู (ที่เหลือเป็น cross entropy กับคำตอบจริง)')
+    parser.add_argument('--kd-temperature', type=float, default=2.0, help='temperature ของ softmax ตอนเทียบกับครู')
+    parser.add_argument('--kd-top-k', type=int, default=32, help='จำนวน logits สูงสุดของครูที่เก็บต่อ token')
+    parser.add_argument('--teacher-cache-dir', type=str, default='cache/teacher',
+                        help='โฟลเดอร์เก็บ logits ของครู (รันครูครั้งเดียวต่อข้อมูลและโมเดลครูชุดเดียวกัน)')
+    parser.add_argument('--teacher-batch-size', type=int, default=4, help='จำนวนตัวอย่างต่อ batch ตอนรันครู')
+    parser.add_argument('--report', action=argparse.BooleanOptionalAction, default=True,
+                        help='ประเมินครูและนักเรียนบนชุด held-out เดียวกันหลังฝึก')
+    parser.add_argument('--report-lessons', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียนสำหรับชุด held-out ของ gracer_ai_eval.py')
+    parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                        help='สัดส่วนบทเรียน held-out (ต้องตรงกับที่ใช้ตอน convert_to_autotrain.py)')
+    parser.add_argument('--report-max-per-task', type=int, default=20, help='จำนวนตัวอย่างประเมินสูงสุดต่อ task')
+    parser.add_argument('--report-max-new-tokens', type=int, default=64, help='จำนวน token สูงสุดที่สร้างต่อคำตอบ')
+    parser.add_argument('--report-generate', action=argparse.BooleanOptionalAction, default=True,
+                        help='สร้างคำตอบเพื่อวัด token F1 และ ROUGE-L (ปิดเพื่อวัดเฉพาะ perplexity)')
+    parser.add_argument('--latency-prompts', type=int, default=8, help='จำนวน prompt ที่ใช้วัดเวลาตอบทีละคำขอ')
+    return parser
+
+def main(argv=None):
+    args = build_distill_arg_parser().parse_args(argv)
+    profiler = profiler_from_args(args)
+    unsupported = [flag for flag, enabled in (('--lora', args.lora), ('--packing', args.packing),
+                                              ('--streaming', args.streaming), ('--sweep-dir', args.sweep_dir),
+                                              ('--nproc-per-node/--nnodes', args.nproc_per_node > 1 or args.nnodes > 1))
+                   if enabled]
+    if unsupported:
+        print(f"โหมดกลั่นความรู้ยังไม่รองรับ {', '.join(unsupported)}")
+        return
+    if args.padding != 'dynamic':
+        print("โหมดกลั่นความรู้ใช้ --padding dynamic เพื่อให้ logits ของครูตรงกับ token จริง")
+        args.padding = 'dynamic'
+    if not os.path.isdir(args.teacher):
+        print(f"ไม่พบโมเดลครู {args.teacher} ฝึกด้วย gracer_ai_trainer.py ก่อน")
+        return
+    # ข้อมูลถูก tokenize ด้วย tokenizer ของครู cache ของข้อมูลจึงแยกตามครู
+    args.base_model = os.path.abspath(args.teacher)
+    args.revision = None
+
+    bf16 = cpu_supports_bf16() if args.bf16 is None else args.bf16
+    teacher_future = load_in_background(load_causal_lm, args.teacher)
+    with profiler.stage("tokenizer load"):
+        tokenizer = AutoTokenizer.from_pretrained(args.teacher)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    tokenizer.padding_side = 'right'
+
+    tokenized_dataset = load_or_build_tokenized_dataset(args, tokenizer, profiler)
+    if tokenized_dataset is None:
+        return
+    tokenized_dataset = tokenized_dataset.add_column("example_index", list(range(len(tokenized_dataset))))
+
+    digest, key = teacher_cache_key(args, tokenizer, args.teacher)
+    cache_path = os.path.join(args.teacher_cache_dir, digest)
+    with profiler.stage("model load"):
+        teacher = teacher_future.result()
+    configure_cpu(args)
+    if os.path.isdir(cache_path):
+        print(f"ใช้ logits ของครูจาก cache: {cache_path}")
+    else:
+        print(f"กำลังรันครูผ่านข้อมูล {len(tokenized_dataset)} ตัวอย่าง (top-{args.kd_top_k} logits ต่อ token)...")
+        with profiler.stage("teacher"):
+            build_teacher_cache(teacher, tokenized_dataset, cache_path, args.kd_top_k, args.teacher_batch_size,
+                                tokenizer.pad_token_id)
+            with open(os.path.join(cache_path, "cache_key.json"), 'w', encoding='utf-8') as f:
+                json.dump(key, f, ensure_ascii=False, indent=2)
+        print(f"บันทึก logits ของครูลง cache: {cache_path}")
+
+    with profiler.stage("student init"):
+        if args.student_model:
+            student = load_causal_lm(args.student_model)
+            if student.config.vocab_size != teacher.config.vocab_size:
+                print(f"vocab ของนักเรียน ({student.config.vocab_size}) ไม่ตรงกับครู ({teacher.config.vocab_size})")
+                return
+        else:
+            num_layers = args.student_layers or max(1, teacher.config.num_hidden_layers // 4)
+            student = build_student(teacher, num_layers)
+    # ไม่ต้องใช้ครูระหว่างฝึกแล้ว คืนหน่วยความจำให้นักเรียนและ optimizer
+    del teacher
+    gc.collect()
+    student.train()
+
+    eval_dataset = None
+    if args.eval_fraction > 0:
+        order = np.random.default_rng(args.seed).permutation(len(tokenized_dataset))
+        num_eval = max(1, int(len(order) * args.eval_fraction))
+        eval_dataset = tokenized_dataset.select(sorted(order[:num_eval]), keep_in_memory=True)
+        tokenized_dataset = tokenized_dataset.select(sorted(order[num_eval:]), keep_in_memory=True)
+
+    data_collator = PaddingStatsCollator(TeacherLogitsCollator(
+        DataCollatorForSeq2Seq(tokenizer, padding=True, label_pad_token_id=-100), cache_path, tokenizer.padding_side))
+    output_dir = f"./models/{args.model_name}"
+    training_args = TrainingArguments(
+        output_dir=output_dir,
+        num_train_epochs=args.num_epochs,
+        max_steps=args.max_steps,
+        per_device_train_batch_size=args.batch_size,
+        per_device_eval_batch_size=args.batch_size,
+        eval_strategy="steps" if eval_dataset is not None else "no",
+        eval_steps=args.eval_steps,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        group_by_length=args.group_by_length,
+        dataloader_num_workers=args.dataloader_workers,
+        dataloader_prefetch_factor=args.prefetch_factor if args.dataloader_workers > 0 else None,
+        save_steps=args.save_steps,
+        save_total_limit=2,
+        logging_dir=f"./logs/{args.model_name}",
+        logging_steps=100,
+        learning_rate=args.learning_rate,
+        warmup_steps=args.warmup_steps,
+        weight_decay=args.weight_decay,
+        seed=args.seed,
+        bf16=bf16,
+        torch_compile=args.torch_compile,
+        use_cpu=True,
+        # example_index และ length ต้องส่งถึง collator ซึ่งจะตัดออกก่อนเข้าโมเดล
+        remove_unused_columns=False,
+        prediction_loss_only=True,
+    )
+    callbacks = [TelemetryCallback(data_collator, training_args.logging_dir)] if args.telemetry else []
+    trainer_cls = AsyncDistillationTrainer if args.async_checkpoint else DistillationTrainer
+    extra = {'max_shard_size': args.checkpoint_shard_size} if args.async_checkpoint else {}
+    trainer = trainer_cls(model=student, args=training_args, train_dataset=tokenized_dataset,
+                          eval_dataset=eval_dataset, data_collator=data_collator, callbacks=callbacks,
+                          kd_alpha=args.kd_alpha, kd_temperature=args.kd_temperature, **extra)
+
+    resume_from_checkpoint = args.resume
+    if resume_from_checkpoint == 'latest':
+        resume_from_checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+    print("เริ่มกลั่นความรู้...")
+    with profiler.stage("train"):
+        trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    if eval_dataset is not None and trainer.state.global_step % args.eval_steps:
+        print(f"eval loss หลังฝึก: {trainer.evaluate()['eval_loss']:.4f}")
+
+    if not args.save_model:
+        print("การกลั่นความรู้เสร็จสิ้น (ไม่บันทึกโมเดลตาม --no-save-model)")
+        profiler.report()
+        return
+    with profiler.stage("write"):
+        student.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+    print(f"บันทึกโมเดลนักเรียนที่ {output_dir}")
+
+    if args.report:
+        with profiler.stage("report"):
+            report = compare_models(args.teacher, output_dir, args)
+        if report is not None:
+            report_path = os.path.join(output_dir, "distill_report.json")
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"บันทึกผลเปรียบเทียบที่ {report_path}")
+    profiler.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import json
+import math
+import os
+import time
+from collections import Counter, defaultdict
+import torch
+from transformers import AutoTokenizer
+from gracer_ai_quantize import load_model
+from model_loader import load_in_background
+from convert_to_autotrain import HOLDOUT_FRACTION, PromptExporter, is_held_out, iter_lessons
+from prompt_templates import build_templates
+
+EVAL_TASKS = ('qa', 'summarize', 'create_lesson_plan')
+
+def load_eval_examples(lessons_path, tasks=EVAL_TASKS, holdout_fraction=HOLDOUT_FRACTION, max_per_task=50, template='alpaca'):
+    """
+    สร้างชุดประเมินจากบทเรียนที่อยู่ในชุด held-out (ดู convert_to_autotrain.is_held_out)
+
+    คืน list ของ dict {task, prompt, response} ไม่เกิน max_per_task รายการต่อ task
+    """
+    exporter = PromptExporter([], tasks)
+    prompt_template = build_templates([template])[template]
+    examples = []
+    counts = Counter()
+    for lesson in iter_lessons(lessons_path):
+        if not is_held_out(lesson, holdout_fraction):
+            continue
+        for task, instruction, response in exporter.lesson_task_pairs(lesson):
+            if max_per_task and counts[task] >= max_per_task:
+                continue
+            counts[task] += 1
+            examples.append({'task': task, 'prompt': prompt_template.render_prompt(instruction), 'response': response})
+        if max_per_task and all(counts[task] >= max_per_task for task in tasks):
+            break
+    return examples
+
+def _length_sorted_batches(lengths, batch_size):
+    """แบ่ง index เป็น batch โดยเรียงตามความยาว เพื่อให้ dynamic padding เติมน้อยที่สุด"""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def _answer_nll(model, hidden, target, chunk_size=128):
+    """
+    NLL ของแต่ละ token เป้าหมายจาก hidden state ทีละช่วงตำแหน่ง
+
+    logits เต็ม vocab (262k ของ Gemma 3) ของทั้ง batch ใหญ่หลาย GB จึงคำนวณ lm_head เฉพาะตำแหน่งที่มี label
+    ทีละ chunk_size ตำแหน่งเหมือน _top_k_logits ของ gracer_ai_distill
+    """
+    lm_head = model.get_output_embeddings()
+    softcap = getattr(model.config, 'final_logit_softcapping', None)
+    nll = []
+    for start in range(0, hidden.shape[0], chunk_size):
+        logits = lm_head(hidden[start:start + chunk_size]).float()
+        if softcap:
+            logits = torch.tanh(logits / softcap) * softcap
+        nll.append(torch.nn.functional.cross_entropy(logits, target[start:start + chunk_size], reduction='none'))
+    return torch.cat(nll) if nll else torch.zeros(0)
+
+@torch.inference_mode()
+def batched_perplexity(model, tokenizer, examples, batch_size=8, max_length=512):
+    """
+    คำนวณ perplexity ของคำตอบ (ไม่นับ token ของ prompt) ทีละ batch แบบ dynamic padding
+
+    คืน (dict task -> {'nll', 'tokens'}, จำนวน token ที่ประมวลผลรวม padding)
+    """
+    encoded = []
+    for example in examples:
+        prompt_len = len(tokenizer(example['prompt'])['input_ids'])
+        input_ids = tokenizer(example['prompt'] + example['response'])['input_ids'][:max_length]
+        labels = [-100] * min(prompt_len, len(input_ids)) + input_ids[prompt_len:]
+        encoded.append((input_ids, labels))
+
+    decoder = model.get_decoder()
+    totals = defaultdict(lambda: {'nll': 0.0, 'tokens': 0})
+    processed_tokens = 0
+    for batch_indices in _length_sorted_batches([len(ids) for ids, _ in encoded], batch_size):
+        width = max(len(encoded[i][0]) for i in batch_indices)
+        input_ids = torch.full((len(batch_indices), width), tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(batch_indices), width), -100, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_indices), width), dtype=torch.long)
+        for row, i in enumerate(batch_indices):
+            ids, example_labels = encoded[i]
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            labels[row, :len(ids)] = torch.tensor(example_labels)
+            attention_mask[row, :len(ids)] = 1
+        processed_tokens += input_ids.numel()
+
+        hidden = decoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, :-1]
+        target = labels[:, 1:]
+        nll = torch.zeros(target.shape)
+        nll[target != -100] = _answer_nll(model, hidden[target != -100], target[target != -100])
+        for row, i in enumerate(batch_indices):
+            task = examples[i]['task']
+            totals[task]['nll'] += nll[row].sum().item()
+            totals[task]['tokens'] += int((target[row] != -100).sum())
+    return dict(totals), processed_tokens
+
+@torch.inference_mode()
+def batched_generate(model, tokenizer, prompts, batch_size=8, max_new_tokens=128, max_prompt_length=512):
+    """
+    สร้างคำตอบแบบ greedy ทีละ batch (pad ทางซ้าย) โดยใช้ KV cache ระหว่างการ decode
+
+    คืน (list ของ token id ที่สร้างตามลำดับ prompts, จำนวน token ที่สร้างรวม)
+    """
+    encoded = [tokenizer(prompt, truncation=True, max_length=max_prompt_length)['input_ids'] for prompt in prompts]
+    outputs = [None] * len(prompts)
+    generated_tokens = 0
+    for batch_indices in _length_sorted_batches([len(ids) for ids in encoded], batch_size):
+        # pad ทางซ้ายเพื่อให้ token ถัดไปของทุกแถวต่อจากตำแหน่งสุดท้ายเดียวกัน
+        width = max(len(encoded[i]) for i in batch_indices)
+        input_ids = torch.full((len(batch_indices), width), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_indices), width), dtype=torch.long)
+        for row, i in enumerate(batch_indices):
+            input_ids[row, width - len(encoded[i]):] = torch.tensor(encoded[i])
+            attention_mask[row, width - len(encoded[i]):] = 1
+        sequences = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        new_tokens = sequences[:, width:].tolist()
+        for i, tokens in zip(batch_indices, new_tokens):
+            if tokenizer.eos_token_id in tokens:
+                tokens = tokens[:tokens.index(tokenizer.eos_token_id)]
+            outputs[i] = tokens
+            generated_tokens += len(tokens)
+    return outputs, generated_tokens
+
+def token_f1(prediction, reference):
+    """F1 ของ token ที่ตรงกัน (นับซ้ำได้) ใช้ token ของ tokenizer จึงใช้กับภาษาไทยที่ไม่เว้นวรรคได้"""
+    common = sum((Counter(prediction) & Counter(reference)).values())
+    if common == 0:
+        return 0.0
+    precision = common / len(prediction)
+    recall = common / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+def rouge_l(prediction, reference):
+    """ROUGE-L F1 จาก longest common subsequence ของ token"""
+    if not prediction or not reference:
+        return 0.0
+    previous = [0] * (len(reference) + 1)
+    for token in prediction:
+        current = [0]
+        for j, ref_token in enumerate(reference):
+            current.append(previous[j] + 1 if token == ref_token else max(previous[j + 1], current[j]))
+        previous = current
+    lcs = previous[-1]
+    if lcs == 0:
+        return 0.0
+    precision = lcs / len(prediction)
+    recall = lcs / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+def evaluate(model_path, lessons_path, tasks=EVAL_TASKS, holdout_fraction=HOLDOUT_FRACTION, max_per_task=50,
+             batch_size=8, max_length=512, max_new_tokens=128, template='alpaca', generate=True):
+    """ประเมินโมเดลด้วย perplexity และคุณภาพคำตอบบนชุด held-out พร้อมวัดความเร็ว"""
+    # โหลดโมเดลในเบื้องหลังระหว่างเตรียมชุดประเมิน
+    model_future = load_in_background(load_model, model_path)
+    examples = load_eval_examples(lessons_path, tasks, holdout_fraction, max_per_task, template)
+    if not examples:
+        print("ไม่มีตัวอย่างในชุด held-out ลองเพิ่ม --holdout-fraction")
+        return None
+    print(f"ชุดประเมิน: {len(examples)} ตัวอย่าง ({dict(Counter(e['task'] for e in examples))})")
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = model_future.result()
+
+    results = {'model': model_path, 'examples': len(examples), 'tasks': {}}
+    start = time.perf_counter()
+    totals, processed_tokens = batched_perplexity(model, tokenizer, examples, batch_size, max_length)
+    elapsed = time.perf_counter() - start
+    results['perplexity_seconds'] = round(elapsed, 2)
+    results['perplexity_tokens_per_second'] = round(processed_tokens / elapsed, 1)
+    for task, total in totals.items():
+        results['tasks'][task] = {
+            'examples': sum(1 for e in examples if e['task'] == task),
+            'perplexity': round(math.exp(total['nll'] / total['tokens']), 3) if total['tokens'] else None,
+        }
+
+    if generate:
+        start = time.perf_counter()
+        outputs, generated_tokens = batched_generate(
+            model, tokenizer, [e['prompt'] for e in examples], batch_size, max_new_tokens, max_length
+        )
+        elapsed = time.perf_counter() - start
+        results['generation_seconds'] = round(elapsed, 2)
+        results['generation_tokens_per_second'] = round(generated_tokens / elapsed, 1)
+        results['generation_examples_per_second'] = round(len(examples) / elapsed, 2)
+
+        scores = defaultdict(lambda: defaultdict(list))
+        for example, tokens in zip(examples, outputs):
+            reference = tokenizer(example['response'], add_special_tokens=False)['input_ids']
+            prediction_text = tokenizer.decode(tokens, skip_special_tokens=True).strip()
+            task_scores = scores[example['task']]
+            task_scores['token_f1'].append(token_f1(tokens, reference))
+            task_scores['rouge_l'].append(rouge_l(tokens, reference))
+            task_scores['exact_match'].append(float(prediction_text == example['response'].strip()))
+        for task, task_scores in scores.items():
+            for metric, values in task_scores.items():
+                results['tasks'][task][metric] = round(sum(values) / len(values), 4)
+
+    print_results(results)
+    return results
+
+def print_results(results):
+    print(f"\nผลการประเมิน {results['model']}")
+    print(f"{'task':20s} {'n':>5s} {'ppl':>10s} {'token F1':>9s} {'ROUGE-L':>8s} {'EM':>6s}")
+    for task, metrics in results['tasks'].items():
+        ppl = f"{metrics['perplexity']:.2f}" if metrics.get('perplexity') is not None else '-'
+        row = f"{task:20s} {metrics['examples']:5d} {ppl:>10s}"
+        if 'token_f1' in metrics:
+            row += f" {metrics['token_f1']:9.3f} {metrics['rouge_l']:8.3f} {metrics['exact_match']:6.2f}"
+        print(row)
+    print(f"perplexity: {results['perplexity_tokens_per_second']:,.0f} token/วินาที "
+          f"({results['perplexity_seconds']:.1f} วินาที)")
+    if 'generation_seconds' in results:
+        print(f"generation: {results['generation_tokens_per_second']:,.0f} token ใหม่/วินาที, "
+              f"{results['generation_examples_per_second']:.2f} ตัวอย่าง/วินาที ({results['generation_seconds']:.1f} วินาที)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ประเมินโมเดล gracer-ai บนชุด held-out ของข้อมูล DLTV')
+    parser.add_argument('--model', type=str, default='./models/gracer-ai',
+                        help='โฟลเดอร์โมเดลหรือ checkpoint ที่จะประเมิน')
+    parser.add_argument('--lessons', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียน (.json หรือ .jsonl)')
+    parser.add_argument('--tasks', type=str, nargs='+', choices=list(EVAL_TASKS), default=list(EVAL_TASKS),
+                        help='task ที่จะประเมิน')
+    parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                        help='สัดส่วนบทเรียนที่กันไว้ประเมิน (ต้องตรงกับ --holdout-fraction ของ convert_to_autotrain.py)')
+    parser.add_argument('--max-per-task', type=int, default=50,
+                        help='จำนวนตัวอย่างสูงสุดต่อ task (0 = ทั้งหมด)')
+    parser.add_argument('--template', type=str, default='alpaca', choices=['alpaca', 'gemma'],
+                        help='แม่แบบ prompt ที่ใช้ตอนฝึก')
+    parser.add_argument('--batch-size', type=int, default=8, help='จำนวนตัวอย่างต่อ batch')
+    parser.add_argument('--max-length', type=int, default=512, help='ความยาวสูงสุดของ prompt + คำตอบ (token)')
+    parser.add_argument('--max-new-tokens', type=int, default=128, help='จำนวน token สูงสุดที่สร้างต่อคำตอบ')
+    parser.add_argument('--no-generate', action='store_true', help='วัดเฉพาะ perplexity ไม่สร้างคำตอบ')
+    parser.add_argument('--output', type=str, default=None,
+                        help='ไฟล์ JSON สำหรับบันทึกผล (ค่าเริ่มต้น <model>/eval_results.json)')
+    args = parser.parse_args()
+
+    results = evaluate(args.model, args.lessons, args.tasks, args.holdout_fraction, args.max_per_task,
+                       args.batch_size, args.max_length, args.max_new_tokens, args.template,
+                       generate=not args.no_generate)
+    if results is not None:
+        output_path = args.output or os.path.join(args.model, 'eval_results.json')
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"บันทึกผลที่ {output_path}")
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import torch
+from transformers import AutoTokenizer
+from model_loader import load_causal_lm, pinned_snapshot
+
+def merge_and_export(adapter_path, output_path, base_model=None, revision=None):
+    """
+    รวม LoRA adapter เข้ากับโมเดลตั้งต้นแล้วบันทึกเป็นโมเดลเต็มที่ใช้งานได้โดยไม่ต้องมี peft
+
+    ถ้าไม่ระบุ base_model จะใช้ค่าที่บันทึกไว้ใน adapter_config.json
+    """
+    try:
+        from peft import PeftModel
+    except ImportError:
+        raise ImportError("การรวม adapter ต้องติดตั้ง peft ก่อน (pip install 'dltv[lora]')")
+    
+    if base_model is None:
+        with open(os.path.join(adapter_path, "adapter_config.json"), 'r', encoding='utf-8') as f:
+            base_model = json.load(f)["base_model_name_or_path"]
+    
+    base_model = pinned_snapshot(base_model, revision)
+    print(f"กำลังโหลดโมเดลตั้งต้น {base_model}...")
+    model = load_causal_lm(base_model, torch.float32)
+    
+    print(f"กำลังรวม adapter จาก {adapter_path}...")
+    model = PeftModel.from_pretrained(model, adapter_path)
+    model = model.merge_and_unload()
+    
+    # ใช้ tokenizer ที่บันทึกไว้พร้อม adapter ถ้ามี
+    tokenizer_source = adapter_path if os.path.exists(os.path.join(adapter_path, "tokenizer_config.json")) else base_model
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_source)
+    
+    model.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+    print(f"บันทึกโมเดลที่รวม adapter แล้วที่ {output_path}")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='รวม LoRA adapter เข้ากับโมเดลตั้งต้นแล้วบันทึกเป็นโมเดลเต็ม')
+    parser.add_argument('--adapter', type=str, default='./models/gracer-ai-lora',
+                        help='โฟลเดอร์ของ LoRA adapter ที่ได้จาก gracer_ai_trainer.py --lora')
+    parser.add_argument('--output', type=str, default='./models/gracer-ai',
+                        help='โฟลเดอร์ที่จะบันทึกโมเดลเต็ม')
+    parser.add_argument('--base-model', type=str, default=None,
+                        help='โมเดลตั้งต้น (ค่าเริ่มต้นอ่านจาก adapter_config.json)')
+    parser.add_argument('--revision', type=str, default=None,
+                        help='revision ของโมเดลตั้งต้น')
+    args = parser.parse_args()
+
+    merge_and_export(args.adapter, args.output, args.base_model, args.revision)
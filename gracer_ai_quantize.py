@@ -0,0 +1,329 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import shutil
+import time
+import torch
+from torch import nn
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+from convert_to_autotrain import HOLDOUT_FRACTION
+from model_loader import load_causal_lm
+from training_telemetry import current_rss_mb
+
+QUANTIZATION_CONFIG = "quantization.json"
+QUANTIZED_WEIGHTS = "quantized_model.pt"
+FORMATS = ('int8', 'int4')
+
+def _pack_int4(values):
+    """รวมค่า 0-15 สองค่าต่อหนึ่ง byte (คอลัมน์คู่อยู่ 4 bit ล่าง คอลัมน์คี่อยู่ 4 bit บน)"""
+    values = values.to(torch.uint8)
+    return values[:, ::2] | (values[:, 1::2] << 4)
+
+def _unpack_int4(packed):
+    low = packed & 0x0F
+    high = packed >> 4
+    return torch.stack([low, high], dim=-1).view(packed.shape[0], -1)
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    Linear ที่เก็บ weight เป็น int4 แบบแบ่งกลุ่ม (group-wise, มี scale และ zero ต่อกลุ่ม) ส่วน activation คงเดิม
+
+    weight เก็บเป็น nibble ในรูปแบบของเราเองเพื่อให้ไฟล์ไม่ขึ้นกับ CPU ที่ใช้
+    แล้วแปลงเป็นรูปแบบของ kernel int4 ของ torch (_weight_int4pack_mm_for_cpu) ครั้งแรกที่เรียก forward
+    """
+
+    def __init__(self, in_features, out_features, bias=True, group_size=128):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer('qweight', torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+        self.register_buffer('scales_and_zeros',
+                             torch.zeros(in_features // group_size, out_features, 2, dtype=torch.bfloat16))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+        self._kernel_weight = None
+
+    @staticmethod
+    def supports(linear, group_size):
+        # ข้อจำกัดของ kernel: จำนวน output ต้องหารด้วย 16 และ input ต้องแบ่งกลุ่มได้ลงตัว
+        return linear.out_features % 16 == 0 and linear.in_features % group_size == 0
+
+    @classmethod
+    def from_linear(cls, linear, group_size=128):
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, group_size)
+        weight = linear.weight.detach().float()
+        groups = weight.view(linear.out_features, -1, group_size)
+        minimum = groups.amin(dim=-1, keepdim=True)
+        maximum = groups.amax(dim=-1, keepdim=True)
+        scale = (maximum - minimum).clamp(min=1e-8) / 15
+        values = ((groups - minimum) / scale).round().clamp(0, 15).view(linear.out_features, -1)
+        # kernel ของ torch ถอดค่าเป็น (q - 8) * scale + zero
+        zero = minimum + 8 * scale
+        module.qweight.copy_(_pack_int4(values))
+        module.scales_and_zeros.copy_(torch.stack([scale.squeeze(-1).t(), zero.squeeze(-1).t()], dim=-1))
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    def forward(self, x):
+        if self._kernel_weight is None:
+            values = _unpack_int4(self.qweight).to(torch.int32)
+            self._kernel_weight = torch._convert_weight_to_int4pack_for_cpu(values, 1)
+        shape = x.shape
+        out = torch._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features).to(torch.bfloat16), self._kernel_weight,
+            self.group_size, self.scales_and_zeros,
+        ).to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias
+        return out.view(*shape[:-1], self.out_features)
+
+def quantize_linear(linear, method, group_size=128):
+    """คืน Linear ที่ quantize แล้ว (None ถ้าทำกับ layer นี้ไม่ได้)"""
+    if method == 'int8':
+        wrapper = nn.Sequential(copy.deepcopy(linear))
+        return torch.ao.quantization.quantize_dynamic(wrapper, {nn.Linear}, dtype=torch.qint8)[0]
+    if not Int4WeightOnlyLinear.supports(linear, group_size):
+        return None
+    return Int4WeightOnlyLinear.from_linear(linear, group_size)
+
+def collect_calibration_inputs(model, tokenizer, prompts, max_rows=512):
+    """
+    ส่ง prompt ผ่านโมเดลแล้วเก็บ input ของทุก nn.Linear (สุ่มไม่เกิน max_rows แถวต่อ layer)
+
+    ไม่รวม lm_head เพราะมักผูก weight กับ embedding และ generate ของบางโมเดลอ่าน lm_head.weight.dtype โดยตรง
+    """
+    inputs = {}
+    hooks = []
+    output_embeddings = model.get_output_embeddings()
+
+    def make_hook(name):
+        def hook(module, args):
+            rows = args[0].detach().reshape(-1, args[0].shape[-1])
+            previous = inputs.get(name)
+            rows = rows if previous is None else torch.cat([previous, rows])
+            if rows.shape[0] > max_rows:
+                rows = rows[torch.randperm(rows.shape[0])[:max_rows]]
+            inputs[name] = rows
+        return hook
+
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear) and module is not output_embeddings:
+            hooks.append(module.register_forward_pre_hook(make_hook(name)))
+    try:
+        with torch.inference_mode():
+            for prompt in prompts:
+                model(**tokenizer(prompt, return_tensors='pt', truncation=True, max_length=512))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return inputs
+
+def calibrate(model, calibration_inputs, method, max_error, group_size=128):
+    """
+    วัด error สัมพัทธ์ของผลลัพธ์แต่ละ Linear เมื่อ quantize ด้วย input จริงจาก prompt DLTV
+
+    คืน (dict ชื่อ layer -> error, list ของ layer ที่จะ quantize) layer ที่ error เกิน max_error คงเป็น fp32
+    """
+    errors = {}
+    selected = []
+    modules = dict(model.named_modules())
+    with torch.inference_mode():
+        for name, x in calibration_inputs.items():
+            quantized = quantize_linear(modules[name], method, group_size)
+            if quantized is None:
+                continue
+            reference = modules[name](x)
+            error = ((quantized(x) - reference).norm() / reference.norm().clamp(min=1e-8)).item()
+            errors[name] = round(error, 5)
+            if error <= max_error:
+                selected.append(name)
+    return errors, selected
+
+def apply_quantization(model, method, module_names, group_size=128):
+    """แทนที่ Linear ตามชื่อที่เลือกด้วยเวอร์ชันที่ quantize แล้ว (แก้ model โดยตรง)"""
+    if method == 'int8':
+        qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in module_names}
+        return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    for name in module_names:
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child_name, Int4WeightOnlyLinear.from_linear(getattr(parent, child_name), group_size))
+    return model
+
+def load_quantized_model(path):
+    """โหลดโมเดลที่บันทึกด้วย export_quantized (สร้างโครงจาก config แล้วใส่ weight ที่ quantize แล้ว)"""
+    with open(os.path.join(path, QUANTIZATION_CONFIG), 'r', encoding='utf-8') as f:
+        quant_config = json.load(f)
+    model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(path), torch_dtype=torch.float32)
+    apply_quantization(model, quant_config['method'], quant_config['modules'], quant_config.get('group_size', 128))
+    # state_dict มีเพียง tensor (รวม tensor แบบ qint8), dtype และ tuple จึงโหลดแบบ weights_only ได้
+    # ไม่ต้อง unpickle object ใด ๆ จากโฟลเดอร์โมเดล
+    state_dict = torch.load(os.path.join(path, QUANTIZED_WEIGHTS), weights_only=True, mmap=True)
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+def load_model(path):
+    """โหลดโมเดลสำหรับ inference ได้ทั้งแบบปกติและแบบที่ quantize แล้ว"""
+    if os.path.exists(os.path.join(path, QUANTIZATION_CONFIG)):
+        return load_quantized_model(path)
+    return load_causal_lm(path, torch.float32)
+
+def export_quantized(model_path, output_path, method, calibration_prompts, max_error, group_size=128):
+    """quantize โมเดลตามผลการ calibrate แล้วบันทึกพร้อม tokenizer และ config"""
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = load_causal_lm(model_path, torch.float32)
+
+    print(f"[{method}] calibrate ด้วย {len(calibration_prompts)} prompt...")
+    calibration_inputs = collect_calibration_inputs(model, tokenizer, calibration_prompts)
+    errors, selected = calibrate(model, calibration_inputs, method, max_error, group_size)
+    skipped = sorted(set(calibration_inputs) - set(selected))
+    print(f"[{method}] quantize {len(selected)} layer, คงเป็น fp32 {len(skipped)} layer "
+          f"(error เกิน {max_error} หรือขนาดไม่รองรับ)")
+
+    apply_quantization(model, method, selected, group_size)
+    os.makedirs(output_path, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(output_path, QUANTIZED_WEIGHTS))
+    model.config.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+    if os.path.exists(os.path.join(model_path, "generation_config.json")):
+        shutil.copy(os.path.join(model_path, "generation_config.json"), output_path)
+    with open(os.path.join(output_path, QUANTIZATION_CONFIG), 'w', encoding='utf-8') as f:
+        json.dump({'method': method, 'group_size': group_size, 'max_error': max_error,
+                   'modules': selected, 'skipped': skipped, 'calibration_errors': errors}, f, indent=2)
+    print(f"[{method}] บันทึกที่ {output_path}")
+    return output_path
+
+def _directory_size_mb(path):
+    weight_files = [name for name in os.listdir(path) if name.endswith(('.safetensors', '.pt', '.bin'))]
+    return sum(os.path.getsize(os.path.join(path, name)) for name in weight_files) / (1024 * 1024)
+
+def _benchmark_worker(model_path, examples, prompts, max_new_tokens, queue):
+    """รันใน process แยกเพื่อให้วัดหน่วยความจำของแต่ละรูปแบบได้โดยไม่ปนกัน"""
+    from gracer_ai_eval import batched_perplexity
+    import math
+
+    try:
+        baseline = current_rss_mb()
+        start = time.perf_counter()
+        model = load_model(model_path)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        load_seconds = time.perf_counter() - start
+        memory_mb = current_rss_mb() - baseline
+
+        def encode(prompt):
+            return tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
+
+        with torch.inference_mode():
+            # warmup (รวมการแปลง weight เป็นรูปแบบของ kernel)
+            model.generate(**encode(prompts[0]), max_new_tokens=2, do_sample=False,
+                           pad_token_id=tokenizer.pad_token_id)
+            generated = 0
+            start = time.perf_counter()
+            for prompt in prompts:
+                inputs = encode(prompt)
+                output = model.generate(**inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                        do_sample=False, pad_token_id=tokenizer.pad_token_id)
+                generated += output.shape[1] - inputs['input_ids'].shape[1]
+            generate_seconds = time.perf_counter() - start
+
+        totals, _ = batched_perplexity(model, tokenizer, examples)
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+        raise
+    nll = sum(total['nll'] for total in totals.values())
+    tokens = sum(total['tokens'] for total in totals.values())
+    queue.put({
+        'load_seconds': round(load_seconds, 2),
+        'memory_mb': round(memory_mb, 1),
+        'ms_per_token': round(generate_seconds / generated * 1000, 2),
+        'tokens_per_second': round(generated / generate_seconds, 1),
+        'perplexity': round(math.exp(nll / tokens), 3) if tokens else None,
+    })
+
+def _wait_for_result(process, queue):
+    """รอผลจาก worker ถ้า worker ตายก่อนส่งผล (เช่นถูก OOM killer ปิดตอนโหลดโมเดล) คืน error แทนการรอตลอดไป"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                # ผลอาจถูกส่งมาก่อน process จบพอดี
+                try:
+                    return queue.get(timeout=1)
+                except queue_module.Empty:
+                    return {'error': f"exit code {process.exitcode}"}
+
+def benchmark_formats(model_paths, examples, prompts, max_new_tokens=32):
+    """เทียบ latency, หน่วยความจำ, ขนาดไฟล์ และ perplexity ของแต่ละรูปแบบ (แต่ละรูปแบบใน process ใหม่)"""
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name, path in model_paths.items():
+        queue = context.Queue()
+        process = context.Process(target=_benchmark_worker, args=(path, examples, prompts, max_new_tokens, queue))
+        process.start()
+        result = _wait_for_result(process, queue)
+        process.join()
+        if 'error' in result:
+            print(f"[benchmark] {name}: ล้มเหลว ({result['error']})")
+            continue
+        result['file_mb'] = round(_directory_size_mb(path), 1)
+        results[name] = result
+        print(f"[benchmark] {name}: {result}")
+
+    base = results.get('fp32')
+    print(f"\n{'format':8s} {'file MB':>9s} {'RAM MB':>9s} {'ms/token':>9s} {'speedup':>8s} {'ppl':>10s}")
+    for name, result in results.items():
+        speedup = f"x{base['ms_per_token'] / result['ms_per_token']:.2f}" if base else '-'
+        print(f"{name:8s} {result['file_mb']:9.1f} {result['memory_mb']:9.1f} {result['ms_per_token']:9.2f} "
+              f"{speedup:>8s} {result['perplexity']:10.3f}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ส่งออกโมเดล gracer-ai แบบ int8 / int4 พร้อมเทียบกับ fp32')
+    parser.add_argument('--model', type=str, default='./models/gracer-ai', help='โฟลเดอร์โมเดล fp32')
+    parser.add_argument('--formats', type=str, nargs='+', choices=list(FORMATS), default=['int8'],
+                        help='int8 = dynamic quantization, int4 = weight-only แบบแบ่งกลุ่ม')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='โฟลเดอร์ที่จะบันทึก (ค่าเริ่มต้น <model>-int8, <model>-int4)')
+    parser.add_argument('--lessons', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียนสำหรับ prompt ที่ใช้ calibrate และ benchmark')
+    parser.add_argument('--calibration-samples', type=int, default=32, help='จำนวน prompt สำหรับ calibrate')
+    parser.add_argument('--max-layer-error', type=float, default=None,
+                        help='error สัมพัทธ์สูงสุดที่ยอมให้แต่ละ layer (ค่าเริ่มต้น int8 0.05, int4 0.15)')
+    parser.add_argument('--group-size', type=int, default=128, help='ขนาดกลุ่มของ int4')
+    parser.add_argument('--benchmark', action='store_true', help='เทียบ latency, หน่วยความจำ และ perplexity กับ fp32')
+    parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                        help='ชุด held-out สำหรับวัด perplexity (เหมือน gracer_ai_eval.py)')
+    parser.add_argument('--max-new-tokens', type=int, default=32, help='จำนวน token ที่สร้างตอนวัด latency')
+    args = parser.parse_args()
+
+    from gracer_ai_eval import load_eval_examples
+    model_path = args.model.rstrip('/')
+    calibration_prompts = [
+        example['prompt'] + example['response']
+        for example in load_eval_examples(args.lessons, holdout_fraction=1.0,
+                                          max_per_task=max(1, args.calibration_samples // 3))
+    ][:args.calibration_samples]
+
+    outputs = {'fp32': model_path}
+    for method in args.formats:
+        output_path = os.path.join(args.output_dir, f"{os.path.basename(model_path)}-{method}") \
+            if args.output_dir else f"{model_path}-{method}"
+        max_error = args.max_layer_error or {'int8': 0.05, 'int4': 0.15}[method]
+        outputs[method] = export_quantized(model_path, output_path, method, calibration_prompts, max_error,
+                                           args.group_size)
+
+    if args.benchmark:
+        examples = load_eval_examples(args.lessons, holdout_fraction=args.holdout_fraction, max_per_task=20)
+        prompts = [example['prompt'] for example in examples[:8]]
+        results = benchmark_formats(outputs, examples, prompts, args.max_new_tokens)
+        report_path = os.path.join(model_path, 'quantization_benchmark.json')
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"บันทึกผล benchmark ที่ {report_path}")
@@ -0,0 +1,545 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from transformers import AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from gracer_ai_quantize import load_model
+from model_loader import load_in_background, warmup
+from prompt_templates import SUMMARY_INSTRUCTION, build_templates
+from response_cache import PrefixKVCache, ResponseCache, model_version, normalize_prompt
+from training_telemetry import percentile
+
+class ServerMetrics:
+    """ตัวชี้วัดของ server: latency, time to first token และ token/วินาที (เก็บ window ล่าสุด)"""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.first_token_latencies = deque(maxlen=window)
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.generated_tokens = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.generate_seconds = 0.0
+        self.prefix_tokens_reused = 0
+
+    def record_request(self, latency, first_token_latency):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if first_token_latency is not None:
+                self.first_token_latencies.append(first_token_latency)
+
+    def record_batch(self, size, tokens, seconds, prefix_tokens_reused=0):
+        with self.lock:
+            self.prefix_tokens_reused += prefix_tokens_reused
+            self.batches += 1
+            self.batched_requests += size
+            self.generated_tokens += tokens
+            self.generate_seconds += seconds
+
+    def record_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.started
+            latencies = list(self.latencies)
+            first_token = list(self.first_token_latencies)
+            return {
+                'uptime_seconds': round(uptime, 1),
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                'latency_p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+                'first_token_p50_ms': round(percentile(first_token, 50) * 1000, 1) if first_token else None,
+                'first_token_p99_ms': round(percentile(first_token, 99) * 1000, 1) if first_token else None,
+                'generated_tokens': self.generated_tokens,
+                'tokens_per_second': round(self.generated_tokens / uptime, 1) if uptime else 0.0,
+                'generate_tokens_per_second': (
+                    round(self.generated_tokens / self.generate_seconds, 1) if self.generate_seconds else 0.0),
+                'batches': self.batches,
+                'average_batch_size': round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+                'prefix_tokens_reused': self.prefix_tokens_reused,
+            }
+
+class GenerationRequest:
+    """คำขอหนึ่งรายการ token ที่สร้างได้จะถูกส่งผ่าน queue ทีละตัว (None = จบ, Exception = ผิดพลาด)"""
+
+    def __init__(self, prompt, max_new_tokens):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.tokens = queue.Queue()
+        self.generated = 0
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+
+    def push(self, token):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.generated += 1
+        self.tokens.put(token)
+
+    def finish(self):
+        self.tokens.put(None)
+
+    def fail(self, exc):
+        self.tokens.put(exc)
+
+def eos_token_ids(model, tokenizer):
+    """
+    token ที่ทำให้ generate() หยุดแถว: EOS ของ tokenizer และทุกตัวใน generation_config.eos_token_id
+    (โมเดล Gemma 3 แบบ it มี <end_of_turn> อยู่ในนั้นด้วย)
+    """
+    ids = set()
+    config_ids = getattr(getattr(model, 'generation_config', None), 'eos_token_id', None)
+    for token_id in (config_ids if isinstance(config_ids, (list, tuple)) else [config_ids]):
+        if token_id is not None:
+            ids.add(token_id)
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    return frozenset(ids)
+
+class _BatchStreamer(BaseStreamer):
+    """
+    ส่ง token ที่ generate() สร้างในแต่ละ step ไปยังคำขอของแต่ละแถวใน batch
+
+    แถวที่เจอ token ใน eos_token_ids จบคำขอทันที token หลังจากนั้น (pad ที่ generate เติมจนทั้ง batch จบ)
+    ไม่ถูกส่งและไม่ถูกนับ
+    """
+
+    def __init__(self, requests, eos_token_ids):
+        self.requests = requests
+        self.eos_token_ids = eos_token_ids
+        self.done = [False] * len(requests)
+        self.tokens = 0
+
+    def put(self, value):
+        # ครั้งแรก generate() ส่ง prompt ทั้งก้อน (2 มิติ) มาก่อน
+        if value.dim() > 1:
+            return
+        for row, token in enumerate(value.tolist()):
+            if self.done[row]:
+                continue
+            request = self.requests[row]
+            if token in self.eos_token_ids:
+                self._finish(row)
+                continue
+            request.push(token)
+            self.tokens += 1
+            if request.generated >= request.max_new_tokens:
+                self._finish(row)
+
+    def _finish(self, row):
+        self.done[row] = True
+        self.requests[row].finish()
+
+    def end(self):
+        for row, done in enumerate(self.done):
+            if not done:
+                self._finish(row)
+
+class _PerRequestLimit(StoppingCriteria):
+    """หยุดแต่ละแถวเมื่อครบ max_new_tokens ของคำขอนั้น (แถวที่หยุดแล้วจะถูกเติม pad จนทั้ง batch จบ)"""
+
+    def __init__(self, limits, prompt_width):
+        self.limits = torch.tensor(limits)
+        self.prompt_width = prompt_width
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return (input_ids.shape[1] - self.prompt_width) >= self.limits
+
+class BatchScheduler:
+    """
+    รวมคำขอที่เข้ามาใกล้กันเป็น batch แล้ว generate ในเธรดเดียวที่เป็นเจ้าของโมเดล
+
+    รอคำขอแรก แล้วรับคำขอเพิ่มอีกไม่เกิน batch_window_ms หรือจนครบ max_batch_size
+    ก่อนรับคำขอแรกจะ warmup โมเดลหนึ่งครั้ง (คำขอที่เข้ามาระหว่างนั้นรอใน queue) และตั้ง ready เมื่อเสร็จ
+    ถ้ามี prefix_cache และทุกคำขอใน batch ขึ้นต้นด้วย prefix เดียวกัน จะใช้ KV ของ prefix ที่คำนวณไว้แทนการคำนวณใหม่
+    """
+
+    def __init__(self, model, tokenizer, metrics, max_batch_size=8, batch_window_ms=10, max_prompt_length=1024,
+                 prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.max_prompt_length = max_prompt_length
+        self.prefix_cache = prefix_cache
+        self.eos_token_ids = eos_token_ids(model, tokenizer)
+        self.ready = threading.Event()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        self.queue.put(request)
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            print(f"warmup โมเดลเสร็จใน {warmup(self.model, self.tokenizer):.2f} วินาที")
+        except Exception as e:
+            print(f"warmup ล้มเหลว: {e}")
+        self.ready.set()
+        while True:
+            batch = self._collect()
+            try:
+                self._generate(batch)
+            except Exception as e:
+                print(f"generate ล้มเหลว: {e}")
+                for request in batch:
+                    request.fail(e)
+
+    @torch.inference_mode()
+    def _generate(self, batch):
+        start = time.perf_counter()
+        encoded = [
+            self.tokenizer(request.prompt, truncation=True, max_length=self.max_prompt_length)['input_ids']
+            for request in batch
+        ]
+        limits = [request.max_new_tokens for request in batch]
+        reuse = self.prefix_cache.match(encoded, max(limits)) if self.prefix_cache is not None else None
+        prefix_length = reuse[0] if reuse else 0
+        cache_kwargs = {'past_key_values': reuse[1], 'cache_implementation': None} if reuse else {}
+
+        # prefix ที่ใช้ร่วมกันอยู่ต้นแถว ส่วนที่เหลือ pad ทางซ้ายเพื่อให้ทุกแถวสร้าง token ถัดไปที่ตำแหน่งเดียวกัน
+        # (position ของ token คำนวณจาก attention_mask จึงไม่นับ pad ที่อยู่ตรงกลาง)
+        width = max(len(ids) for ids in encoded) - prefix_length
+        total_width = prefix_length + width
+        input_ids = torch.full((len(batch), total_width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), total_width), dtype=torch.long)
+        for row, ids in enumerate(encoded):
+            input_ids[row, :prefix_length] = torch.tensor(ids[:prefix_length])
+            attention_mask[row, :prefix_length] = 1
+            input_ids[row, total_width - len(ids) + prefix_length:] = torch.tensor(ids[prefix_length:])
+            attention_mask[row, total_width - len(ids) + prefix_length:] = 1
+
+        streamer = _BatchStreamer(batch, self.eos_token_ids)
+        self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max(limits),
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList([_PerRequestLimit(limits, total_width)]),
+            **cache_kwargs,
+        )
+        self.metrics.record_batch(len(batch), streamer.tokens, time.perf_counter() - start,
+                                  prefix_length * len(batch))
+
+class InferenceService:
+    """
+    โหลดโมเดลครั้งเดียว รับคำขอผ่าน BatchScheduler และจำกัดจำนวนคำขอที่ทำพร้อมกัน
+
+    คำขอที่ prompt (หลัง normalize) เคยตอบแล้วกับโมเดลเวอร์ชันเดียวกันจะตอบจาก ResponseCache โดยไม่ generate
+    และ KV ของ preamble ของแม่แบบ (รวมต้นคำสั่งสรุปบทเรียน) ถูกคำนวณไว้ครั้งเดียวให้ทุก batch ใช้ร่วมกัน
+    """
+
+    def __init__(self, model_path, template='alpaca', max_concurrent=32, max_new_tokens=256,
+                 cache_entries=1024, cache_mb=64, cache_dir=None, prefix_cache=True, **scheduler_kwargs):
+        print(f"กำลังโหลดโมเดลจาก {model_path}...")
+        model_future = load_in_background(load_model, model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = model_future.result()
+        self.template = build_templates([template])[template]
+        self.max_new_tokens = max_new_tokens
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.metrics = ServerMetrics()
+        self.cache = None
+        if cache_entries > 0:
+            self.cache = ResponseCache(model_version(model_path), cache_entries, cache_mb, cache_dir)
+        if prefix_cache:
+            scheduler_kwargs['prefix_cache'] = PrefixKVCache(self.model, self.tokenizer, self.shared_prefixes())
+        self.scheduler = BatchScheduler(self.model, self.tokenizer, self.metrics, **scheduler_kwargs)
+
+    def shared_prefixes(self):
+        """ข้อความต้น prompt ที่คำขอส่วนใหญ่ใช้ร่วมกัน: preamble ของแม่แบบ และ preamble + ต้นคำสั่งสรุปบทเรียน"""
+        summary_head = SUMMARY_INSTRUCTION.split('{', 1)[0]
+        return [
+            os.path.commonprefix([self.template.render_prompt(f"{head}ก"), self.template.render_prompt(f"{head}ข")])
+            for head in ('', summary_head)
+        ]
+
+    def build_prompt(self, payload):
+        """ใช้ 'prompt' ตามที่ส่งมา หรือห่อ 'instruction' ด้วยแม่แบบเดียวกับตอนฝึก (normalize ก่อนทั้งสองแบบ)"""
+        if 'prompt' in payload:
+            return normalize_prompt(payload['prompt'])
+        return self.template.render_prompt(normalize_prompt(payload['instruction']).strip())
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        if self.cache is not None:
+            snapshot.update(self.cache.stats())
+        return snapshot
+
+    def iter_text(self, request):
+        """คืนข้อความที่สร้างเพิ่มทีละส่วนตามลำดับ token ที่ได้รับ"""
+        token_ids = []
+        sent = ''
+        while True:
+            item = request.tokens.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            token_ids.append(item)
+            text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            # token ที่ยังประกอบอักขระไม่ครบ (byte fallback) ให้รอ token ถัดไปก่อน
+            if text.endswith('�'):
+                continue
+            delta, sent = text[len(sent):], text
+            if delta:
+                yield delta
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _record(self, request):
+        latency = time.perf_counter() - request.submitted_at
+        first_token = request.first_token_at - request.submitted_at if request.first_token_at else None
+        self.server.service.metrics.record_request(latency, first_token)
+
+    def do_GET(self):
+        if self.path == '/health':
+            if self.server.service.scheduler.ready.is_set():
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(503, {'status': 'warming'})
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.service.metrics_snapshot())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._send_json(404, {'error': 'not found'})
+            return
+        service = self.server.service
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            prompt = service.build_prompt(payload)
+            max_new_tokens = min(int(payload.get('max_new_tokens', service.max_new_tokens)), service.max_new_tokens)
+            if max_new_tokens < 1:
+                raise ValueError("max_new_tokens ต้องมีค่าอย่างน้อย 1")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': f"คำขอไม่ถูกต้อง: {e}"})
+            return
+
+        received_at = time.perf_counter()
+        cache_key = service.cache.key(prompt, max_new_tokens) if service.cache is not None else None
+        cached = service.cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            latency = time.perf_counter() - received_at
+            service.metrics.record_request(latency, latency)
+            if payload.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                if cached['text']:
+                    self._send_chunk((json.dumps({'text': cached['text']}, ensure_ascii=False) + "\n").encode('utf-8'))
+                self._send_chunk((json.dumps({'done': True, 'tokens': cached['tokens'], 'cached': True})
+                                  + "\n").encode('utf-8'))
+                self._send_chunk(b"")
+            else:
+                self._send_json(200, {'text': cached['text'], 'tokens': cached['tokens'], 'cached': True})
+            return
+
+        if not service.slots.acquire(blocking=False):
+            service.metrics.record_rejected()
+            self._send_json(429, {'error': 'server มีคำขอเต็มจำนวนที่รับได้'})
+            return
+        streaming = False
+        try:
+            request = GenerationRequest(prompt, max_new_tokens)
+            service.scheduler.submit(request)
+            if payload.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                streaming = True
+                parts = []
+                for delta in service.iter_text(request):
+                    parts.append(delta)
+                    self._send_chunk((json.dumps({'text': delta}, ensure_ascii=False) + "\n").encode('utf-8'))
+                self._record(request)
+                text = ''.join(parts)
+                if cache_key is not None:
+                    service.cache.put(cache_key, text, request.generated)
+                self._send_chunk((json.dumps({'done': True, 'tokens': request.generated}) + "\n").encode('utf-8'))
+                self._send_chunk(b"")
+            else:
+                text = ''.join(service.iter_text(request))
+                self._record(request)
+                if cache_key is not None:
+                    service.cache.put(cache_key, text, request.generated)
+                self._send_json(200, {'text': text, 'tokens': request.generated})
+        except Exception as e:
+            service.metrics.record_error()
+            print(f"คำขอล้มเหลว: {e}")
+            # แจ้ง client เสมอ ไม่เช่นนั้น client จะรอจนหมดเวลาของตัวเอง
+            try:
+                if streaming:
+                    self._send_chunk((json.dumps({'error': f"สร้างคำตอบไม่สำเร็จ: {e}"}, ensure_ascii=False)
+                                      + "\n").encode('utf-8'))
+                    self._send_chunk(b"")
+                else:
+                    self._send_json(500, {'error': f"สร้างคำตอบไม่สำเร็จ: {e}"})
+            except OSError:
+                pass
+        finally:
+            service.slots.release()
+
+def serve(model_path, host='127.0.0.1', port=8000, **service_kwargs):
+    service = InferenceService(model_path, **service_kwargs)
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"server พร้อมที่ http://{host}:{port} (POST /generate, GET /metrics, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def _send_request(url, prompt, max_new_tokens, stream):
+    """ส่งคำขอหนึ่งรายการ คืน (status, latency, first token latency, จำนวน token)"""
+    body = json.dumps({'prompt': prompt, 'max_new_tokens': max_new_tokens, 'stream': stream}).encode('utf-8')
+    request = urllib.request.Request(f"{url}/generate", data=body, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    first_token = None
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            if stream:
+                tokens = 0
+                for line in response:
+                    message = json.loads(line)
+                    if first_token is None and 'text' in message:
+                        first_token = time.perf_counter() - start
+                    if message.get('done'):
+                        tokens = message['tokens']
+            else:
+                tokens = json.loads(response.read())['tokens']
+            return response.status, time.perf_counter() - start, first_token, tokens
+    except urllib.error.HTTPError as e:
+        return e.code, time.perf_counter() - start, None, 0
+
+def load_test(url, prompts, num_requests=64, concurrency=8, max_new_tokens=64, stream=True):
+    """ยิงคำขอพร้อมกัน concurrency รายการจนครบ num_requests แล้วสรุป latency และ throughput ฝั่ง client"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(
+            lambda i: _send_request(url, prompts[i % len(prompts)], max_new_tokens, stream), range(num_requests)
+        ))
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r[0] == 200]
+    latencies = [r[1] for r in ok]
+    first_tokens = [r[2] for r in ok if r[2] is not None]
+    tokens = sum(r[3] for r in ok)
+    print(f"\nload test: {num_requests} คำขอ, concurrency {concurrency}, {elapsed:.1f} วินาที")
+    print(f"  สำเร็จ {len(ok)}, ถูกปฏิเสธ (429) {sum(1 for r in results if r[0] == 429)}, "
+          f"ผิดพลาด {sum(1 for r in results if r[0] not in (200, 429))}")
+    if latencies:
+        print(f"  latency p50 {percentile(latencies, 50) * 1000:,.0f} ms, p99 {percentile(latencies, 99) * 1000:,.0f} ms")
+    if first_tokens:
+        print(f"  first token p50 {percentile(first_tokens, 50) * 1000:,.0f} ms, "
+              f"p99 {percentile(first_tokens, 99) * 1000:,.0f} ms")
+    print(f"  {tokens / elapsed:,.1f} token/วินาที, {len(ok) / elapsed:.2f} คำขอ/วินาที")
+    with urllib.request.urlopen(f"{url}/metrics") as response:
+        print(f"  server metrics: {json.loads(response.read())}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='HTTP inference server สำหรับโมเดล gracer-ai')
+    parser.add_argument('action', choices=['serve', 'load-test'], help='serve = เปิด server, load-test = ทดสอบโหลด')
+    parser.add_argument('--model', type=str, default='./models/gracer-ai', help='โฟลเดอร์โมเดล')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='ที่อยู่ที่ server รับคำขอ')
+    parser.add_argument('--port', type=int, default=8000, help='พอร์ตของ server')
+    parser.add_argument('--template', type=str, default='alpaca', choices=['alpaca', 'gemma'],
+                        help='แม่แบบสำหรับคำขอที่ส่ง instruction มา')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='จำนวนคำขอสูงสุดต่อ batch')
+    parser.add_argument('--batch-window-ms', type=float, default=10,
+                        help='เวลาที่รอรวมคำขอเข้า batch เดียวกัน (มิลลิวินาที)')
+    parser.add_argument('--max-concurrent', type=int, default=32,
+                        help='จำนวนคำขอที่รับพร้อมกันได้ เกินนี้ตอบ 429')
+    parser.add_argument('--max-new-tokens', type=int, default=256, help='จำนวน token สูงสุดต่อคำตอบ')
+    parser.add_argument('--max-prompt-length', type=int, default=1024, help='ความยาว prompt สูงสุด (token)')
+    parser.add_argument('--cache-entries', type=int, default=1024,
+                        help='จำนวนคำตอบสูงสุดใน cache หน่วยความจำ (0 = ปิด response cache)')
+    parser.add_argument('--cache-mb', type=float, default=64, help='ขนาดข้อความรวมสูงสุดใน cache หน่วยความจำ (MB)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='โฟลเดอร์ cache คำตอบบนดิสก์ (ไม่ระบุ = ไม่ใช้)')
+    parser.add_argument('--no-prefix-cache', action='store_true',
+                        help='ไม่ใช้ KV cache ของ preamble ที่คำขอใช้ร่วมกัน')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000', help='server ที่จะทดสอบโหลด')
+    parser.add_argument('--lessons', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียนสำหรับสร้าง prompt ที่ใช้ทดสอบโหลด')
+    parser.add_argument('--requests', type=int, default=64, help='จำนวนคำขอในการทดสอบโหลด')
+    parser.add_argument('--concurrency', type=int, default=8, help='จำนวนคำขอพร้อมกันในการทดสอบโหลด')
+    parser.add_argument('--no-stream', action='store_true', help='ทดสอบโหลดแบบไม่ stream')
+    args = parser.parse_args()
+
+    if args.action == 'serve':
+        serve(args.model, args.host, args.port, template=args.template, max_concurrent=args.max_concurrent,
+              max_new_tokens=args.max_new_tokens, max_batch_size=args.max_batch_size,
+              batch_window_ms=args.batch_window_ms, max_prompt_length=args.max_prompt_length,
+              cache_entries=args.cache_entries, cache_mb=args.cache_mb, cache_dir=args.cache_dir,
+              prefix_cache=not args.no_prefix_cache)
+    else:
+        from gracer_ai_eval import load_eval_examples
+        examples = load_eval_examples(args.lessons, holdout_fraction=1.0, max_per_task=args.requests,
+                                      template=args.template)
+        load_test(args.url, [example['prompt'] for example in examples], args.requests, args.concurrency,
+                  args.max_new_tokens, not args.no_stream)
@@ -0,0 +1,237 @@
+import argparse
+import itertools
+import math
+import os
+import queue
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoTokenizer
+from early_stopping import SWEEP_CONFIG, TRIALS_DIR, load_trials, trial_path, write_json_atomic
+from gracer_ai_trainer import build_arg_parser, load_or_build_tokenized_dataset
+from model_loader import pinned_snapshot
+from pipeline_profiler import profiler_from_args
+
+# hyperparameter ที่ค้นหาได้ -> ชนิดค่า (ชื่อ flag ของ gracer_ai_trainer.py คือ --ชื่อ-ที่-ใช้-ขีด)
+SEARCH_PARAMS = {
+    'learning_rate': float,
+    'warmup_steps': int,
+    'num_epochs': float,
+    'batch_size': int,
+    'gradient_accumulation_steps': int,
+    'weight_decay': float,
+    'lora_r': int,
+    'lora_alpha': int,
+    'lora_dropout': float,
+}
+DISTRIBUTIONS = ('uniform', 'loguniform', 'int')
+
+def parse_param(spec):
+    """
+    แปลง --param เป็น (ชื่อ, ช่วงค่า)
+
+    ชื่อ=v1,v2,...          ค่าที่ระบุ (grid ใช้ทุกค่า, random สุ่มเลือก)
+    ชื่อ=uniform:ต่ำ:สูง     สุ่มแบบสม่ำเสมอ (เฉพาะ random)
+    ชื่อ=loguniform:ต่ำ:สูง  สุ่มแบบสม่ำเสมอบนสเกล log เหมาะกับ learning rate (เฉพาะ random)
+    ชื่อ=int:ต่ำ:สูง         สุ่มจำนวนเต็มรวมปลายทั้งสอง (เฉพาะ random)
+    """
+    name, sep, value = spec.partition('=')
+    name = name.strip().replace('-', '_')
+    if not sep or name not in SEARCH_PARAMS:
+        raise ValueError(f"--param {spec} ไม่ถูกต้อง (ชื่อที่ใช้ได้: {', '.join(SEARCH_PARAMS)})")
+    kind, _, bounds = value.partition(':')
+    if kind in DISTRIBUTIONS:
+        low, high = (float(bound) for bound in bounds.split(':'))
+        return name, (kind, low, high)
+    return name, ('values', [SEARCH_PARAMS[name](v) for v in value.split(',')])
+
+def grid_trials(space):
+    """ทุกการผสมของค่าที่ระบุ (ต้องเป็นรายการค่าทั้งหมด)"""
+    for name, (kind, *_) in space.items():
+        if kind != 'values':
+            raise ValueError(f"grid search ใช้ได้เฉพาะรายการค่า แต่ {name} เป็นการสุ่มแบบ {kind}")
+    names = list(space)
+    return [dict(zip(names, combination)) for combination in itertools.product(*(space[n][1] for n in names))]
+
+def random_trials(space, num_trials, seed=0):
+    """สุ่ม num_trials ชุดค่าจาก space"""
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        params = {}
+        for name, (kind, *bounds) in space.items():
+            if kind == 'values':
+                params[name] = rng.choice(bounds[0])
+            elif kind == 'uniform':
+                params[name] = SEARCH_PARAMS[name](rng.uniform(*bounds))
+            elif kind == 'loguniform':
+                params[name] = SEARCH_PARAMS[name](math.exp(rng.uniform(math.log(bounds[0]), math.log(bounds[1]))))
+            else:
+                params[name] = rng.randint(int(bounds[0]), int(bounds[1]))
+        trials.append(params)
+    return trials
+
+def params_to_argv(params):
+    argv = []
+    for name, value in params.items():
+        argv += [f"--{name.replace('_', '-')}", f"{value:.6g}" if isinstance(value, float) else str(value)]
+    return argv
+
+def core_slots(parallel=None, cores_per_trial=None):
+    """แบ่ง core ที่ process นี้ใช้ได้เป็นชุดไม่ซ้อนกัน ชุดละหนึ่ง trial ที่รันพร้อมกัน"""
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_trial is None:
+        cores_per_trial = max(1, len(cores) // (parallel or 1))
+    parallel = parallel or max(1, len(cores) // cores_per_trial)
+    if parallel * cores_per_trial > len(cores):
+        print(f"มี {len(cores)} core ไม่พอสำหรับ {parallel} trial x {cores_per_trial} core "
+              f"ลดเหลือ {max(1, len(cores) // cores_per_trial)} trial พร้อมกัน")
+        parallel = max(1, len(cores) // cores_per_trial)
+    return [cores[i * cores_per_trial:(i + 1) * cores_per_trial] or cores for i in range(parallel)]
+
+def run_trial(name, trainer_argv, slots, sweep_dir):
+    """รัน gracer_ai_trainer.py หนึ่ง trial บน core ชุดที่ว่าง คืน return code"""
+    cores = slots.get()
+    try:
+        argv = trainer_argv + [
+            '--sweep-dir', sweep_dir,
+            '--trial-name', name,
+            '--model-name', f"{os.path.basename(sweep_dir)}/{name}",
+            '--cpu-cores', ','.join(str(core) for core in cores),
+            '--num-threads', str(len(cores)),
+            '--no-numa-binding',
+        ]
+        trainer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gracer_ai_trainer.py")
+        log_path = os.path.join(sweep_dir, TRIALS_DIR, f"{name}.log")
+        print(f"[{name}] เริ่มบน core {cores[0]}-{cores[-1]} (log: {log_path})")
+        with open(log_path, 'w', encoding='utf-8') as log:
+            returncode = subprocess.run([sys.executable, trainer_path] + argv, stdout=log,
+                                        stderr=subprocess.STDOUT).returncode
+    finally:
+        slots.put(cores)
+
+    record = load_trials(sweep_dir).get(name, {})
+    if returncode != 0:
+        record['status'] = 'failed'
+        write_json_atomic(trial_path(sweep_dir, name), record)
+    best = record.get('best_eval_loss')
+    print(f"[{name}] {record.get('status')} eval loss ดีที่สุด "
+          f"{'-' if best is None else f'{best:.4f}'} (return code {returncode})")
+    return returncode
+
+def run_sweep(trials, trainer_argv, sweep_dir, parallel=None, cores_per_trial=None,
+              early_stopping=True, grace_evals=1, min_trials=3):
+    """
+    รัน trial ทั้งหมดพร้อมกันตามจำนวน core ชุดที่แบ่งได้ แต่ละ trial เป็น process แยกที่ผูกกับ core ของตัวเอง
+
+    ข้อมูลที่ tokenize แล้วต้องอยู่ใน cache ก่อน (ดู prepare_dataset_cache) ทุก trial จึงเปิดไฟล์ Arrow
+    ชุดเดียวกันแบบ memory-map อ่านอย่างเดียว และใช้ page cache ร่วมกันแทนการ tokenize ซ้ำทุก trial
+    """
+    os.makedirs(os.path.join(sweep_dir, TRIALS_DIR), exist_ok=True)
+    write_json_atomic(os.path.join(sweep_dir, SWEEP_CONFIG), {
+        'trainer_argv': trainer_argv,
+        'early_stopping': early_stopping,
+        'grace_evals': grace_evals,
+        'min_trials': min_trials,
+    })
+    names = []
+    for index, params in enumerate(trials):
+        name = f"trial-{index:03d}"
+        names.append(name)
+        write_json_atomic(trial_path(sweep_dir, name), {
+            'name': name, 'params': params, 'status': 'pending', 'evals': [], 'best_eval_loss': None,
+        })
+
+    slots = queue.Queue()
+    for cores in core_slots(parallel, cores_per_trial):
+        slots.put(cores)
+    print(f"sweep {len(trials)} trial, พร้อมกัน {slots.qsize()} trial, early stopping "
+          f"{'เปิด' if early_stopping else 'ปิด'} -> {sweep_dir}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=slots.qsize()) as pool:
+        list(pool.map(
+            lambda item: run_trial(item[0], trainer_argv + params_to_argv(item[1]), slots, sweep_dir),
+            zip(names, trials),
+        ))
+    print(f"sweep เสร็จใน {time.perf_counter() - start:.1f} วินาที")
+    return summarize(sweep_dir)
+
+def summarize(sweep_dir):
+    """พิมพ์ตารางผลเรียงตาม eval loss ที่ดีที่สุด และบันทึก results.json"""
+    records = sorted(load_trials(sweep_dir).values(),
+                     key=lambda r: (r.get('best_eval_loss') is None, r.get('best_eval_loss') or 0.0))
+    if not records:
+        return []
+    param_names = list(records[0]['params'])
+    print(f"\n{'trial':10s} {'status':10s} {'eval loss':>10s} {'train loss':>10s} {'steps':>6s}  "
+          + "  ".join(param_names))
+    for record in records:
+        best = record.get('best_eval_loss')
+        train_loss = record.get('train_loss')
+        print(f"{record['name']:10s} {record['status']:10s} "
+              f"{'-' if best is None else f'{best:.4f}':>10s} "
+              f"{'-' if train_loss is None else f'{train_loss:.4f}':>10s} "
+              f"{record.get('global_step', '-'):>6}  "
+              + "  ".join(f"{record['params'][n]:.6g}" if isinstance(record['params'][n], float)
+                          else str(record['params'][n]) for n in param_names))
+    write_json_atomic(os.path.join(sweep_dir, "results.json"), records)
+    if records[0].get('best_eval_loss') is not None:
+        print(f"\nดีที่สุด: {records[0]['name']} {' '.join(params_to_argv(records[0]['params']))}")
+    return records
+
+def prepare_dataset_cache(trainer_args):
+    """tokenize ข้อมูลครั้งเดียวลง cache ก่อนเริ่ม trial (ถ้ามีอยู่แล้วจะใช้ของเดิม)"""
+    if trainer_args.streaming or not trainer_args.cache:
+        raise ValueError("sweep ต้องใช้ cache ของข้อมูลที่ tokenize แล้ว (ไม่รองรับ --streaming หรือ --no-cache)")
+    model_path = pinned_snapshot(trainer_args.base_model, trainer_args.revision, trainer_args.snapshot_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    return load_or_build_tokenized_dataset(trainer_args, tokenizer, profiler_from_args(trainer_args)) is not None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='ค้นหา hyperparameter ของ gracer_ai_trainer.py แบบ grid หรือ random โดยรันหลาย trial พร้อมกัน',
+        epilog='argument อื่นที่ไม่รู้จักจะส่งต่อให้ gracer_ai_trainer.py ทุก trial เช่น '
+               '--base-model, --dataset-path, --lora, --max-steps',
+    )
+    parser.add_argument('--param', type=str, action='append', required=True,
+                        help='ช่วงค่าของ hyperparameter เช่น learning_rate=1e-5,2e-5,5e-5 '
+                             'หรือ learning_rate=loguniform:1e-5:1e-3 (ระบุซ้ำได้)')
+    parser.add_argument('--search', type=str, choices=['grid', 'random'], default='grid', help='วิธีค้นหา')
+    parser.add_argument('--trials', type=int, default=8, help='จำนวน trial ของ random search')
+    parser.add_argument('--search-seed', type=int, default=0, help='seed ของการสุ่ม hyperparameter')
+    parser.add_argument('--name', type=str, default=None, help='ชื่อ sweep (ค่าเริ่มต้นใช้เวลาที่เริ่ม)')
+    parser.add_argument('--sweep-root', type=str, default='sweeps', help='โฟลเดอร์เก็บผลของทุก sweep')
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='จำนวน trial ที่รันพร้อมกัน (ค่าเริ่มต้น: จำนวน core / --cores-per-trial)')
+    parser.add_argument('--cores-per-trial', type=int, default=None,
+                        help='จำนวน core ต่อ trial (ค่าเริ่มต้น: แบ่ง core เท่ากันตาม --parallel)')
+    parser.add_argument('--eval-fraction', type=float, default=0.05, help='สัดส่วนข้อมูลที่กันไว้วัด eval loss')
+    parser.add_argument('--eval-steps', type=int, default=50, help='วัด eval loss ทุกกี่ optimizer step')
+    parser.add_argument('--early-stopping', action=argparse.BooleanOptionalAction, default=True,
+                        help='หยุด trial ที่ eval loss แย่กว่ามัธยฐานของ trial อื่นที่ความคืบหน้าเดียวกัน')
+    parser.add_argument('--grace-evals', type=int, default=1,
+                        help='จำนวนการประเมินแรกของแต่ละ trial ที่ยังไม่ตัดสินหยุด')
+    parser.add_argument('--min-trials', type=int, default=3,
+                        help='จำนวน trial อื่นขั้นต่ำที่ต้องมีผลก่อนใช้ early stopping')
+    parser.add_argument('--keep-models', action='store_true', help='บันทึกโมเดลของทุก trial (ค่าเริ่มต้นไม่บันทึก)')
+    args, trainer_argv = parser.parse_known_args()
+
+    space = dict(parse_param(spec) for spec in args.param)
+    trials = grid_trials(space) if args.search == 'grid' else random_trials(space, args.trials, args.search_seed)
+    name = args.name or time.strftime('sweep-%Y%m%d-%H%M%S')
+    sweep_dir = os.path.join(args.sweep_root, name)
+
+    trainer_argv = trainer_argv + [
+        '--eval-fraction', str(args.eval_fraction),
+        '--eval-steps', str(args.eval_steps),
+    ]
+    if not args.keep_models:
+        trainer_argv += ['--no-save-model', '--save-steps', str(10 ** 9)]
+    trainer_args = build_arg_parser().parse_args(trainer_argv)
+    if not prepare_dataset_cache(trainer_args):
+        sys.exit(1)
+    run_sweep(trials, trainer_argv, sweep_dir, args.parallel, args.cores_per_trial,
+              args.early_stopping, args.grace_evals, args.min_trials)
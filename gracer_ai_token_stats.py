@@ -0,0 +1,306 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from transformers import AutoTokenizer
+from compact_dataset import CompactRenderer, is_compact_dataset, load_compact_dataset
+from convert_to_autotrain import TASKS, PromptExporter, iter_lessons
+from model_loader import SNAPSHOT_DIR, pinned_snapshot
+from prompt_templates import TEMPLATES, build_templates
+
+GROUP_FIELDS = ('task', 'subject', 'grade')
+STRATEGIES = ('max_length', 'dynamic', 'group_by_length', 'packing')
+
+def load_texts(path, tasks=('summary',), template='alpaca'):
+    """
+    สร้างข้อความฝึกพร้อมป้ายกำกับ task/subject/grade
+
+    รับไฟล์บทเรียน (.json/.jsonl) ที่จะ render ด้วยแม่แบบและ task ที่เลือก, ไฟล์กะทัดรัดจาก
+    convert_to_autotrain.py --compact หรือไฟล์ CSV ที่มีคอลัมน์ text (ไม่มีป้ายกำกับ จึงได้ '-')
+    คืน (list ของข้อความ, dict ชื่อฟิลด์ -> numpy array ของป้ายกำกับ)
+    """
+    texts = []
+    labels = {field: [] for field in GROUP_FIELDS}
+    if path.endswith('.csv'):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                text = (row.get('text') or '').strip()
+                if text:
+                    texts.append(text)
+        for field in GROUP_FIELDS:
+            labels[field] = ['-'] * len(texts)
+    elif is_compact_dataset(path):
+        lessons, pairs, compact_tasks = load_compact_dataset(path)
+        texts = CompactRenderer(lessons, compact_tasks, template).render_batch(pairs)
+        labels['task'] = pairs['task']
+        labels['subject'] = [lessons[index]['subject'] for index in pairs['lesson']]
+        labels['grade'] = [lessons[index]['grade'] for index in pairs['lesson']]
+    else:
+        exporter = PromptExporter([], tasks)
+        prompt_template = build_templates([template])[template]
+        for lesson in iter_lessons(path):
+            for task, instruction, response in exporter.lesson_task_pairs(lesson):
+                texts.append(prompt_template.render(instruction, response)['text'])
+                labels['task'].append(task)
+                labels['subject'].append(lesson['subject'])
+                labels['grade'].append(lesson['grade'])
+    return texts, {field: np.array(values, dtype=object) for field, values in labels.items()}
+
+_worker_tokenizer = None
+
+def _init_worker(tokenizer_path):
+    global _worker_tokenizer
+    # แต่ละ process ใช้หนึ่ง core อยู่แล้ว ไม่ต้องให้ tokenizer แตกเธรดเพิ่ม
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+def _encode_lengths(tokenizer, texts):
+    encoded = tokenizer(texts, return_attention_mask=False, return_token_type_ids=False)
+    # tokenize_dataset ต่อ EOS ท้ายตัวอย่างที่ยังไม่ลงท้ายด้วย EOS
+    return [len(ids) + (not ids or ids[-1] != tokenizer.eos_token_id) for ids in encoded['input_ids']]
+
+def _lengths_in_worker(texts):
+    return _encode_lengths(_worker_tokenizer, texts)
+
+def token_lengths(texts, tokenizer_path, workers=0, chunk_size=2000):
+    """
+    ความยาว (token) ของทุกข้อความ รวม special token และ EOS ท้ายตัวอย่างแบบเดียวกับที่ trainer tokenize
+
+    workers=0 tokenize ทีละก้อนใน process หลัก (fast tokenizer กระจายงานใน batch ไปทุก core เอง)
+    workers>1 แบ่งก้อนให้หลาย process ซึ่งช่วยเมื่อ tokenizer เป็นแบบ Python (slow tokenizer)
+    """
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if workers <= 1:
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        lengths = [_encode_lengths(tokenizer, chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tokenizer_path,)) as executor:
+            lengths = list(executor.map(_lengths_in_worker, chunks))
+    return np.fromiter((n for chunk in lengths for n in chunk), dtype=np.int64, count=len(texts))
+
+def length_summary(lengths, candidates):
+    """สถิติความยาวและสัดส่วนที่ถูกตัดที่แต่ละความยาวใน candidates"""
+    if len(lengths) == 0:
+        return {'examples': 0}
+    p50, p90, p95, p99 = np.percentile(lengths, [50, 90, 95, 99])
+    candidates = np.asarray(candidates)
+    over = lengths[None, :] > candidates[:, None]
+    lost = np.clip(lengths[None, :] - candidates[:, None], 0, None).sum(axis=1)
+    return {
+        'examples': int(len(lengths)),
+        'mean': round(float(lengths.mean()), 1),
+        'p50': int(p50), 'p90': int(p90), 'p95': int(p95), 'p99': int(p99),
+        'max': int(lengths.max()),
+        # สัดส่วนตัวอย่างที่ยาวเกิน และสัดส่วน token ที่ถูกตัดทิ้ง
+        'truncated': {int(c): round(float(rate), 4) for c, rate in zip(candidates, over.mean(axis=1))},
+        'tokens_lost': {int(c): round(float(n) / float(lengths.sum()), 4) for c, n in zip(candidates, lost)},
+    }
+
+def length_histogram(lengths, bin_width):
+    """จำนวนตัวอย่างในแต่ละช่วงความยาว (ช่วงละ bin_width token)"""
+    if len(lengths) == 0:
+        return {}
+    edges = np.arange(0, int(lengths.max()) + bin_width + 1, bin_width)
+    counts, edges = np.histogram(lengths, bins=edges)
+    return {f"{int(lo)}-{int(hi) - 1}": int(n) for lo, hi, n in zip(edges[:-1], edges[1:], counts) if n}
+
+def _batched_tokens(lengths, batch_size):
+    """จำนวน token รวม padding เมื่อจัด lengths เป็น batch ตามลำดับแล้ว pad ตามตัวที่ยาวที่สุดของแต่ละ batch"""
+    n = len(lengths)
+    rows = -(-n // batch_size)
+    padded = np.zeros(rows * batch_size, dtype=np.int64)
+    padded[:n] = lengths
+    padded = padded.reshape(rows, batch_size)
+    real_per_row = np.minimum(batch_size, n - np.arange(rows) * batch_size)
+    return int((padded.max(axis=1) * real_per_row).sum())
+
+def _group_by_length_order(lengths, batch_size, rng):
+    """ลำดับแบบ LengthGroupedSampler ของ transformers: สุ่มแล้วเรียงจากยาวไปสั้นภายใน megabatch ขนาด 50 batch"""
+    order = rng.permutation(len(lengths))
+    megabatch = batch_size * 50
+    return np.concatenate([
+        chunk[np.argsort(-lengths[chunk], kind='stable')]
+        for chunk in np.split(order, np.arange(megabatch, len(order), megabatch))
+    ])
+
+def packed_block_lengths(lengths, block_size, map_batch_size=1000):
+    """ความยาวของบล็อกที่ pack_dataset ใน gracer_ai_trainer.py จะสร้าง (lengths รวม EOS แล้ว pack ทีละ 1000 ตัวอย่าง)"""
+    blocks = []
+    for start in range(0, len(lengths), map_batch_size):
+        current = 0
+        for n in np.minimum(lengths[start:start + map_batch_size], block_size):
+            if current + n > block_size:
+                blocks.append(current)
+                current = 0
+            current += n
+        if current:
+            blocks.append(current)
+    return np.array(blocks, dtype=np.int64)
+
+def padding_waste(lengths, max_length, batch_size, block_size, seeds=3):
+    """
+    คาดการณ์สัดส่วน padding ต่อ epoch ของแต่ละวิธีจัด batch ที่ gracer_ai_trainer.py มี
+
+    max_length: pad ทุกตัวอย่างเท่า max_length (--padding max_length)
+    dynamic: สุ่มลำดับแล้ว pad ตามตัวที่ยาวที่สุดของ batch (--no-group-by-length)
+    group_by_length: ค่าเริ่มต้นของ trainer
+    packing: --packing --block-size แล้วจัดบล็อกแบบ group_by_length
+    dynamic, group_by_length และ packing เฉลี่ยจากการสุ่มลำดับ seeds ครั้ง
+    """
+    truncated = np.minimum(lengths, max_length)
+    real = int(truncated.sum())
+    blocks = packed_block_lengths(truncated, block_size)
+    totals = {'max_length': [len(truncated) * max_length], 'dynamic': [], 'group_by_length': [], 'packing': []}
+    for seed in range(seeds):
+        rng = np.random.default_rng(seed)
+        totals['dynamic'].append(_batched_tokens(truncated[rng.permutation(len(truncated))], batch_size))
+        totals['group_by_length'].append(
+            _batched_tokens(truncated[_group_by_length_order(truncated, batch_size, rng)], batch_size))
+        totals['packing'].append(_batched_tokens(blocks[_group_by_length_order(blocks, batch_size, rng)], batch_size))
+    # ตัวอย่างที่ยาวกว่า block_size ถูกตัดเพิ่มอีกเมื่อ pack
+    packed_real = int(blocks.sum())
+    results = {}
+    for strategy, values in totals.items():
+        total = float(np.mean(values))
+        strategy_real = packed_real if strategy == 'packing' else real
+        results[strategy] = {
+            'tokens_per_epoch': int(total),
+            'padding': round(1 - strategy_real / total, 4) if total else 0.0,
+            'batches': int(-(-(len(blocks) if strategy == 'packing' else len(truncated)) // batch_size)),
+        }
+    return results
+
+def analyze(path, tokenizer_path, tasks=('summary',), template='alpaca', candidates=(128, 256, 384, 512, 768, 1024),
+            max_length=256, batch_sizes=(4, 8, 16), block_size=1024, bin_width=64, workers=0,
+            target_truncation=0.01):
+    """tokenize ข้อมูลทั้งหมดแล้วสรุปความยาว การตัด และ padding ของแต่ละวิธีจัด batch"""
+    start = time.perf_counter()
+    texts, labels = load_texts(path, tasks, template)
+    if not texts:
+        print(f"ไม่พบข้อมูลใน {path}")
+        return None
+    render_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lengths = token_lengths(texts, tokenizer_path, workers)
+    tokenize_seconds = time.perf_counter() - start
+    print(f"tokenize {len(texts):,} ตัวอย่าง ({int(lengths.sum()):,} token) ใช้เวลา {tokenize_seconds:.2f} วินาที "
+          f"({lengths.sum() / tokenize_seconds:,.0f} token/วินาที)")
+
+    candidates = sorted(set(candidates) | {max_length})
+    report = {
+        'dataset': path,
+        'tokenizer': tokenizer_path,
+        'template': template,
+        'examples': len(texts),
+        'tokens': int(lengths.sum()),
+        'render_seconds': round(render_seconds, 2),
+        'tokenize_seconds': round(tokenize_seconds, 2),
+        'overall': length_summary(lengths, candidates),
+        'histogram': length_histogram(lengths, bin_width),
+        'groups': {},
+        'padding': {},
+    }
+    for field in GROUP_FIELDS:
+        values, inverse = np.unique(labels[field], return_inverse=True)
+        if len(values) <= 1:
+            continue
+        report['groups'][field] = {
+            str(value): dict(length_summary(lengths[inverse == i], candidates),
+                             histogram=length_histogram(lengths[inverse == i], bin_width))
+            for i, value in enumerate(values)
+        }
+    for batch_size in batch_sizes:
+        report['padding'][batch_size] = padding_waste(lengths, max_length, batch_size, block_size)
+
+    # ความยาวที่สั้นที่สุดที่ตัดตัวอย่างไม่เกิน target_truncation
+    fits = [c for c, rate in report['overall']['truncated'].items() if rate <= target_truncation]
+    report['suggested_max_length'] = min(fits) if fits else None
+    report['target_truncation'] = target_truncation
+    report['max_length'] = max_length
+    report['block_size'] = block_size
+    return report
+
+def _summary_row(name, summary, candidates):
+    row = (f"{name[:24]:24s} {summary['examples']:6d} {summary['mean']:7.1f} {summary['p50']:6d} "
+           f"{summary['p95']:6d} {summary['max']:6d}")
+    return row + ''.join(f" {summary['truncated'][c]:6.1%}" for c in candidates)
+
+def print_report(report, histogram_fields=('task',)):
+    candidates = list(report['overall']['truncated'])
+    header = (f"{'กลุ่ม':24s} {'n':>6s} {'mean':>7s} {'p50':>6s} {'p95':>6s} {'max':>6s}"
+              + ''.join(f" {'>' + str(c):>6s}" for c in candidates))
+    print(f"\nความยาว (token) และสัดส่วนตัวอย่างที่ยาวเกินแต่ละ max_length: {report['dataset']}")
+    print(header)
+    print(_summary_row('ทั้งหมด', report['overall'], candidates))
+    for field, groups in report['groups'].items():
+        print(f"-- {field}")
+        for name, summary in groups.items():
+            print(_summary_row(name, summary, candidates))
+
+    histograms = [(f"{field}={name}", summary['histogram'])
+                  for field in histogram_fields for name, summary in report['groups'].get(field, {}).items()]
+    for title, histogram in histograms or [('ทั้งหมด', report['histogram'])]:
+        peak = max(histogram.values())
+        print(f"\nhistogram {title}")
+        for bucket, count in histogram.items():
+            print(f"  {bucket:>11s} {count:6d} {'#' * max(1, round(40 * count / peak))}")
+
+    print(f"\npadding ต่อ epoch ที่ max_length {report['max_length']} (packing ใช้ block size {report['block_size']})")
+    print(f"{'batch':>5s}" + ''.join(f" {strategy:>22s}" for strategy in STRATEGIES))
+    for batch_size, strategies in report['padding'].items():
+        cells = ''.join(f" {s['padding']:7.1%} {s['tokens_per_epoch']:>14,d}" for s in strategies.values())
+        print(f"{batch_size:5d}{cells}")
+    print("(แต่ละช่อง: สัดส่วน padding, จำนวน token ที่ประมวลผลต่อ epoch รวม padding)")
+    lost = report['overall']['tokens_lost'][report['max_length']]
+    print(f"\nที่ max_length {report['max_length']}: ตัด {report['overall']['truncated'][report['max_length']]:.1%} "
+          f"ของตัวอย่าง ({lost:.1%} ของ token)")
+    if report['suggested_max_length'] is not None:
+        print(f"max_length ที่สั้นที่สุดที่ตัดไม่เกิน {report['target_truncation']:.0%} ของตัวอย่าง: "
+              f"{report['suggested_max_length']}")
+    else:
+        print(f"ไม่มี max_length ที่ทดสอบซึ่งตัดไม่เกิน {report['target_truncation']:.0%} ของตัวอย่าง")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='สถิติความยาว token ของข้อมูลฝึก สำหรับเลือก max_length และวิธีจัด batch')
+    parser.add_argument('--dataset-path', type=str, default='dltv_dataset/dltv_dataset.json',
+                        help='ไฟล์บทเรียน (.json/.jsonl), ไฟล์กะทัดรัด หรือ CSV ที่มีคอลัมน์ text')
+    parser.add_argument('--base-model', type=str, default='google/gemma-3-1b-it',
+                        help='โมเดลที่จะใช้ tokenizer')
+    parser.add_argument('--revision', type=str, default=None, help='revision ของโมเดล')
+    parser.add_argument('--snapshot-dir', type=str, default=SNAPSHOT_DIR, help='โฟลเดอร์ snapshot ของโมเดล')
+    parser.add_argument('--tasks', type=str, nargs='+', choices=list(TASKS), default=['summary'],
+                        help='task ที่จะสร้างจากไฟล์บทเรียน (ไม่ใช้กับไฟล์กะทัดรัดและ CSV)')
+    parser.add_argument('--template', type=str, default='alpaca',
+                        choices=[name for name, cls in TEMPLATES.items() if cls.columns == ('text',)],
+                        help='แม่แบบที่ใช้ render ข้อความ')
+    parser.add_argument('--candidates', type=int, nargs='+', default=[128, 256, 384, 512, 768, 1024],
+                        help='max_length ที่จะคำนวณสัดส่วนการตัด')
+    parser.add_argument('--max-length', type=int, default=256,
+                        help='max_length ที่ใช้คาดการณ์ padding (ค่าเดียวกับ --max-length ของ trainer)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[4, 8, 16],
+                        help='batch size ที่จะคาดการณ์ padding')
+    parser.add_argument('--block-size', type=int, default=1024, help='block size ของโหมด --packing')
+    parser.add_argument('--bin-width', type=int, default=64, help='ความกว้างของช่วงใน histogram (token)')
+    parser.add_argument('--histograms', type=str, nargs='*', choices=list(GROUP_FIELDS), default=['task'],
+                        help='แสดง histogram แยกตามฟิลด์เหล่านี้ (ทุกกลุ่มอยู่ในไฟล์ --output)')
+    parser.add_argument('--target-truncation', type=float, default=0.01,
+                        help='สัดส่วนตัวอย่างที่ยอมให้ถูกตัด ใช้แนะนำ max_length')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='จำนวน process สำหรับ tokenize (0 = process หลัก ซึ่ง fast tokenizer ใช้ทุก core อยู่แล้ว)')
+    parser.add_argument('--output', type=str, default=None, help='ไฟล์ JSON สำหรับบันทึกรายงานทั้งหมด')
+    args = parser.parse_args()
+
+    tokenizer_path = pinned_snapshot(args.base_model, args.revision, args.snapshot_dir)
+    report = analyze(args.dataset_path, tokenizer_path, args.tasks, args.template, args.candidates,
+                     args.max_length, args.batch_sizes, args.block_size, args.bin_width, args.workers,
+                     args.target_truncation)
+    if report is not None:
+        print_report(report, args.histograms)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"บันทึกรายงานที่ {args.output}")
@@ -1,9 +1,26 @@
+import argparse
+import glob
 import json
 import torch
+import numpy as np
 import pandas as pd
-from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments, Trainer
-from datasets import Dataset
+from transformers import AutoTokenizer, TrainingArguments, Trainer, DataCollatorForSeq2Seq
+from transformers.trainer_utils import get_last_checkpoint
+from datasets import Dataset, load_from_disk, load_dataset as hf_load_dataset
+import hashlib
+import multiprocessing
 import os
+import shutil
+import subprocess
+import sys
+import time
+from pipeline_profiler import add_profile_arguments, profiler_from_args
+from training_telemetry import TelemetryCallback, current_rss_mb
+from async_checkpoint import AsyncCheckpointTrainer
+from memory_tuner import auto_tune_batch_size, available_memory_mb
+from model_loader import SNAPSHOT_DIR, load_causal_lm, load_in_background, pinned_snapshot
+from compact_dataset import CompactRenderer, is_compact_dataset, load_compact_dataset
+from prompt_templates import TEMPLATES
 
 def load_dataset(file_path):
     """โหลดข้อมูลจากไฟล์ JSON หรือ CSV"""
@@ -79,97 +96,862 @@ def prepare_dataset(data):
     
     return Dataset.from_dict({"text": texts})
 
-def main():
-    # กำหนดค่าเริ่มต้น
-    model_name = "gracer-ai"  # ชื่อโมเดลที่จะบันทึก
-    dataset_path = "dltv_dataset/dltv_dataset_autotrain.csv"  # เปลี่ยนเป็นไฟล์ CSV
-    base_model = "google/gemma-3-1b-it"
+def tokenize_dataset(dataset, tokenizer, max_length=256, padding="dynamic", render=None):
+    """
+    Tokenize ข้อความสำหรับ causal language modeling
+
+    padding="dynamic" จะไม่ pad ที่นี่ แต่ปล่อยให้ data collator pad ตามตัวอย่างที่ยาวที่สุดในแต่ละ batch
+    padding="max_length" จะ pad ทุกตัวอย่างให้ยาวเท่า max_length แบบเดิม
+    คอลัมน์ length ใช้สำหรับจัดกลุ่มตัวอย่างที่ยาวใกล้กันไว้ใน batch เดียวกัน
+    ถ้าระบุ render (ฟังก์ชันที่รับ batch แล้วคืน list ของข้อความ) จะสร้างข้อความทีละ batch แทนคอลัมน์ text
+    ทุกตัวอย่างลงท้ายด้วย EOS ที่มี label จริง (รวมอยู่ใน max_length) เพื่อให้โมเดลเรียนรู้ว่าคำตอบจบตรงไหน
+    """
+    def tokenize_function(examples):
+        tokenized = tokenizer(
+            render(examples) if render is not None else examples["text"],
+            truncation=True,
+            max_length=max_length - 1,
+        )
+        for input_ids, attention_mask in zip(tokenized["input_ids"], tokenized["attention_mask"]):
+            if not input_ids or input_ids[-1] != tokenizer.eos_token_id:
+                input_ids.append(tokenizer.eos_token_id)
+                attention_mask.append(1)
+        if padding == "max_length":
+            tokenized = tokenizer.pad(dict(tokenized), padding="max_length", max_length=max_length)
+        
+        # สร้าง labels สำหรับ causal language modeling โดยไม่คิด loss ที่ตำแหน่ง padding
+        tokenized["labels"] = [
+            [token if mask else -100 for token, mask in zip(input_ids, attention_mask)]
+            for input_ids, attention_mask in zip(tokenized["input_ids"], tokenized["attention_mask"])
+        ]
+        tokenized["length"] = [sum(attention_mask) for attention_mask in tokenized["attention_mask"]]
+        
+        return tokenized
     
-    # ใช้ CPU แทน MPS
-    device = torch.device("cpu")
-    print(f"ใช้ device: {device}")
+    # IterableDataset ที่อ่านจาก CSV/JSON ไม่รู้ชื่อคอลัมน์ล่วงหน้า ซึ่งมีแค่ text อยู่แล้ว
+    return dataset.map(tokenize_function, batched=True, remove_columns=dataset.column_names or ["text"])
+
+def pack_dataset(tokenized_dataset, block_size, eos_token_id):
+    """
+    รวมตัวอย่างที่ tokenize แล้วเป็นบล็อกยาวไม่เกิน block_size (tokenize_dataset ต่อ EOS ท้ายทุกตัวอย่างไว้แล้ว)
+
+    position_ids เริ่มนับใหม่จาก 0 ทุกตัวอย่าง PackedCollator ใช้จุดนี้แยกขอบเขตของตัวอย่าง
+    เพื่อสร้าง attention mask ที่ไม่ให้ตัวอย่างมองข้ามไปยังตัวอย่างอื่นในบล็อกเดียวกัน
+    ตัวอย่างที่ยาวกว่า block_size จะถูกตัดให้พอดีบล็อกโดยยังลงท้ายด้วย EOS
+    """
+    def pack_function(examples):
+        blocks = {"input_ids": [], "labels": [], "position_ids": [], "length": []}
+        input_ids, labels, position_ids = [], [], []
+        
+        def flush():
+            if input_ids:
+                blocks["input_ids"].append(list(input_ids))
+                blocks["labels"].append(list(labels))
+                blocks["position_ids"].append(list(position_ids))
+                blocks["length"].append(len(input_ids))
+                input_ids.clear()
+                labels.clear()
+                position_ids.clear()
+        
+        for example_ids, example_labels in zip(examples["input_ids"], examples["labels"]):
+            if len(example_ids) > block_size:
+                example_ids = example_ids[:block_size - 1] + [eos_token_id]
+                example_labels = example_labels[:block_size - 1] + [eos_token_id]
+            else:
+                example_labels = list(example_labels)
+            # token แรกของแต่ละตัวอย่างไม่ควรถูกทำนายจากตัวอย่างก่อนหน้า
+            example_labels[0] = -100
+            if len(input_ids) + len(example_ids) > block_size:
+                flush()
+            input_ids.extend(example_ids)
+            labels.extend(example_labels)
+            position_ids.extend(range(len(example_ids)))
+        flush()
+        return blocks
     
-    # โหลดข้อมูล
-    print("กำลังโหลดข้อมูล...")
-    data = load_dataset(dataset_path)
-    print(f"จำนวนข้อมูลที่โหลดได้: {len(data)} รายการ")
+    return tokenized_dataset.map(pack_function, batched=True, batch_size=1000,
+                                 remove_columns=tokenized_dataset.column_names or ["input_ids", "attention_mask", "labels", "length"])
+
+class PackedCollator:
+    """
+    รวมบล็อกที่ pack แล้วเป็น batch พร้อม attention mask แบบ 4 มิติ
+
+    แต่ละ token มองเห็นได้เฉพาะ token ก่อนหน้าในตัวอย่างเดียวกัน (block-diagonal causal mask)
+    ตำแหน่ง padding มองเห็นแค่ตัวเองและไม่ถูกคิด loss
+    """
+
+    def __init__(self, pad_token_id, mask_dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_len), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+        segment_ids = torch.full((batch_size, max_len), -1, dtype=torch.long)
+        
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[i, :n] = torch.tensor(f["input_ids"])
+            labels[i, :n] = torch.tensor(f["labels"])
+            positions = torch.tensor(f["position_ids"])
+            position_ids[i, :n] = positions
+            segment_ids[i, :n] = torch.cumsum(positions == 0, dim=0)
+        
+        same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        causal = torch.ones((max_len, max_len), dtype=torch.bool).tril()
+        allowed = same_segment & causal & (segment_ids[:, :, None] >= 0)
+        allowed |= torch.eye(max_len, dtype=torch.bool)  # ให้ padding มองเห็นตัวเอง ไม่ให้ softmax ว่าง
+        attention_mask = torch.zeros((batch_size, 1, max_len, max_len), dtype=self.mask_dtype)
+        attention_mask.masked_fill_(~allowed[:, None], torch.finfo(self.mask_dtype).min)
+        
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
+
+class PaddingStatsCollator:
+    """
+    ห่อ data collator เพื่อนับ token จริงเทียบกับ token ทั้งหมดใน batch (รวม padding)
+
+    ตัวนับเป็น shared memory เพราะเมื่อใช้ dataloader workers ตัว collator จะทำงานใน worker process
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self._real_tokens = multiprocessing.Value('q', 0)
+        self._total_tokens = multiprocessing.Value('q', 0)
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        real_tokens = sum(
+            sum(f["attention_mask"]) if "attention_mask" in f else len(f["input_ids"]) for f in features
+        )
+        with self._real_tokens.get_lock():
+            self._real_tokens.value += real_tokens
+        with self._total_tokens.get_lock():
+            self._total_tokens.value += batch["input_ids"].numel()
+        return batch
+
+    @property
+    def real_tokens(self):
+        return self._real_tokens.value
+
+    @property
+    def total_tokens(self):
+        return self._total_tokens.value
+
+    @property
+    def padding_ratio(self):
+        """สัดส่วน token ที่เป็น padding"""
+        if not self.total_tokens:
+            return 0.0
+        return 1 - self.real_tokens / self.total_tokens
+
+TOKENIZED_CACHE_VERSION = 3  # เพิ่มค่านี้เมื่อวิธี tokenize หรือ pack เปลี่ยน เพื่อไม่ให้ใช้ cache เก่า
+
+def file_sha256(path, chunk_size=1 << 20):
+    """คำนวณ SHA-256 ของไฟล์แบบอ่านทีละส่วน"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tokenizer_fingerprint(tokenizer):
+    """hash ของ vocab และกฎของ tokenizer ใช้แยก tokenizer ที่ชื่อเดียวกันแต่เนื้อหาต่างกัน"""
+    if getattr(tokenizer, "backend_tokenizer", None) is not None:
+        content = tokenizer.backend_tokenizer.to_str()
+    else:
+        content = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def tokenized_cache_key(args, tokenizer):
+    """สร้าง key ของ cache จากไฟล์ข้อมูล tokenizer และค่าที่มีผลต่อการ tokenize/pack"""
+    key = {
+        "version": TOKENIZED_CACHE_VERSION,
+        "dataset_sha256": file_sha256(args.dataset_path),
+        "tokenizer": args.base_model,
+        "revision": args.revision,
+        "tokenizer_sha256": tokenizer_fingerprint(tokenizer),
+        "max_length": args.max_length,
+        "padding": "dynamic" if args.packing else args.padding,
+        "packing": args.packing,
+        "block_size": args.block_size if args.packing else None,
+    }
+    if is_compact_dataset(args.dataset_path):
+        key["template"] = args.template
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return digest, key
+
+def build_tokenized_dataset(args, tokenizer, profiler):
+    """
+    โหลด ทำความสะอาด tokenize (และ pack) ข้อมูลจากไฟล์ คืน None ถ้าไม่มีข้อมูลที่ใช้ได้
+
+    ไฟล์กะทัดรัดจาก convert_to_autotrain.py --compact มีเพียงการอ้างอิง (lesson, task, part)
+    ข้อความจะถูก render ด้วยแม่แบบ --template ระหว่าง tokenize แต่ละ batch
+    """
+    render = None
+    if is_compact_dataset(args.dataset_path):
+        print(f"กำลังโหลดข้อมูลแบบกะทัดรัด (render ด้วยแม่แบบ {args.template})...")
+        with profiler.stage("load"):
+            lessons, pairs, tasks = load_compact_dataset(args.dataset_path)
+            render = CompactRenderer(lessons, tasks, args.template).render_batch
+            dataset = Dataset.from_dict(pairs)
+        print(f"จำนวนข้อมูลที่เตรียมสำหรับการฝึก: {len(dataset)} คู่จาก {len(lessons)} บทเรียน")
+        if len(dataset) == 0:
+            print("ไม่พบข้อมูล กรุณาตรวจสอบไฟล์ข้อมูล")
+            return None
+    else:
+        # โหลดข้อมูล
+        print("กำลังโหลดข้อมูล...")
+        with profiler.stage("load"):
+            data = load_dataset(args.dataset_path)
+        print(f"จำนวนข้อมูลที่โหลดได้: {len(data)} รายการ")
+        
+        if not data:
+            print("ไม่พบข้อมูล กรุณาตรวจสอบไฟล์ข้อมูล")
+            return None
+        
+        try:
+            with profiler.stage("clean"):
+                dataset = prepare_dataset(data)
+            print(f"จำนวนข้อมูลที่เตรียมสำหรับการฝึก: {len(dataset)} รายการ")
+        except ValueError as e:
+            print(f"เกิดข้อผิดพลาด: {e}")
+            return None
     
-    if not data:
+    # เตรียมข้อมูลสำหรับการฝึก
+    with profiler.stage("tokenize"):
+        if args.packing:
+            tokenized_dataset = tokenize_dataset(dataset, tokenizer, args.max_length, "dynamic", render)
+            tokenized_dataset = pack_dataset(tokenized_dataset, args.block_size, tokenizer.eos_token_id)
+            print(f"รวม {len(dataset)} ตัวอย่างเป็น {len(tokenized_dataset)} บล็อก (block size {args.block_size})")
+        else:
+            tokenized_dataset = tokenize_dataset(dataset, tokenizer, args.max_length, args.padding, render)
+    return tokenized_dataset
+
+STREAMING_BUILDERS = {
+    '.csv': 'csv',
+    '.json': 'json',
+    '.jsonl': 'json',
+    '.parquet': 'parquet',
+}
+
+def _clean_streaming_example(example):
+    text = example.get("text")
+    return {"text": text.strip() if isinstance(text, str) else ""}
+
+def stream_tokenized_dataset(args, tokenizer):
+    """
+    เปิดไฟล์ข้อมูลเป็น IterableDataset ที่อ่าน ทำความสะอาด และ tokenize ทีละส่วนระหว่างการฝึก
+
+    --dataset-path รับได้ทั้งไฟล์เดียว หรือ glob ของหลายไฟล์ (เช่น data/*.parquet)
+    แต่ละไฟล์คือหนึ่ง shard ที่ dataloader worker แยกกันอ่านได้ ถ้ามี worker มากกว่า shard
+    worker ที่เกินจะไม่มีงานทำ
+    """
+    extension = os.path.splitext(args.dataset_path)[1].lower()
+    if is_compact_dataset(args.dataset_path):
+        raise ValueError("โหมด streaming ไม่รองรับไฟล์แบบกะทัดรัด (ไฟล์เล็กพอที่จะใช้แบบปกติพร้อม cache)")
+    if extension not in STREAMING_BUILDERS:
+        raise ValueError(f"โหมด streaming รองรับเฉพาะ {', '.join(STREAMING_BUILDERS)}")
+    
+    dataset = hf_load_dataset(STREAMING_BUILDERS[extension], data_files=args.dataset_path,
+                              split="train", streaming=True)
+    print(f"อ่านข้อมูลแบบ streaming จาก {args.dataset_path} ({dataset.n_shards} shard)")
+    if dataset.column_names is not None:
+        if "text" not in dataset.column_names:
+            raise ValueError("ไม่พบคอลัมน์ 'text' ในไฟล์ข้อมูล")
+        dataset = dataset.select_columns(["text"])
+    
+    dataset = dataset.map(_clean_streaming_example)
+    dataset = dataset.filter(lambda example: len(example["text"]) > 0)
+    if args.shuffle_buffer:
+        dataset = dataset.shuffle(seed=42, buffer_size=args.shuffle_buffer)
+    
+    if args.packing:
+        dataset = tokenize_dataset(dataset, tokenizer, args.max_length, "dynamic")
+        return pack_dataset(dataset, args.block_size, tokenizer.eos_token_id)
+    return tokenize_dataset(dataset, tokenizer, args.max_length, args.padding)
+
+def load_or_build_tokenized_dataset(args, tokenizer, profiler):
+    """
+    ใช้ข้อมูลที่ tokenize แล้วจาก cache (Arrow บนดิสก์ เปิดแบบ memory-map) ถ้ามี
+    ถ้าไม่มีจะเตรียมใหม่แล้วบันทึกลง cache สำหรับการรันครั้งถัดไป
+    """
+    if not args.cache:
+        return build_tokenized_dataset(args, tokenizer, profiler)
+    
+    # key ของ cache ต้องอ่านไฟล์ข้อมูล จึงตรวจก่อนว่ามีไฟล์อยู่จริง
+    if not os.path.isfile(args.dataset_path):
+        print(f"ไม่พบไฟล์ {args.dataset_path}")
         print("ไม่พบข้อมูล กรุณาตรวจสอบไฟล์ข้อมูล")
-        return
+        return None
+    
+    digest, key = tokenized_cache_key(args, tokenizer)
+    cache_path = os.path.join(args.cache_dir, digest)
+    if os.path.isdir(cache_path):
+        with profiler.stage("cache load"):
+            tokenized_dataset = load_from_disk(cache_path)
+        print(f"ใช้ข้อมูลที่ tokenize แล้วจาก cache: {cache_path} ({len(tokenized_dataset)} รายการ)")
+        return tokenized_dataset
+    
+    tokenized_dataset = build_tokenized_dataset(args, tokenizer, profiler)
+    if tokenized_dataset is None:
+        return None
+    
+    # บันทึกลงโฟลเดอร์ชั่วคราวก่อนแล้วค่อยย้าย เพื่อไม่ให้เหลือ cache ที่เขียนไม่ครบ
+    with profiler.stage("cache write"):
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        tokenized_dataset.save_to_disk(tmp_path)
+        with open(os.path.join(tmp_path, "cache_key.json"), 'w', encoding='utf-8') as f:
+            json.dump(key, f, ensure_ascii=False, indent=2)
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        os.replace(tmp_path, cache_path)
+    print(f"บันทึกข้อมูลที่ tokenize แล้วลง cache: {cache_path}")
+    # เปิดจาก cache เพื่อให้ข้อมูลเป็น memory-map แทนการอยู่ในหน่วยความจำ
+    return load_from_disk(cache_path)
+
+def cpu_supports_bf16():
+    """ตรวจว่า CPU มีคำสั่ง bf16 ในฮาร์ดแวร์ (AVX-512 BF16 หรือ AMX) ซึ่งทำให้ autocast bf16 เร็วกว่า fp32"""
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def parse_core_list(spec):
+    """แปลงรายการ core เช่น "0-15,32-47" เป็น list ของเลข core"""
+    cores = []
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            cores.append(int(part))
+    return cores
+
+def configure_cpu(args):
+    """
+    ผูก process กับ core ที่เลือกและตั้งจำนวน thread ของ torch
+
+    thread ที่ torch สร้างภายหลังจะสืบทอด affinity ของ process จึงต้องเรียกก่อนเริ่มคำนวณ
+    ถ้าไม่ระบุ --num-threads จะใช้ thread เท่ากับจำนวน core ที่ผูกไว้
+    """
+    if args.cpu_cores:
+        cores = parse_core_list(args.cpu_cores)
+        os.sched_setaffinity(0, cores)
+        print(f"ผูก process กับ core {args.cpu_cores} ({len(cores)} core)")
+    num_threads = args.num_threads or (len(os.sched_getaffinity(0)) if args.cpu_cores else None)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if args.interop_threads:
+        # ตั้งได้ครั้งเดียวและต้องตั้งก่อนเริ่มงานแบบ inter-op ครั้งแรก
+        torch.set_num_interop_threads(args.interop_threads)
+    print(f"torch threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+def measure_tokens_per_second(model, batches, bf16=False):
+    """วัดความเร็ว forward + backward (token จริงต่อวินาที) โดยไม่อัปเดต weight และไม่นับ batch แรกที่ใช้ warmup"""
+    model.train()
+    real_tokens = 0
+    elapsed = 0.0
+    for i, batch in enumerate(batches):
+        start = time.perf_counter()
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+            loss = model(**batch).loss
+        loss.backward()
+        if i > 0:
+            elapsed += time.perf_counter() - start
+            real_tokens += int((batch["labels"] != -100).sum())
+    model.zero_grad(set_to_none=True)
+    return real_tokens / elapsed if elapsed else 0.0
+
+def benchmark_cpu_settings(model, tokenized_dataset, collator, args, bf16):
+    """
+    เทียบ token/วินาทีของค่าเริ่มต้น (fp32, thread เดิม, ไม่ compile) กับค่าที่ปรับแล้ว
+
+    ใช้ --cpu-benchmark-steps batch แรกของข้อมูล (รวม batch warmup อีกหนึ่ง batch)
+    """
+    model_inputs = ("input_ids", "attention_mask", "labels", "position_ids")
+    features = [
+        {k: v for k, v in f.items() if k in model_inputs}
+        for f in tokenized_dataset.take((args.cpu_benchmark_steps + 1) * args.batch_size)
+    ]
+    batches = [collator(features[i:i + args.batch_size]) for i in range(0, len(features), args.batch_size)]
+    
+    default_threads = torch.get_num_threads()
+    default_affinity = os.sched_getaffinity(0)
+    before = measure_tokens_per_second(model, batches)
+    
+    configure_cpu(args)
+    tuned_model = torch.compile(model) if args.torch_compile else model
+    after = measure_tokens_per_second(tuned_model, batches, bf16=bf16)
+    
+    print(f"token/วินาที ก่อนปรับ (fp32, {default_threads} threads, {len(default_affinity)} core): {before:,.0f}")
+    print(f"token/วินาที หลังปรับ (bf16={bf16}, compile={args.torch_compile}, "
+          f"{torch.get_num_threads()} threads): {after:,.0f}"
+          + (f" (x{after / before:.2f})" if before else ""))
+
+def numa_core_lists():
+    """คืน list ของ core ในแต่ละ NUMA node (เฉพาะ core ที่ process นี้ใช้ได้)"""
+    allowed = os.sched_getaffinity(0)
+    node_paths = sorted(
+        glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+        key=lambda path: int(os.path.basename(os.path.dirname(path))[len("node"):]),
+    )
+    nodes = []
+    for path in node_paths:
+        with open(path, 'r') as f:
+            cores = [core for core in parse_core_list(f.read().strip()) if core in allowed]
+        if cores:
+            nodes.append(cores)
+    return nodes or [sorted(allowed)]
+
+def plan_rank_cores(nproc):
+    """
+    แบ่ง core ให้แต่ละ local rank โดยเรียง core ตาม NUMA node แล้วแบ่งเป็นช่วงต่อเนื่องเท่า ๆ กัน
+
+    ถ้าจำนวน rank เป็นพหุคูณของจำนวน node แต่ละ rank จะได้ core ใน node เดียว
+    จึงไม่ต้องข้าม node ไปอ่านหน่วยความจำ
+    """
+    cores = [core for node in numa_core_lists() for core in node]
+    if len(cores) < nproc:
+        return [None] * nproc
+    return [cores[i * len(cores) // nproc:(i + 1) * len(cores) // nproc] for i in range(nproc)]
+
+def launch_distributed(args, argv, profiler, model_path):
+    """
+    รัน gracer_ai_trainer.py --nproc-per-node ตัวบนเครื่องนี้เป็น DDP (backend gloo)
+
+    แต่ละ process ได้ RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR และ MASTER_PORT ผ่าน environment
+    แบบเดียวกับ torchrun หลายเครื่องต่อกันผ่าน TCP ที่ --master-addr:--master-port
+    โดยรันคำสั่งเดียวกันทุกเครื่องและเปลี่ยนเฉพาะ --node-rank
+    """
+    nproc = args.nproc_per_node
+    world_size = args.nnodes * nproc
+    
+    # tokenize ครั้งเดียวลง cache ก่อน แล้วทุก rank เปิดใช้ cache เดียวกัน
+    if args.cache and not args.streaming:
+        with profiler.stage("tokenizer load"):
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        tokenizer.pad_token = tokenizer.eos_token
+        if load_or_build_tokenized_dataset(args, tokenizer, profiler) is None:
+            return 1
     
+    if args.numa_binding and not args.cpu_cores:
+        rank_cores = plan_rank_cores(nproc)
+    else:
+        rank_cores = [None] * nproc
+    
+    print(f"เริ่ม DDP (gloo): {nproc} process บนเครื่องนี้ (node {args.node_rank}/{args.nnodes}), "
+          f"world size {world_size}, rendezvous {args.master_addr}:{args.master_port}")
+    procs = []
+    for local_rank in range(nproc):
+        env = dict(
+            os.environ,
+            RANK=str(args.node_rank * nproc + local_rank),
+            LOCAL_RANK=str(local_rank),
+            WORLD_SIZE=str(world_size),
+            LOCAL_WORLD_SIZE=str(nproc),
+            MASTER_ADDR=args.master_addr,
+            MASTER_PORT=str(args.master_port),
+        )
+        cmd = [sys.executable, os.path.abspath(__file__), *argv]
+        if rank_cores[local_rank]:
+            cmd += ['--cpu-cores', ','.join(map(str, rank_cores[local_rank]))]
+            print(f"rank {env['RANK']}: core {cmd[-1]}")
+        elif not args.num_threads:
+            # ไม่ผูก core ก็แบ่ง thread เพื่อไม่ให้ทุก rank แย่ง core กันทั้งหมด
+            cmd += ['--num-threads', str(max(1, os.cpu_count() // nproc))]
+        procs.append(subprocess.Popen(cmd, env=env))
+    
+    # ถ้ามี rank ใดล้มเหลว ให้หยุด rank ที่เหลือแทนที่จะค้างรอ collective
+    exit_code = 0
+    while procs:
+        for proc in list(procs):
+            code = proc.poll()
+            if code is None:
+                continue
+            procs.remove(proc)
+            if code != 0 and exit_code == 0:
+                exit_code = code
+                print(f"process {proc.pid} จบด้วย exit code {code} กำลังหยุด process ที่เหลือ")
+                for other in procs:
+                    other.terminate()
+        time.sleep(0.5)
+    return exit_code
+
+LORA_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+def apply_lora(model, args):
+    """ครอบโมเดลด้วย LoRA adapter ให้ฝึกเฉพาะ adapter ส่วน weight เดิมถูก freeze ไว้"""
     try:
-        dataset = prepare_dataset(data)
-        print(f"จำนวนข้อมูลที่เตรียมสำหรับการฝึก: {len(dataset)} รายการ")
-    except ValueError as e:
-        print(f"เกิดข้อผิดพลาด: {e}")
+        from peft import LoraConfig, get_peft_model
+    except ImportError:
+        raise ImportError("โหมด --lora ต้องติดตั้ง peft ก่อน (pip install 'dltv[lora]')")
+    
+    lora_config = LoraConfig(
+        r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        lora_dropout=args.lora_dropout,
+        target_modules=args.lora_target_modules,
+        task_type="CAUSAL_LM",
+    )
+    model = get_peft_model(model, lora_config)
+    trainable, total = model.get_nb_trainable_parameters()
+    print(f"LoRA: ฝึก {trainable:,} จาก {total:,} พารามิเตอร์ ({trainable / total:.2%})")
+    return model
+
+def build_arg_parser():
+    """สร้าง argument parser สำหรับการฝึกโมเดล"""
+    parser = argparse.ArgumentParser(description='ฝึกโมเดล gracer-ai ด้วยข้อมูล DLTV')
+    parser.add_argument('--model-name', type=str, default='gracer-ai',
+                        help='ชื่อโมเดลที่จะบันทึก')
+    parser.add_argument('--dataset-path', type=str, default='dltv_dataset/dltv_dataset_autotrain.csv',
+                        help='ไฟล์ข้อมูลสำหรับการฝึก (.csv, .json หรือไฟล์กะทัดรัดจาก convert_to_autotrain.py --compact)')
+    parser.add_argument('--template', type=str, default='alpaca',
+                        choices=[name for name, cls in TEMPLATES.items() if cls.columns == ('text',)],
+                        help='แม่แบบที่ใช้ render ข้อความจากไฟล์กะทัดรัดระหว่าง tokenize')
+    parser.add_argument('--base-model', type=str, default='google/gemma-3-1b-it',
+                        help='โมเดลตั้งต้น')
+    parser.add_argument('--revision', type=str, default=None,
+                        help='revision (branch, tag หรือ commit) ของโมเดลตั้งต้น')
+    parser.add_argument('--snapshot-dir', type=str, default=SNAPSHOT_DIR,
+                        help='โฟลเดอร์เก็บ snapshot ของโมเดลตั้งต้นที่ดาวน์โหลดจาก Hub (pin ไว้ที่ commit เดียว)')
+    parser.add_argument('--refresh-snapshot', action='store_true',
+                        help='ตรวจ Hub แล้วดาวน์โหลด snapshot ของ --revision ใหม่แทนที่ pin ไว้')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='เก็บข้อมูลที่ tokenize แล้วไว้ใช้ซ้ำในการรันครั้งถัดไป')
+    parser.add_argument('--cache-dir', type=str, default='cache/tokenized',
+                        help='โฟลเดอร์เก็บ cache ของข้อมูลที่ tokenize แล้ว')
+    parser.add_argument('--max-length', type=int, default=256,
+                        help='ความยาวสูงสุดของแต่ละตัวอย่าง (token) ดูสัดส่วนที่ถูกตัดได้ด้วย gracer_ai_token_stats.py')
+    parser.add_argument('--padding', type=str, choices=['dynamic', 'max_length'], default='dynamic',
+                        help='dynamic = pad ตามตัวอย่างที่ยาวที่สุดในแต่ละ batch, max_length = pad ทุกตัวอย่างเท่ากัน')
+    parser.add_argument('--group-by-length', action=argparse.BooleanOptionalAction, default=True,
+                        help='จัดตัวอย่างที่ยาวใกล้กันไว้ใน batch เดียวกันเพื่อลด padding')
+    parser.add_argument('--packing', action='store_true',
+                        help='รวมหลายตัวอย่างเป็นบล็อกยาว --block-size โดยแยก attention ตามตัวอย่าง')
+    parser.add_argument('--block-size', type=int, default=1024,
+                        help='ความยาวบล็อกเมื่อใช้ --packing (token)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='อ่านข้อมูล (CSV, JSONL หรือ Parquet) แบบ streaming และ tokenize ระหว่างการฝึก')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000,
+                        help='ขนาด buffer สำหรับสลับลำดับข้อมูลในโหมด streaming (0 = ไม่สลับ)')
+    parser.add_argument('--max-steps', type=int, default=-1,
+                        help='จำนวน optimizer step สูงสุด (จำเป็นสำหรับ --streaming)')
+    parser.add_argument('--dataloader-workers', type=int, default=0,
+                        help='จำนวน process ที่เตรียม batch ล่วงหน้า')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+                        help='จำนวน batch ที่แต่ละ worker เตรียมล่วงหน้า')
+    parser.add_argument('--lora', action='store_true',
+                        help='ฝึกแบบ LoRA (บันทึกเฉพาะ adapter) แทนการฝึกทุกพารามิเตอร์')
+    parser.add_argument('--lora-r', type=int, default=16, help='rank ของ LoRA adapter')
+    parser.add_argument('--lora-alpha', type=int, default=32, help='ค่า alpha ของ LoRA')
+    parser.add_argument('--lora-dropout', type=float, default=0.05, help='dropout ของ LoRA')
+    parser.add_argument('--lora-target-modules', type=str, nargs='+', default=LORA_TARGET_MODULES,
+                        help='ชื่อโมดูลที่จะใส่ LoRA adapter (ค่าเริ่มต้นคือ projection ของ attention และ MLP)')
+    parser.add_argument('--learning-rate', type=float, default=None,
+                        help='learning rate (ค่าเริ่มต้น 2e-5 หรือ 2e-4 เมื่อใช้ --lora)')
+    parser.add_argument('--num-epochs', type=float, default=3, help='จำนวนรอบที่ฝึกผ่านข้อมูลทั้งหมด')
+    parser.add_argument('--warmup-steps', type=int, default=100, help='จำนวน step ที่ค่อย ๆ เพิ่ม learning rate')
+    parser.add_argument('--weight-decay', type=float, default=0.0, help='weight decay ของ AdamW')
+    parser.add_argument('--seed', type=int, default=42, help='seed ของการสุ่ม (ลำดับข้อมูล, dropout, การแบ่งชุดประเมิน)')
+    parser.add_argument('--eval-fraction', type=float, default=0.0,
+                        help='สัดส่วนข้อมูลที่กันไว้วัด eval loss ระหว่างฝึก (0 = ไม่ประเมิน)')
+    parser.add_argument('--eval-steps', type=int, default=100, help='วัด eval loss ทุกกี่ optimizer step')
+    parser.add_argument('--bf16', action=argparse.BooleanOptionalAction, default=None,
+                        help='ฝึกด้วย bf16 autocast (ค่าเริ่มต้น: เปิดเมื่อ CPU รองรับ bf16 ในฮาร์ดแวร์)')
+    parser.add_argument('--torch-compile', action='store_true',
+                        help='คอมไพล์โมเดลด้วย torch.compile ก่อนฝึก')
+    parser.add_argument('--num-threads', type=int, default=None,
+                        help='จำนวน intra-op thread ของ torch (ค่าเริ่มต้น: จำนวน core ที่ผูกไว้)')
+    parser.add_argument('--interop-threads', type=int, default=None,
+                        help='จำนวน inter-op thread ของ torch')
+    parser.add_argument('--cpu-cores', type=str, default=None,
+                        help='ผูก process กับ core ที่กำหนด เช่น 0-15 หรือ 0-15,32-47')
+    parser.add_argument('--cpu-benchmark-steps', type=int, default=0,
+                        help='วัด token/วินาที ก่อนและหลังปรับค่า CPU ด้วยจำนวน batch นี้ก่อนเริ่มฝึก (0 = ไม่วัด)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='จำนวนตัวอย่างต่อ batch (per_device_train_batch_size)')
+    parser.add_argument('--gradient-accumulation-steps', type=int, default=16,
+                        help='จำนวน step ที่สะสม gradient ก่อนอัปเดตโมเดล (นับรวมทุก rank เมื่อใช้ DDP)')
+    parser.add_argument('--telemetry', action=argparse.BooleanOptionalAction, default=True,
+                        help='บันทึก token/วินาที, padding, เวลารอ dataloader, เวลาต่อ step และหน่วยความจำทุก step')
+    parser.add_argument('--auto-batch-size', action='store_true',
+                        help='วัดหน่วยความจำแล้วเลือก micro-batch ที่ใหญ่ที่สุดที่ใส่ได้ (และ gradient checkpointing) '
+                             'โดยปรับ accumulation ให้ effective batch size เท่าเดิม')
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='หน่วยความจำที่ให้ใช้ฝึกบนเครื่องนี้สำหรับ --auto-batch-size '
+                             '(ค่าเริ่มต้น: ที่ใช้อยู่ + 90%% ของหน่วยความจำว่าง แบ่งเท่ากันทุก process)')
+    parser.add_argument('--save-steps', type=int, default=1000,
+                        help='บันทึก checkpoint ทุกกี่ optimizer step')
+    parser.add_argument('--async-checkpoint', action=argparse.BooleanOptionalAction, default=True,
+                        help='เขียน checkpoint ในเธรดเบื้องหลังโดยไม่หยุดการฝึก')
+    parser.add_argument('--save-model', action=argparse.BooleanOptionalAction, default=True,
+                        help='บันทึกโมเดลเมื่อฝึกเสร็จ')
+    parser.add_argument('--checkpoint-shard-size', type=str, default='2GB',
+                        help='ขนาดสูงสุดของแต่ละไฟล์ safetensors ใน checkpoint')
+    parser.add_argument('--resume', type=str, nargs='?', const='latest', default=None,
+                        help='ฝึกต่อจาก checkpoint (ไม่ระบุ path = checkpoint ล่าสุดในโฟลเดอร์โมเดล) '
+                             'คืนค่าโมเดล, optimizer, scheduler, RNG และตำแหน่งข้อมูล')
+    parser.add_argument('--nproc-per-node', type=int, default=1,
+                        help='จำนวน process DDP (gloo) บนเครื่องนี้')
+    parser.add_argument('--nnodes', type=int, default=1,
+                        help='จำนวนเครื่องที่ฝึกร่วมกัน')
+    parser.add_argument('--node-rank', type=int, default=0,
+                        help='ลำดับของเครื่องนี้ (0 ถึง --nnodes - 1)')
+    parser.add_argument('--master-addr', type=str, default='127.0.0.1',
+                        help='ที่อยู่ของเครื่อง node 0 สำหรับ rendezvous ผ่าน TCP')
+    parser.add_argument('--master-port', type=int, default=29500,
+                        help='พอร์ต TCP สำหรับ rendezvous')
+    parser.add_argument('--numa-binding', action=argparse.BooleanOptionalAction, default=True,
+                        help='แบ่ง core ให้แต่ละ process ตาม NUMA node')
+    parser.add_argument('--sweep-dir', type=str, default=None,
+                        help='(ใช้โดย gracer_ai_sweep.py) โฟลเดอร์ของ sweep ที่บันทึก eval loss และตัดสินหยุด trial')
+    parser.add_argument('--trial-name', type=str, default=None,
+                        help='(ใช้โดย gracer_ai_sweep.py) ชื่อ trial ใน --sweep-dir')
+    add_profile_arguments(parser)
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    profiler = profiler_from_args(args)
+    
+    # ใช้ snapshot ในเครื่องที่ pin ไว้ ไม่ต้องติดต่อ Hub ทุกครั้งที่เริ่ม (launcher ดาวน์โหลดก่อนแยก process)
+    launcher = "LOCAL_RANK" not in os.environ
+    with profiler.stage("snapshot"):
+        base_model = pinned_snapshot(args.base_model, args.revision, args.snapshot_dir,
+                                     refresh=args.refresh_snapshot and launcher)
+    
+    if (args.nproc_per_node > 1 or args.nnodes > 1) and launcher:
+        exit_code = launch_distributed(args, sys.argv[1:] if argv is None else argv, profiler, base_model)
+        profiler.report()
+        if exit_code:
+            sys.exit(exit_code)
         return
     
-    # โหลด tokenizer และโมเดล
-    print("กำลังโหลด tokenizer และโมเดล...")
-    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    rank = int(os.environ.get("RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1:
+        profiler.output_dir = os.path.join(profiler.output_dir, f"rank{rank}")
+
+    # กำหนดค่าเริ่มต้น
+    model_name = args.model_name  # ชื่อโมเดลที่จะบันทึก
+    
+    # ใช้ CPU แทน MPS
+    device = torch.device("cpu")
+    print(f"ใช้ device: {device}")
+    bf16 = cpu_supports_bf16() if args.bf16 is None else args.bf16
+    print(f"bf16 autocast: {'เปิด' if bf16 else 'ปิด'}")
+    
+    # เริ่มโหลดโมเดลในเบื้องหลังระหว่างโหลด tokenizer และเตรียมข้อมูล
+    model_future = load_in_background(load_causal_lm, base_model)
+    
+    # โหลด tokenizer
+    print("กำลังโหลด tokenizer...")
+    with profiler.stage("tokenizer load"):
+        tokenizer = AutoTokenizer.from_pretrained(base_model)
     
     # ตั้งค่า tokenizer
     tokenizer.pad_token = tokenizer.eos_token
     
-    # เตรียมข้อมูลสำหรับการฝึก
-    def tokenize_function(examples):
-        # Tokenize ข้อความ
-        tokenized = tokenizer(
-            examples["text"],
-            padding="max_length",
-            truncation=True,
-            max_length=256,  # ลดความยาวลงเพื่อประหยัดหน่วยความจำ
-            return_tensors="pt"
-        )
-        
-        # สร้าง labels สำหรับ causal language modeling
-        tokenized["labels"] = tokenized["input_ids"].clone()
-        
-        return tokenized
+    if args.streaming:
+        # อ่านและ tokenize ข้อมูลระหว่างการฝึก จึงไม่รู้จำนวนข้อมูลล่วงหน้า ต้องกำหนด --max-steps
+        if args.max_steps <= 0:
+            print("โหมด --streaming ต้องกำหนด --max-steps")
+            return
+        tokenized_dataset = stream_tokenized_dataset(args, tokenizer)
+    else:
+        # โหลดข้อมูลที่ tokenize แล้วจาก cache หรือเตรียมใหม่
+        tokenized_dataset = load_or_build_tokenized_dataset(args, tokenizer, profiler)
+        if tokenized_dataset is None:
+            return
+    
+    eval_dataset = None
+    if args.eval_fraction > 0 and not args.streaming:
+        # select แบบ keep_in_memory เก็บเฉพาะ index ในหน่วยความจำ ข้อมูลยัง memory-map จาก cache
+        # และไม่เขียนไฟล์ index ลงโฟลเดอร์ cache ที่ process อื่นอาจเปิดใช้อยู่
+        order = np.random.default_rng(args.seed).permutation(len(tokenized_dataset))
+        num_eval = max(1, int(len(order) * args.eval_fraction))
+        eval_dataset = tokenized_dataset.select(sorted(order[:num_eval]), keep_in_memory=True)
+        tokenized_dataset = tokenized_dataset.select(sorted(order[num_eval:]), keep_in_memory=True)
+        print(f"กันข้อมูล {len(eval_dataset)} รายการไว้วัด eval loss ทุก {args.eval_steps} step")
+    
+    if args.packing:
+        data_collator = PaddingStatsCollator(PackedCollator(tokenizer.pad_token_id))
+    else:
+        # pad แบบ dynamic ต่อ batch และไม่คิด loss ที่ตำแหน่ง padding
+        data_collator = PaddingStatsCollator(DataCollatorForSeq2Seq(tokenizer, padding=True, label_pad_token_id=-100))
+    
+    # โหมด LoRA บันทึกเฉพาะ adapter แยกไว้ ใช้ gracer_ai_merge.py รวมเป็นโมเดลเต็มภายหลัง
+    output_dir = f"./models/{model_name}-lora" if args.lora else f"./models/{model_name}"
+    learning_rate = args.learning_rate or (2e-4 if args.lora else 2e-5)
     
-    tokenized_dataset = dataset.map(tokenize_function, batched=True)
+    # แบ่ง gradient accumulation ให้ทุก rank เพื่อให้ effective batch size เท่าเดิม
+    # จึงใช้ learning rate เดิมได้ไม่ว่าจะฝึกกี่ process
+    gradient_accumulation_steps = max(1, args.gradient_accumulation_steps // world_size)
+    if world_size > 1 and args.gradient_accumulation_steps % world_size:
+        print(f"--gradient-accumulation-steps {args.gradient_accumulation_steps} หารด้วย world size "
+              f"{world_size} ไม่ลงตัว effective batch size จะเปลี่ยนไป")
+    print(f"effective batch size: {args.batch_size * gradient_accumulation_steps * world_size} "
+          f"({args.batch_size} x {gradient_accumulation_steps} step x {world_size} process)")
     
     # ตั้งค่าการฝึก
     training_args = TrainingArguments(
-        output_dir=f"./models/{model_name}",
-        num_train_epochs=3,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=16,  # เพิ่มขึ้นเพื่อประหยัดหน่วยความจำ
-        save_steps=1000,
+        output_dir=output_dir,
+        num_train_epochs=args.num_epochs,
+        max_steps=args.max_steps,
+        per_device_train_batch_size=args.batch_size,
+        per_device_eval_batch_size=args.batch_size,
+        eval_strategy="steps" if eval_dataset is not None else "no",
+        eval_steps=args.eval_steps,
+        gradient_accumulation_steps=gradient_accumulation_steps,  # เพิ่มขึ้นเพื่อประหยัดหน่วยความจำ
+        group_by_length=args.group_by_length and not args.streaming,
+        dataloader_num_workers=args.dataloader_workers,
+        dataloader_prefetch_factor=args.prefetch_factor if args.dataloader_workers > 0 else None,
+        save_steps=args.save_steps,
         save_total_limit=2,
         logging_dir=f"./logs/{model_name}",
         logging_steps=100,
-        learning_rate=2e-5,
-        warmup_steps=100,
+        learning_rate=learning_rate,
+        warmup_steps=args.warmup_steps,
+        weight_decay=args.weight_decay,
+        seed=args.seed,
         fp16=False,
-        bf16=False,
+        bf16=bf16,  # autocast บน CPU ส่วน weight ยังเป็น float32
+        torch_compile=args.torch_compile,
         use_cpu=True,  # ใช้ CPU แทน MPS
+        # map-style dataset ถูกแบ่งตาม rank ด้วย DistributedSampler ส่วนโหมด streaming
+        # rank 0 อ่านข้อมูลแล้วส่งส่วนของแต่ละ rank ให้ (dispatch_batches ของ accelerate)
+        ddp_backend="gloo" if world_size > 1 else None,
+        ddp_find_unused_parameters=False if world_size > 1 else None,
     )
     
-    # โหลดโมเดลหลังจากตั้งค่า training arguments
-    model = AutoModelForCausalLM.from_pretrained(
-        base_model,
-        torch_dtype=torch.float32,
-    ).to(device)
+    # รอโมเดลที่โหลดในเบื้องหลัง (stage นี้จึงวัดเฉพาะเวลาที่ต้องรอจริง)
+    print("กำลังโหลดโมเดล...")
+    with profiler.stage("model load"):
+        model = model_future.result()
+        if args.lora:
+            model = apply_lora(model, args)
+    
+    if args.cpu_benchmark_steps > 0:
+        benchmark_cpu_settings(model, tokenized_dataset, data_collator.collator, args, bf16)
+    else:
+        configure_cpu(args)
+    
+    if args.auto_batch_size:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        if args.memory_budget_gb:
+            budget_mb = args.memory_budget_gb * 1024 / local_world_size
+        else:
+            budget_mb = current_rss_mb() + 0.9 * available_memory_mb() / local_world_size
+        tuned = auto_tune_batch_size(
+            model,
+            data_collator.collator,
+            seq_len=args.block_size if args.packing else args.max_length,
+            effective_batch=args.batch_size * gradient_accumulation_steps,
+            budget_mb=budget_mb,
+            pad_token_id=tokenizer.pad_token_id,
+            packing=args.packing,
+            bf16=bf16,
+        )
+        if tuned:
+            micro_batch, accumulation, checkpointing = tuned
+            training_args.per_device_train_batch_size = micro_batch
+            training_args.gradient_accumulation_steps = accumulation
+            training_args.gradient_checkpointing = checkpointing
+            training_args.gradient_checkpointing_kwargs = {"use_reentrant": False}
+            print(f"auto-tune: micro-batch {micro_batch} x {accumulation} step, "
+                  f"gradient checkpointing {'เปิด' if checkpointing else 'ปิด'}")
     
     # สร้าง trainer
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        train_dataset=tokenized_dataset,
-    )
+    callbacks = []
+    if args.telemetry:
+        telemetry_file = f"telemetry.rank{rank}.jsonl" if world_size > 1 else "telemetry.jsonl"
+        callbacks.append(TelemetryCallback(data_collator, training_args.logging_dir, telemetry_file))
+    if args.sweep_dir:
+        from early_stopping import MedianStoppingCallback
+        callbacks.append(MedianStoppingCallback(args.sweep_dir, args.trial_name))
+    if args.async_checkpoint:
+        trainer = AsyncCheckpointTrainer(
+            model=model,
+            args=training_args,
+            train_dataset=tokenized_dataset,
+            eval_dataset=eval_dataset,
+            data_collator=data_collator,
+            callbacks=callbacks,
+            max_shard_size=args.checkpoint_shard_size,
+        )
+    else:
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            train_dataset=tokenized_dataset,
+            eval_dataset=eval_dataset,
+            data_collator=data_collator,
+            callbacks=callbacks,
+        )
+    
+    resume_from_checkpoint = args.resume
+    if resume_from_checkpoint == 'latest':
+        resume_from_checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+        if resume_from_checkpoint is None:
+            print(f"ไม่พบ checkpoint ใน {output_dir} เริ่มฝึกใหม่")
+    if resume_from_checkpoint:
+        print(f"ฝึกต่อจาก {resume_from_checkpoint}")
     
     # เริ่มการฝึก
     print("เริ่มการฝึกโมเดล...")
-    trainer.train()
+    with profiler.stage("train"):
+        trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    
+    # วัด eval loss ครั้งสุดท้ายถ้า step สุดท้ายไม่ตรงรอบการประเมิน
+    if eval_dataset is not None and trainer.state.global_step % args.eval_steps:
+        eval_loss = trainer.evaluate()['eval_loss']
+        if trainer.is_world_process_zero():
+            print(f"eval loss หลังฝึก: {eval_loss:.4f}")
+    
+    # รวมตัวนับ token จากทุก rank
+    real_tokens, total_tokens = data_collator.real_tokens, data_collator.total_tokens
+    if world_size > 1 and torch.distributed.is_initialized():
+        counts = torch.tensor([real_tokens, total_tokens], dtype=torch.int64)
+        torch.distributed.all_reduce(counts)
+        real_tokens, total_tokens = counts.tolist()
+    if not trainer.is_world_process_zero():
+        return
+    
+    padding_ratio = 1 - real_tokens / total_tokens if total_tokens else 0.0
+    print(f"สัดส่วน padding ระหว่างการฝึก: {padding_ratio:.1%} "
+          f"({real_tokens} token จริงจากทั้งหมด {total_tokens} token)")
+    train_runtime = trainer.state.log_history[-1].get("train_runtime") if trainer.state.log_history else None
+    if train_runtime:
+        print(f"ความเร็วการฝึก: {real_tokens / train_runtime:,.0f} token จริง/วินาที")
+    if trainer.state.global_step:
+        print(f"token จริงเฉลี่ยต่อ optimizer step: {real_tokens / trainer.state.global_step:,.0f}")
+    
+    if not args.save_model:
+        print("การฝึกเสร็จสิ้น (ไม่บันทึกโมเดลตาม --no-save-model)")
+        profiler.report()
+        return
     
-    # บันทึกโมเดลและ tokenizer
+    # บันทึกโมเดลและ tokenizer (เฉพาะ rank 0)
     print("กำลังบันทึกโมเดล...")
-    model.save_pretrained(f"./models/{model_name}")
-    tokenizer.save_pretrained(f"./models/{model_name}")
+    with profiler.stage("write"):
+        model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
     
-    print(f"การฝึกเสร็จสิ้น! โมเดลถูกบันทึกที่ ./models/{model_name}")
+    print(f"การฝึกเสร็จสิ้น! โมเดลถูกบันทึกที่ {output_dir}")
+    if args.lora:
+        print(f"รวม adapter เป็นโมเดลเต็มด้วย: python gracer_ai_merge.py --adapter {output_dir} "
+              f"--output ./models/{model_name}")
+    profiler.report()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,5 +1,414 @@
-def main():
-    print("Hello from dltv!")
+"""
+Command-line entry point for the DLTV / gracer-ai pipeline
+
+    python main.py run [--until process train] [--jobs 2] [--force convert] [--dry-run]
+    python main.py status
+    python main.py <command> [args...]     # scrape, process, convert, train, eval, ...
+
+`run` executes the pipeline stages as a DAG (scrape -> process, scrape -> convert -> train -> eval).
+Every stage is keyed by the hashes of its input files, its script and its command line;
+a stage whose key and outputs are unchanged since its last successful run is skipped, and
+stages whose dependencies are done run in parallel as separate processes. An existing
+scraped dataset is never replaced unless `--force scrape` is given.
+
+The other commands run the matching script in-process. Scripts are imported only when
+their command is used, so `main.py status` or `main.py run --dry-run` start without
+loading torch or transformers.
+"""
+import argparse
+import hashlib
+import json
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from convert_to_autotrain import HOLDOUT_FRACTION
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = "cache/pipeline"
+
+# command -> (module, arguments placed before the user's arguments)
+COMMANDS = {
+    'scrape': ('dltv_scraper', ['--action', 'scrape']),
+    'process': ('dltv_scraper', ['--action', 'process']),
+    'merge-lessons': ('dltv_scraper', ['--action', 'merge']),
+    'convert': ('convert_to_autotrain', []),
+    'train': ('gracer_ai_trainer', []),
+    'sweep': ('gracer_ai_sweep', []),
+    'distill': ('gracer_ai_distill', []),
+    'merge': ('gracer_ai_merge', []),
+    'quantize': ('gracer_ai_quantize', []),
+    'eval': ('gracer_ai_eval', []),
+    'serve': ('gracer_ai_server', []),
+    'benchmark': ('dltv_benchmark', []),
+    'token-stats': ('gracer_ai_token_stats', []),
+}
+
+
+def run_command(name, argv):
+    """Import the command's module and run it as __main__ with the given arguments"""
+    module, prefix = COMMANDS[name]
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    sys.argv = [f"main.py {name}"] + prefix + list(argv)
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+class Stage:
+    """One pipeline step: the command it runs, the files it reads and the files it produces"""
+
+    def __init__(self, name, command, argv, inputs=(), outputs=(), deps=(), adopt_existing=False):
+        self.name = name
+        self.command = command
+        self.argv = list(argv)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        # outputs that exist are used as they are and the stage only re-runs with --force
+        self.adopt_existing = adopt_existing
+
+    @property
+    def script(self):
+        return os.path.join(ROOT, f"{COMMANDS[self.command][0]}.py")
+
+    def cmdline(self):
+        module, prefix = COMMANDS[self.command]
+        return [sys.executable, self.script] + prefix + self.argv
+
+
+def build_stages(args):
+    """The scrape -> process / convert -> train -> eval DAG for the given options"""
+    data_dir = args.data_dir
+    lessons = os.path.join(data_dir, "dltv_dataset.json")
+    if args.compact:
+        train_data = os.path.join(data_dir, "dltv_dataset_compact.json")
+        convert_argv = ['--compact', train_data]
+    else:
+        train_data = os.path.join(data_dir, "dltv_dataset_autotrain.csv")
+        convert_argv = ['--output', train_data]
+    train_argv = shlex.split(args.train_args)
+    model_dir = os.path.join("models", f"{args.model_name}-lora" if '--lora' in train_argv else args.model_name)
+
+    scrape_argv = ['--output-path', data_dir, '--max-lessons', str(args.max_lessons)]
+    if args.grade:
+        scrape_argv += ['--grade', args.grade]
+    stages = [
+        # scraping takes hours of rate-limited requests and would overwrite the dataset, so an
+        # existing dataset is used as is (even after the scrape options change) until `--force scrape`
+        Stage('scrape', 'scrape', scrape_argv, outputs=[lessons], adopt_existing=True),
+        Stage('process', 'process', ['--output-path', data_dir],
+              inputs=[lessons], outputs=[os.path.join(data_dir, "processed", "training_pairs.json")],
+              deps=['scrape']),
+        Stage('convert', 'convert',
+              ['--input', lessons, '--tasks', *args.tasks, '--holdout-fraction', str(args.holdout_fraction)]
+              + convert_argv,
+              inputs=[lessons, os.path.join(ROOT, "prompt_templates.py")], outputs=[train_data], deps=['scrape']),
+        Stage('train', 'train',
+              ['--dataset-path', train_data, '--base-model', args.base_model, '--model-name', args.model_name]
+              + train_argv,
+              inputs=[train_data], outputs=[model_dir], deps=['convert']),
+    ]
+    if '--lora' not in train_argv:
+        eval_path = os.path.join("models", f"{args.model_name}-eval.json")
+        # evaluate with the prompt template the model was trained on
+        template_parser = argparse.ArgumentParser(add_help=False)
+        template_parser.add_argument('--template', default=None)
+        template = template_parser.parse_known_args(train_argv)[0].template
+        stages.append(Stage('eval', 'eval',
+                            ['--model', model_dir, '--lessons', lessons,
+                             '--holdout-fraction', str(args.holdout_fraction), '--output', eval_path]
+                            + (['--template', template] if template else [])
+                            + shlex.split(args.eval_args),
+                            inputs=[model_dir, lessons], outputs=[eval_path], deps=['train']))
+    return {stage.name: stage for stage in stages}
+
+
+def select_stages(stages, targets):
+    """The target stages and everything they depend on, in dependency order"""
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for dep in stages[name].deps:
+            visit(dep)
+        order.append(name)
+
+    for name in targets:
+        visit(name)
+    return order
+
+
+class ArtifactHasher:
+    """
+    Content hashes of pipeline files and directories
+
+    Hashes are remembered per (path, size, mtime) in the pipeline state, so an
+    unchanged multi-megabyte dataset is not re-read on every run. A directory
+    (e.g. a saved model) hashes the names and hashes of the files inside it.
+    """
+
+    def __init__(self, memo):
+        self.memo = memo
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            cached = self.memo.get(path)
+        if cached and cached[:2] == signature:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.memo[path] = signature + [digest.hexdigest()]
+        return digest.hexdigest()
+
+    def __call__(self, path):
+        """sha256 of a file or directory, or None when it does not exist"""
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(path):
+            # checkpoints are intermediate training state, not part of the model
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('checkpoint-'))
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                digest.update(f"{os.path.relpath(full_path, path)}\0{self.file_hash(full_path)}\0".encode('utf-8'))
+        return digest.hexdigest()
+
+
+class Pipeline:
+    """Run the selected stages, skipping those whose key and outputs match the last successful run"""
+
+    def __init__(self, stages, state_dir=STATE_DIR, jobs=2, force=(), dry_run=False):
+        self.stages = stages
+        self.state_dir = state_dir
+        self.jobs = jobs
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.state_path = os.path.join(state_dir, "state.json")
+        self.state = {'stages': {}, 'hashes': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+        self.hasher = ArtifactHasher(self.state.setdefault('hashes', {}))
+        self.lock = threading.Lock()
+        self.print_lock = threading.Lock()
+
+    def save_state(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def stage_key(self, stage):
+        """Hash of the stage's command line, script and input files (None if an input is missing)"""
+        inputs = {}
+        for path in [stage.script] + stage.inputs:
+            inputs[path] = self.hasher(path)
+            if inputs[path] is None:
+                return None
+        key = {'argv': stage.cmdline()[1:], 'inputs': inputs}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_fresh(self, stage, key):
+        record = self.state['stages'].get(stage.name)
+        if stage.name in self.force or key is None:
+            return False
+        if stage.adopt_existing and all(os.path.exists(path) for path in stage.outputs):
+            # edits to an adopted dataset are kept; downstream stages see them through their input hashes.
+            # Changed options or a changed script (which also holds other commands) never re-run it.
+            if not record:
+                with self.lock:
+                    self.state['stages'][stage.name] = {
+                        'key': key,
+                        'outputs': {path: self.hasher(path) for path in stage.outputs},
+                        'finished_at': None,
+                        'seconds': 0.0,
+                    }
+            elif record['key'] != key:
+                self.log(f"[{stage.name}] options or script changed; keeping the existing "
+                         f"{', '.join(stage.outputs)} (use --force {stage.name} to re-run)")
+            return True
+        if not record or record['key'] != key:
+            return False
+        # outputs deleted or edited since the last run are rebuilt
+        return all(self.hasher(path) == digest for path, digest in record['outputs'].items())
+
+    def log(self, message):
+        with self.print_lock:
+            print(message, flush=True)
+
+    def execute(self, stage):
+        """Run one stage in a subprocess, prefixing its output with the stage name"""
+        start = time.perf_counter()
+        self.log(f"[{stage.name}] $ {shlex.join(stage.cmdline()[1:])}")
+        process = subprocess.Popen(stage.cmdline(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   env=dict(os.environ, PYTHONUNBUFFERED="1"), text=True, errors='replace')
+        for line in process.stdout:
+            # progress bars redraw with \r; print only their last state
+            line = line.rstrip('\n').rsplit('\r', 1)[-1]
+            if line.strip():
+                self.log(f"[{stage.name}] {line}")
+        returncode = process.wait()
+        duration = time.perf_counter() - start
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if returncode == 0 and missing:
+            self.log(f"[{stage.name}] finished but did not produce {', '.join(missing)}")
+            returncode = 1
+        if returncode == 0:
+            record = {
+                'key': self.stage_key(stage),
+                'outputs': {path: self.hasher(path) for path in stage.outputs},
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'seconds': round(duration, 2),
+            }
+            with self.lock:
+                self.state['stages'][stage.name] = record
+            self.save_state()
+        return returncode, duration
+
+    def run(self, names):
+        """Run the named stages (already in dependency order). Returns {stage: (status, seconds)}"""
+        results = {}
+        pending = list(names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(results.get(dep, ('',))[0] in ('failed', 'blocked') for dep in stage.deps if dep in names):
+                        results[name] = ('blocked', 0.0)
+                        pending.remove(name)
+                        continue
+                    if not all(results.get(dep, ('',))[0] in ('ran', 'skipped') for dep in stage.deps
+                               if dep in names):
+                        continue
+                    pending.remove(name)
+                    # a dependency that only ran in dry-run mode has no real outputs to hash yet
+                    upstream_ran = any(results.get(dep, ('',))[0] == 'ran' for dep in stage.deps)
+                    key = None if self.dry_run and upstream_ran else self.stage_key(stage)
+                    if self.is_fresh(stage, key):
+                        results[name] = ('skipped', 0.0)
+                        self.log(f"[{name}] up to date, skipped")
+                    elif self.dry_run:
+                        results[name] = ('ran', 0.0)
+                        self.log(f"[{name}] would run: {shlex.join(stage.cmdline()[1:])}")
+                    elif len(running) < self.jobs:
+                        running[executor.submit(self.execute, stage)] = name
+                    else:
+                        pending.insert(0, name)
+                        break
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        returncode, duration = future.result()
+                    except Exception as e:
+                        self.log(f"[{name}] could not start: {e}")
+                        returncode, duration = 1, 0.0
+                    results[name] = ('ran' if returncode == 0 else 'failed', duration)
+                    if returncode:
+                        self.log(f"[{name}] failed with exit code {returncode}")
+        if not self.dry_run:
+            self.save_state()
+        return results
+
+
+def print_summary(names, results):
+    print("\nstage        status      seconds")
+    for name in names:
+        status, seconds = results.get(name, ('-', 0.0))
+        print(f"{name:<12} {status:<10} {seconds:>8.1f}")
+
+
+def print_status(stages, state_dir):
+    state_path = os.path.join(state_dir, "state.json")
+    records = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            records = json.load(f).get('stages', {})
+    for name, stage in stages.items():
+        record = records.get(name)
+        if record and record['finished_at'] is None:
+            print(f"{name:<12} using existing {', '.join(stage.outputs)}")
+        elif record:
+            print(f"{name:<12} last run {record['finished_at']} ({record['seconds']:.1f}s) -> {', '.join(stage.outputs)}")
+        else:
+            print(f"{name:<12} never run")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='DLTV / gracer-ai pipeline',
+        epilog=f"other commands (run the matching script, e.g. main.py train --help): {', '.join(COMMANDS)}")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    run_parser = subparsers.add_parser('run', help='run the pipeline, skipping stages that are up to date')
+    status_parser = subparsers.add_parser('status', help='show when each stage last ran')
+    for sub in (run_parser, status_parser):
+        sub.add_argument('--data-dir', type=str, default='dltv_dataset', help='directory with the lesson dataset')
+        sub.add_argument('--model-name', type=str, default='gracer-ai', help='name of the trained model')
+        sub.add_argument('--compact', action='store_true',
+                         help='train from the compact dataset format instead of the AutoTrain CSV')
+        sub.add_argument('--train-args', type=str, default='',
+                         help='extra gracer_ai_trainer.py arguments, e.g. "--lora --max-steps 100"')
+        sub.add_argument('--eval-args', type=str, default='', help='extra gracer_ai_eval.py arguments')
+        sub.add_argument('--state-dir', type=str, default=STATE_DIR, help='where stage keys and hashes are kept')
+    run_parser.add_argument('--until', type=str, nargs='+', default=['process', 'train'],
+                            choices=['scrape', 'process', 'convert', 'train', 'eval'],
+                            help='run these stages and the stages they depend on')
+    run_parser.add_argument('--force', type=str, nargs='+', default=[], help='stages to run even if up to date')
+    run_parser.add_argument('--jobs', type=int, default=2, help='stages to run at the same time')
+    run_parser.add_argument('--dry-run', action='store_true', help='print which stages would run')
+    run_parser.add_argument('--base-model', type=str, default='google/gemma-3-1b-it', help='base model to fine-tune')
+    run_parser.add_argument('--tasks', type=str, nargs='+', default=['summary'],
+                            help='instruction/response tasks to generate (see convert_to_autotrain.py)')
+    run_parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                            help='lessons held out of training for the eval stage')
+    run_parser.add_argument('--max-lessons', type=int, default=5, help='lessons to scrape per subject')
+    run_parser.add_argument('--grade', type=str, default=None, help='scrape a single grade level')
+    status_parser.set_defaults(base_model='google/gemma-3-1b-it', tasks=['summary'], holdout_fraction=HOLDOUT_FRACTION,
+                               max_lessons=5, grade=None)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        run_command(argv[0], argv[1:])
+        return
+
+    args = build_arg_parser().parse_args(argv)
+    stages = build_stages(args)
+    if args.action == 'status':
+        print_status(stages, args.state_dir)
+        return
+
+    unknown = [name for name in args.until + args.force if name not in stages]
+    if unknown:
+        print(f"stage {', '.join(unknown)} is not part of this pipeline (stages: {', '.join(stages)}; "
+              f"eval is not run for LoRA adapters)")
+        sys.exit(2)
+    names = select_stages(stages, args.until)
+    pipeline = Pipeline(stages, args.state_dir, args.jobs, args.force, args.dry_run)
+    results = pipeline.run(names)
+    print_summary(names, results)
+    if any(status in ('failed', 'blocked') for status, _ in results.values()):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+import ctypes
+import ctypes.util
+import gc
+import torch
+from training_telemetry import current_rss_mb
+
+def available_memory_mb():
+    """หน่วยความจำที่ระบบยังให้ใช้ได้ (MemAvailable, MB)"""
+    with open("/proc/meminfo", 'r') as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024
+    raise OSError("ไม่พบ MemAvailable ใน /proc/meminfo")
+
+def _reset_peak_rss():
+    """รีเซ็ตค่า RSS สูงสุดของ process (Linux) คืน False ถ้าทำไม่ได้"""
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    """RSS สูงสุดตั้งแต่รีเซ็ตครั้งล่าสุด (VmHWM, MB)"""
+    with open("/proc/self/status", 'r') as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise OSError("ไม่พบ VmHWM ใน /proc/self/status")
+
+def _release_free_memory():
+    """
+    คืนหน่วยความจำที่ free แล้วให้ระบบ (glibc malloc_trim) เพื่อให้ RSS ก่อนวัดไม่รวมพื้นที่ว่างที่ allocator เก็บไว้
+    ไม่เช่นนั้น probe ถัดไปจะใช้พื้นที่ว่างนั้นซ้ำและวัดได้น้อยกว่าความจริง
+    """
+    gc.collect()
+    libc_path = ctypes.util.find_library("c")
+    if libc_path:
+        try:
+            ctypes.CDLL(libc_path).malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+def _set_gradient_checkpointing(model, enabled):
+    if enabled:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    else:
+        model.gradient_checkpointing_disable()
+
+def probe_step_memory(model, collator, micro_batch, seq_len, pad_token_id, packing=False, bf16=False):
+    """
+    วัดหน่วยความจำที่เพิ่มขึ้น (MB) ระหว่าง forward + backward ของ batch ขนาด micro_batch x seq_len
+
+    ใช้ตัวอย่างยาวเต็ม seq_len ทุกตัว ซึ่งเป็นกรณีที่ใช้หน่วยความจำมากที่สุดของ dynamic padding
+    """
+    feature = {"input_ids": [pad_token_id] * seq_len, "attention_mask": [1] * seq_len, "labels": [pad_token_id] * seq_len}
+    if packing:
+        feature["position_ids"] = list(range(seq_len))
+    batch = collator([dict(feature) for _ in range(micro_batch)])
+
+    model.zero_grad(set_to_none=True)
+    _release_free_memory()
+    baseline = current_rss_mb()
+    _reset_peak_rss()
+    with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+        loss = model(**batch).loss
+    loss.backward()
+    peak = _peak_rss_mb()
+    del loss, batch
+    model.zero_grad(set_to_none=True)
+    _release_free_memory()
+    return max(0.0, peak - baseline)
+
+def auto_tune_batch_size(model, collator, seq_len, effective_batch, budget_mb, pad_token_id,
+                         packing=False, bf16=False):
+    """
+    เลือก micro-batch ที่ใหญ่ที่สุดที่ใช้หน่วยความจำไม่เกิน budget_mb โดยลองทั้งเปิดและปิด gradient checkpointing
+
+    micro-batch ที่ลองคือตัวหารของ effective_batch (1, 2, 4, ...) เพื่อให้ micro-batch x accumulation
+    เท่ากับ effective_batch เสมอ ก่อนลองขนาดถัดไปจะประมาณหน่วยความจำจากผลที่วัดได้ก่อน
+    ถ้าเกิน budget จะหยุดโดยไม่รันจริง หน่วยความจำที่นับรวมโมเดลที่โหลดแล้ว
+    และ optimizer state ของ AdamW (2 เท่าของพารามิเตอร์ที่ฝึก)
+
+    คืน (micro_batch, gradient_accumulation_steps, gradient_checkpointing)
+    """
+    if not _reset_peak_rss():
+        print("วัด RSS สูงสุดไม่ได้ (ต้องใช้ Linux) ใช้ batch size เดิม")
+        return None
+
+    trainable_mb = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad) / (1024 * 1024)
+    fixed_mb = current_rss_mb() + 2 * trainable_mb
+    candidates = [size for size in range(1, effective_batch + 1) if effective_batch % size == 0]
+    print(f"auto-tune: budget {budget_mb:,.0f} MB, โมเดล + optimizer state ~{fixed_mb:,.0f} MB, "
+          f"ความยาว {seq_len} token, effective batch {effective_batch}")
+
+    best = {}
+    model.train()
+    for checkpointing in (False, True):
+        _set_gradient_checkpointing(model, checkpointing)
+        last_size = last_mb = None
+        for size in candidates:
+            if last_size is not None and fixed_mb + last_mb * size / last_size > budget_mb:
+                break
+            step_mb = probe_step_memory(model, collator, size, seq_len, pad_token_id, packing, bf16)
+            fits = fixed_mb + step_mb <= budget_mb
+            print(f"  checkpointing={'on' if checkpointing else 'off'} micro-batch {size}: "
+                  f"+{step_mb:,.0f} MB {'ผ่าน' if fits else 'เกิน budget'}")
+            if not fits:
+                break
+            best[checkpointing] = size
+            last_size, last_mb = size, step_mb
+    _set_gradient_checkpointing(model, False)
+
+    if not best:
+        print("auto-tune: micro-batch 1 ยังเกิน budget ใช้ micro-batch 1 พร้อม gradient checkpointing")
+        return 1, effective_batch, True
+    # checkpointing คำนวณ forward ซ้ำ จึงเลือกเมื่อทำให้ micro-batch ใหญ่ขึ้นอย่างน้อยสองเท่าเท่านั้น
+    checkpointing = best.get(True, 0) >= 2 * best.get(False, 0)
+    micro_batch = best[checkpointing]
+    return micro_batch, effective_batch // micro_batch, checkpointing
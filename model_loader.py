@@ -0,0 +1,101 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from transformers import AutoModelForCausalLM
+
+SNAPSHOT_DIR = "models/snapshots"
+PIN_FILE = "snapshot.json"
+# ไฟล์ที่ต้องใช้ฝึกและ inference (ไม่ดาวน์โหลด .bin, .gguf หรือไฟล์ของ framework อื่นที่อาจอยู่ใน repo เดียวกัน)
+SNAPSHOT_PATTERNS = ["*.json", "*.safetensors", "*.model", "*.txt", "*.jinja"]
+
+def pinned_snapshot(model_id, revision=None, snapshot_dir=SNAPSHOT_DIR, refresh=False):
+    """
+    คืนโฟลเดอร์ในเครื่องของโมเดลบน Hugging Face Hub โดย pin ไว้ที่ commit เดียว
+
+    ครั้งแรกจะดาวน์โหลดลง snapshot_dir/<owner>--<name> แล้วบันทึก commit ไว้ใน snapshot.json
+    ครั้งต่อไปใช้โฟลเดอร์นั้นทันทีโดยไม่ติดต่อ Hub (ทุกรันจึงได้ weight ชุดเดียวกันแม้ repo บน Hub เปลี่ยน)
+    จนกว่าจะขอ revision อื่นหรือใช้ refresh=True ถ้า model_id เป็นโฟลเดอร์อยู่แล้วจะคืนค่าเดิม
+    """
+    if os.path.isdir(model_id):
+        return model_id
+    local_dir = os.path.join(snapshot_dir, model_id.replace('/', '--'))
+    pin_path = os.path.join(local_dir, PIN_FILE)
+    pin = None
+    if os.path.exists(pin_path):
+        with open(pin_path, 'r', encoding='utf-8') as f:
+            pin = json.load(f)
+    if pin and not refresh and revision in (None, pin['requested_revision'], pin['revision']):
+        return local_dir
+
+    from huggingface_hub import HfApi, snapshot_download
+    try:
+        commit = HfApi().model_info(model_id, revision=revision).sha
+        print(f"กำลังดาวน์โหลด {model_id}@{commit[:12]} ลง {local_dir}...")
+        snapshot_download(model_id, revision=commit, local_dir=local_dir, allow_patterns=SNAPSHOT_PATTERNS)
+    except Exception as e:
+        if pin:
+            print(f"อัปเดต snapshot ของ {model_id} ไม่ได้ ({e}) ใช้ commit {pin['revision'][:12]} ที่ pin ไว้")
+            return local_dir
+        raise
+    with open(pin_path, 'w', encoding='utf-8') as f:
+        json.dump({'model': model_id, 'requested_revision': revision, 'revision': commit,
+                   'downloaded_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+    return local_dir
+
+def prefetch_weights(path):
+    """
+    ขอให้ kernel อ่านไฟล์ safetensors เข้า page cache ล่วงหน้า (posix_fadvise WILLNEED)
+
+    weight ถูก mmap และอ่านจากดิสก์จริงตอนใช้ครั้งแรก การอ่านล่วงหน้าแบบต่อเนื่องจึงเร็วกว่าให้
+    forward แรกเกิด page fault ทีละหน้า คำสั่งนี้คืนทันทีและ kernel อ่านในเบื้องหลัง
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for filename in glob.glob(os.path.join(path, "*.safetensors")):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def load_causal_lm(path, dtype=torch.float32):
+    """
+    โหลดโมเดลจากโฟลเดอร์ในเครื่องโดยไม่ติดต่อ Hub
+
+    สร้างโครงโมเดลบน meta device (ไม่สุ่มค่าเริ่มต้นที่จะถูกเขียนทับ) แล้ว mmap safetensors
+    tensor ที่ dtype ตรงกับ dtype ที่ขอจะใช้หน่วยความจำของไฟล์โดยตรงโดยไม่คัดลอก
+    ส่วนที่ต่างกัน (เช่น checkpoint bf16 ที่โหลดเป็น float32) จะแปลงทีละ tensor
+    """
+    prefetch_weights(path)
+    model = AutoModelForCausalLM.from_pretrained(path, torch_dtype=dtype, local_files_only=True,
+                                                 low_cpu_mem_usage=True)
+    return model.eval()
+
+def load_in_background(load_fn, *args, **kwargs):
+    """
+    เริ่มโหลดโมเดลในเธรดเบื้องหลังแล้วคืน Future ทันที
+
+    ใช้ระหว่างเตรียมข้อมูลหรือโหลด tokenizer เพื่อให้การ import โมดูลของโมเดลและการอ่าน weight
+    ทำไปพร้อมกัน เรียก .result() เมื่อต้องใช้โมเดล (exception ระหว่างโหลดจะถูกส่งต่อที่นั่น)
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-load")
+    future = executor.submit(load_fn, *args, **kwargs)
+    executor.shutdown(wait=False)
+    return future
+
+def warmup(model, tokenizer, prompt="สวัสดี", max_new_tokens=2):
+    """
+    generate สั้น ๆ หนึ่งครั้งเพื่อให้การเตรียมที่เกิดตอนเรียกครั้งแรกเสร็จก่อนคำขอจริง
+
+    เช่น การอ่าน weight จาก mmap การแปลง weight int4 เป็นรูปแบบของ kernel และการสร้าง primitive ของ oneDNN
+    คืนเวลาที่ใช้ (วินาที)
+    """
+    start = time.perf_counter()
+    inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
+    with torch.inference_mode():
+        model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                       pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id)
+    return time.perf_counter() - start
@@ -0,0 +1,179 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class _StackSampler:
+    """
+    Periodically sample the profiled thread's Python stack
+
+    The samples are written in the collapsed-stack format understood by
+    flamegraph.pl, speedscope and similar tools: one "frame;frame;frame count"
+    line per distinct stack.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class StageProfiler:
+    """
+    Measure wall time, CPU time and peak Python memory for each pipeline stage
+
+    When disabled, stage() is a no-op so callers can wrap their stages
+    unconditionally. With cprofile enabled each stage also gets a .pstats dump
+    and a .collapsed stack file in output_dir.
+
+    Stages may be nested: an inner stage's memory peak also counts towards the
+    outer stage, and only the outermost stage runs cProfile (only one profiler
+    can be active at a time), so inner stages appear inside its dumps. Entering
+    a stage name again records it as "name#2", "name#3", ... unless accumulate
+    is set, in which case every entry is added to the same result; this is meant
+    for stages that run once per chunk of a streaming loop.
+    """
+
+    def __init__(self, enabled=False, output_dir="profiles", cprofile=False):
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self.cprofile = cprofile
+        self.results = []
+        self._stack = []
+        self._runs = Counter()
+        self._accumulated = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, accumulate=False):
+        if not self.enabled:
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._stack:
+            # keep the outer stage's peak so far before resetting it for this stage
+            outer = self._stack[-1]
+            outer['peak'] = max(outer['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+        result = self._accumulated.get(name) if accumulate else None
+        if result is None:
+            self._runs[name] += 1
+            label = name if self._runs[name] == 1 else f"{name}#{self._runs[name]}"
+            result = {'stage': label, 'depth': len(self._stack),
+                      'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'tracemalloc_peak_mb': 0.0}
+            if accumulate:
+                result['calls'] = 0
+                self._accumulated[name] = result
+            self.results.append(result)
+        frame = {'peak': 0, 'profiler': None, 'sampler': None}
+        if self.cprofile and not self._stack:
+            os.makedirs(self.output_dir, exist_ok=True)
+            # an accumulated stage keeps one cProfile across entries so its dump covers all of them
+            frame['profiler'] = result.get('_profiler') or cProfile.Profile()
+            frame['sampler'] = _StackSampler(threading.get_ident())
+            frame['sampler'].start()
+            frame['profiler'].enable()
+        self._stack.append(frame)
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self._stack.pop()
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            result['wall_seconds'] = round(result['wall_seconds'] + wall, 4)
+            result['cpu_seconds'] = round(result['cpu_seconds'] + cpu, 4)
+            result['tracemalloc_peak_mb'] = max(result['tracemalloc_peak_mb'], round(peak / (1024 * 1024), 2))
+            if accumulate:
+                result['calls'] += 1
+            if frame['profiler'] is not None:
+                frame['profiler'].disable()
+                frame['sampler'].stop()
+                safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in result['stage'])
+                result['pstats'] = os.path.join(self.output_dir, f"{safe_name}.pstats")
+                result['collapsed'] = os.path.join(self.output_dir, f"{safe_name}.collapsed")
+                frame['profiler'].dump_stats(result['pstats'])
+                if accumulate:
+                    result.setdefault('_samples', Counter()).update(frame['sampler'].samples)
+                    frame['sampler'].samples = result['_samples']
+                    result['_profiler'] = frame['profiler']
+                frame['sampler'].write(result['collapsed'])
+            if not accumulate:
+                print(f"[profile] {result['stage']}: wall {wall:.2f}s, cpu {cpu:.2f}s, "
+                      f"peak {peak / (1024 * 1024):.1f} MB")
+
+    def report(self):
+        """Print a summary table and save it to output_dir/profile_summary.json"""
+        if not self.enabled or not self.results:
+            return
+        results = [{k: v for k, v in r.items() if not k.startswith('_')} for r in self.results]
+        # nested stages are already inside their parent's time
+        total_wall = sum(r['wall_seconds'] for r in results if r['depth'] == 0) or 1
+        print("\n[profile] summary")
+        print(f"{'stage':24s} {'wall s':>10s} {'cpu s':>10s} {'share':>7s} {'peak MB':>10s}")
+        for r in results:
+            label = "  " * r['depth'] + r['stage'] + (f" (x{r['calls']})" if 'calls' in r else "")
+            print(f"{label:24s} {r['wall_seconds']:10.2f} {r['cpu_seconds']:10.2f} "
+                  f"{r['wall_seconds'] / total_wall:7.1%} {r['tracemalloc_peak_mb']:10.1f}")
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary_path = os.path.join(self.output_dir, "profile_summary.json")
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"[profile] saved to {summary_path}")
+
+
+def add_profile_arguments(parser):
+    """Add the shared --profile options to an argparse parser"""
+    parser.add_argument('--profile', action='store_true',
+                        help='Report wall time, CPU time and peak memory for each stage')
+    parser.add_argument('--profile-dir', type=str, default='profiles',
+                        help='Directory for profile summaries and dumps')
+    parser.add_argument('--profile-cprofile', action='store_true',
+                        help='Also dump cProfile .pstats and collapsed-stack files per stage')
+
+
+def profiler_from_args(args):
+    """Build a StageProfiler from parsed --profile options"""
+    return StageProfiler(
+        enabled=args.profile or args.profile_cprofile,
+        output_dir=args.profile_dir,
+        cprofile=args.profile_cprofile,
+    )
@@ -0,0 +1,126 @@
+ALPACA_PREAMBLE = "Below is an instruction that describes a task. Write a response that appropriately completes the request."
+
+SUMMARY_INSTRUCTION = "สรุปเนื้อหาบทเรียน {lesson_name} วิชา{subject} ระดับชั้น{grade}"
+
+TEMPLATES = {}
+
+def register_template(cls):
+    """ลงทะเบียนคลาสแม่แบบด้วยชื่อ cls.name"""
+    TEMPLATES[cls.name] = cls
+    return cls
+
+class PromptTemplate:
+    """
+    แม่แบบพื้นฐาน: render() คืน record (dict) หนึ่งรายการต่อหนึ่งคู่ instruction/response
+
+    แม่แบบถูกสร้างครั้งเดียวต่อ process แล้วใช้ซ้ำกับทุก record
+    """
+    name = None
+    columns = ('text',)
+    default_format = 'jsonl'
+
+    def render(self, instruction, response):
+        raise NotImplementedError
+
+    def render_prompt(self, instruction):
+        """ข้อความส่วน prompt (ก่อนคำตอบ) สำหรับให้โมเดลสร้างคำตอบต่อ ใช้ได้เฉพาะแม่แบบที่เป็นข้อความ"""
+        raise NotImplementedError(f"แม่แบบ {self.name} ไม่รองรับการสร้าง prompt")
+
+@register_template
+class AlpacaTemplate(PromptTemplate):
+    """รูปแบบ Alpaca แบบเดียวกับไฟล์ dltv_dataset_autotrain.csv เดิม"""
+    name = 'alpaca'
+    default_format = 'csv'
+
+    def __init__(self, **kwargs):
+        self.prefix = f"{ALPACA_PREAMBLE}\n\n### Instruction: "
+
+    def render(self, instruction, response):
+        return {'text': f"{self.prefix}{instruction}\n\n### Response: {response}"}
+
+    def render_prompt(self, instruction):
+        return f"{self.prefix}{instruction}\n\n### Response: "
+
+@register_template
+class ChatMessagesTemplate(PromptTemplate):
+    """รูปแบบ messages (role/content) สำหรับ trainer ที่รองรับ chat format"""
+    name = 'chat'
+    columns = ('messages',)
+
+    def __init__(self, **kwargs):
+        pass
+
+    def render(self, instruction, response):
+        return {'messages': [
+            {'role': 'user', 'content': instruction},
+            {'role': 'assistant', 'content': response},
+        ]}
+
+@register_template
+class GemmaTurnsTemplate(PromptTemplate):
+    """
+    ข้อความแบบ turn ของ Gemma (<start_of_turn>user ... <end_of_turn>)
+
+    ถ้าระบุ chat_template_model จะโหลด chat template ของโมเดลนั้น (เช่น google/gemma-3-1b-it)
+    แล้วคอมไพล์ Jinja ครั้งเดียว ถ้าไม่ระบุหรือโหลดไม่ได้จะใช้รูปแบบ Gemma 3 ที่เขียนไว้ในโค้ด
+    ข้อความไม่มี <bos> นำหน้า เพราะ trainer, eval และ server tokenize ด้วย add_special_tokens=True
+    ซึ่ง tokenizer ของ Gemma ใส่ <bos> ให้เอง (ถ้าใส่ในข้อความด้วยจะได้ <bos> ซ้ำสองตัว)
+    """
+    name = 'gemma'
+
+    def __init__(self, chat_template_model=None, **kwargs):
+        self.compiled = None
+        if chat_template_model:
+            try:
+                self.compiled = _compile_chat_template(chat_template_model)
+            except Exception as e:
+                print(f"โหลด chat template จาก {chat_template_model} ไม่ได้ ({e}) ใช้รูปแบบ Gemma 3 ในตัวแทน")
+
+    def render(self, instruction, response):
+        if self.compiled is not None:
+            text = self.compiled.render(
+                messages=[
+                    {'role': 'user', 'content': instruction},
+                    {'role': 'assistant', 'content': response},
+                ],
+                bos_token='',
+                add_generation_prompt=False,
+            )
+        else:
+            # เหมือน chat template ของ gemma-3 ที่ตัดช่องว่างหัวท้ายของแต่ละข้อความ
+            text = (f"<start_of_turn>user\n{instruction.strip()}<end_of_turn>\n"
+                    f"<start_of_turn>model\n{response.strip()}<end_of_turn>\n")
+        return {'text': text}
+
+    def render_prompt(self, instruction):
+        if self.compiled is not None:
+            return self.compiled.render(
+                messages=[{'role': 'user', 'content': instruction}],
+                bos_token='',
+                add_generation_prompt=True,
+            )
+        return f"<start_of_turn>user\n{instruction.strip()}<end_of_turn>\n<start_of_turn>model\n"
+
+def _compile_chat_template(model_name):
+    """โหลด chat template ของ tokenizer แล้วคอมไพล์เป็น Jinja template"""
+    from jinja2.exceptions import TemplateError
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if not tokenizer.chat_template:
+        raise ValueError("tokenizer ไม่มี chat template")
+
+    def raise_exception(message):
+        raise TemplateError(message)
+
+    env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
+    env.globals['raise_exception'] = raise_exception
+    return env.from_string(tokenizer.chat_template)
+
+def build_templates(names, **kwargs):
+    """สร้างแม่แบบตามชื่อ (คืน dict ชื่อ -> แม่แบบ)"""
+    unknown = [name for name in names if name not in TEMPLATES]
+    if unknown:
+        raise ValueError(f"ไม่รู้จักแม่แบบ {', '.join(unknown)} (มี {', '.join(TEMPLATES)})")
+    return {name: TEMPLATES[name](**kwargs) for name in names}
@@ -0,0 +1,176 @@
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+import torch
+from transformers import DynamicCache
+
+# อักขระความกว้างศูนย์ที่มักติดมากับข้อความภาษาไทยที่คัดลอกจากเว็บ
+_ZERO_WIDTH = re.compile('[\u200b\u200c\u200d\u2060\ufeff]')
+_SPACES = re.compile('[ \t\u00a0]+')
+
+def normalize_prompt(text):
+    """ทำให้ prompt ที่ต่างกันแค่รูปแบบ Unicode อักขระความกว้างศูนย์ หรือช่องว่างซ้ำ กลายเป็นข้อความเดียวกัน"""
+    text = unicodedata.normalize('NFC', text)
+    text = _ZERO_WIDTH.sub('', text)
+    return _SPACES.sub(' ', text)
+
+def model_version(model_path):
+    """
+    รหัสเวอร์ชันของโมเดลจาก config และขนาด/เวลาแก้ไขของไฟล์ weight
+
+    เมื่อฝึกหรือ quantize โมเดลใหม่ลงโฟลเดอร์เดิม รหัสจะเปลี่ยน คำตอบที่ cache ไว้ของโมเดลเก่าจึงไม่ถูกใช้
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(model_path)):
+        path = os.path.join(model_path, name)
+        if name in ('config.json', 'generation_config.json', 'quantization.json'):
+            with open(path, 'rb') as f:
+                digest.update(name.encode('utf-8') + f.read())
+        elif name.endswith(('.safetensors', '.bin', '.pt')):
+            stat = os.stat(path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+class ResponseCache:
+    """
+    cache คำตอบของ prompt ที่ผ่าน normalize_prompt แล้ว แยกตามเวอร์ชันโมเดลและ max_new_tokens
+
+    ชั้นหน่วยความจำเป็น LRU จำกัดทั้งจำนวนรายการและขนาดข้อความรวม ถ้าระบุ disk_dir
+    จะเก็บทุกคำตอบลงดิสก์ด้วย (ไฟล์ JSON ละหนึ่งคำตอบ) และเมื่อไม่พบในหน่วยความจำจะอ่านจากดิสก์แล้วดึงขึ้นมา
+    ใช้ได้เพราะ server generate แบบ greedy คำตอบของ prompt เดิมจึงเหมือนเดิมทุกครั้ง
+    """
+
+    def __init__(self, version, max_entries=1024, max_mb=64, disk_dir=None):
+        self.version = version
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def key(self, prompt, max_new_tokens):
+        text = f"{self.version}\0{max_new_tokens}\0{normalize_prompt(prompt)}"
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _remember(self, key, entry):
+        # เรียกขณะถือ lock
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)['text'].encode('utf-8'))
+        self.entries[key] = entry
+        self.size += len(entry['text'].encode('utf-8'))
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted['text'].encode('utf-8'))
+            self.evictions += 1
+
+    def get(self, key):
+        """คืน {'text', 'tokens'} หรือ None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None:
+                with self.lock:
+                    self._remember(key, entry)
+                    self.disk_hits += 1
+                return entry
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text, tokens):
+        entry = {'text': text, 'tokens': tokens}
+        with self.lock:
+            self._remember(key, entry)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'cache_entries': len(self.entries),
+                'cache_mb': round(self.size / (1024 * 1024), 2),
+                'cache_hits': self.hits,
+                'cache_disk_hits': self.disk_hits,
+                'cache_misses': self.misses,
+                'cache_evictions': self.evictions,
+                'cache_hit_rate': round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+def _common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+class PrefixKVCache:
+    """
+    KV cache ของข้อความส่วนต้นที่ทุก prompt ใช้ร่วมกัน (เช่น preamble ของแม่แบบ Alpaca)
+
+    คำนวณครั้งเดียวตอนเริ่ม server แล้วใช้กับทุก batch ที่ token ต้น prompt ตรงกัน
+    generate จึงคำนวณเฉพาะ token ที่เหลือของแต่ละคำขอ ถ้าโมเดลใช้ sliding window (เช่น Gemma 3)
+    จะใช้เฉพาะเมื่อ prompt รวมคำตอบยาวไม่เกิน window เพราะ DynamicCache ไม่ตัด token ที่เลย window ออก
+    """
+
+    def __init__(self, model, tokenizer, prefixes, min_tokens=4):
+        self.min_tokens = min_tokens
+        self.entries = []
+        self.max_length = getattr(model.config, 'sliding_window', None)
+        with torch.inference_mode():
+            for text in prefixes:
+                ids = tokenizer(text)['input_ids']
+                output = model(torch.tensor([ids]), use_cache=True, past_key_values=DynamicCache())
+                self.entries.append((ids, output.past_key_values))
+
+    def match(self, encoded, max_new_tokens):
+        """
+        หา prefix ที่ยาวที่สุดที่ทุกแถวใน batch ใช้ร่วมกันได้
+
+        คืน (จำนวน token ที่ข้ามได้, cache ขนาดเท่า batch) หรือ None ถ้าไม่คุ้มหรือใช้ไม่ได้
+        """
+        if self.max_length is not None and max(len(ids) for ids in encoded) + max_new_tokens > self.max_length:
+            return None
+        best_length, best_cache = 0, None
+        # เหลืออย่างน้อยหนึ่ง token ให้ generate คำนวณ logits ของ token ถัดไป
+        shortest = min(len(ids) for ids in encoded) - 1
+        for prefix_ids, cache in self.entries:
+            length = min(min(_common_prefix_length(prefix_ids, ids) for ids in encoded), shortest)
+            if length > best_length:
+                best_length, best_cache = length, cache
+        if best_length < self.min_tokens:
+            return None
+        cache = copy.deepcopy(best_cache)
+        cache.crop(best_length)
+        cache.batch_repeat_interleave(len(encoded))
+        return best_length, cache
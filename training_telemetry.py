@@ -0,0 +1,143 @@
+import json
+import os
+import resource
+import statistics
+import time
+from transformers import TrainerCallback
+
+def current_rss_mb():
+    """หน่วยความจำที่ process ใช้อยู่ตอนนี้ (RSS, MB)"""
+    with open("/proc/self/statm", 'r') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def peak_rss_mb():
+    """หน่วยความจำสูงสุดที่ process เคยใช้ (high-water mark, MB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(values, q):
+    """ค่า percentile แบบ nearest-rank ของ list ที่ไม่ว่าง"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+class TelemetryCallback(TrainerCallback):
+    """
+    บันทึกตัวชี้วัดประสิทธิภาพทุก optimizer step ลง JSONL (และ TensorBoard ถ้าติดตั้งไว้)
+
+    Trainer ดึง batch ของทั้ง step มาก่อนเรียก on_step_begin จึงถือว่าเวลาตั้งแต่จบ step ก่อนหน้า
+    จนถึง on_step_begin คือเวลาที่รอ dataloader (stall) ส่วนจำนวน token นับจาก PaddingStatsCollator
+    ถ้าใช้ dataloader workers ตัวนับจะนำหน้าการฝึกไปไม่กี่ batch ตามที่ worker เตรียมไว้ล่วงหน้า
+    สรุปท้ายการฝึกเขียนลงไฟล์ชื่อตาม file_name (telemetry.jsonl -> telemetry_summary.json)
+    แต่ละ rank ของ DDP จึงเขียนไฟล์ของตัวเองเหมือน JSONL ไม่ทับกัน
+    """
+
+    def __init__(self, stats_collator, log_dir, file_name="telemetry.jsonl"):
+        self.stats_collator = stats_collator
+        self.log_dir = log_dir
+        self.file_name = file_name
+        self.records = []
+        self._file = None
+        self._writer = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._file = open(os.path.join(self.log_dir, self.file_name), 'w', encoding='utf-8')
+        try:
+            from torch.utils.tensorboard import SummaryWriter
+            self._writer = SummaryWriter(log_dir=os.path.join(self.log_dir, "telemetry"))
+        except ImportError:
+            print("ไม่พบ tensorboard บันทึก telemetry เฉพาะไฟล์ JSONL")
+        self._train_start = self._step_end = time.perf_counter()
+        self._real_tokens = self.stats_collator.real_tokens
+        self._total_tokens = self.stats_collator.total_tokens
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_begin = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        real_tokens = self.stats_collator.real_tokens - self._real_tokens
+        total_tokens = self.stats_collator.total_tokens - self._total_tokens
+        self._real_tokens += real_tokens
+        self._total_tokens += total_tokens
+
+        step_seconds = now - self._step_end
+        record = {
+            'step': state.global_step,
+            'step_seconds': round(step_seconds, 4),
+            'data_wait_seconds': round(self._step_begin - self._step_end, 4),
+            'compute_seconds': round(now - self._step_begin, 4),
+            'real_tokens': real_tokens,
+            'total_tokens': total_tokens,
+            'padding_ratio': round(1 - real_tokens / total_tokens, 4) if total_tokens else 0.0,
+            'tokens_per_second': round(real_tokens / step_seconds, 1) if step_seconds else 0.0,
+            'rss_mb': round(current_rss_mb(), 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        self._step_end = now
+        self.records.append(record)
+
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self._writer is not None:
+            for key, value in record.items():
+                if key != 'step':
+                    self._writer.add_scalar(f"telemetry/{key}", value, state.global_step)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._file is not None:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+        summary = self.summary()
+        if summary is None:
+            return
+        summary_name = f"{os.path.splitext(self.file_name)[0]}_summary.json"
+        with open(os.path.join(self.log_dir, summary_name), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        if state.is_world_process_zero:
+            self.print_summary(summary)
+
+    def summary(self):
+        """สรุปตัวชี้วัดของทั้งการฝึก (None ถ้ายังไม่มี step)"""
+        if not self.records:
+            return None
+        step_times = [r['step_seconds'] for r in self.records]
+        wall = sum(step_times)
+        data_wait = sum(r['data_wait_seconds'] for r in self.records)
+        real_tokens = sum(r['real_tokens'] for r in self.records)
+        total_tokens = sum(r['total_tokens'] for r in self.records)
+        mean = statistics.fmean(step_times)
+        stdev = statistics.pstdev(step_times)
+        return {
+            'steps': len(self.records),
+            'wall_seconds': round(wall, 2),
+            'tokens_per_second': round(real_tokens / wall, 1) if wall else 0.0,
+            'real_tokens': real_tokens,
+            'total_tokens': total_tokens,
+            'padding_ratio': round(1 - real_tokens / total_tokens, 4) if total_tokens else 0.0,
+            'data_wait_seconds': round(data_wait, 2),
+            'data_wait_ratio': round(data_wait / wall, 4) if wall else 0.0,
+            'step_seconds_mean': round(mean, 4),
+            'step_seconds_stdev': round(stdev, 4),
+            'step_seconds_cv': round(stdev / mean, 4) if mean else 0.0,
+            'step_seconds_p50': percentile(step_times, 50),
+            'step_seconds_p95': percentile(step_times, 95),
+            'step_seconds_max': max(step_times),
+            'peak_rss_mb': max(r['peak_rss_mb'] for r in self.records),
+        }
+
+    def print_summary(self, summary):
+        print("\n[telemetry] สรุปการฝึก")
+        print(f"  optimizer steps:        {summary['steps']} ({summary['wall_seconds']:.1f} วินาที)")
+        print(f"  token จริง/วินาที:      {summary['tokens_per_second']:,.0f}")
+        print(f"  token จริง / ทั้งหมด:    {summary['real_tokens']:,} / {summary['total_tokens']:,} "
+              f"(padding {summary['padding_ratio']:.1%})")
+        print(f"  รอ dataloader:          {summary['data_wait_seconds']:.2f} วินาที "
+              f"({summary['data_wait_ratio']:.1%} ของเวลาฝึก)")
+        print(f"  เวลาต่อ step:           เฉลี่ย {summary['step_seconds_mean']:.3f}s, "
+              f"sd {summary['step_seconds_stdev']:.3f}s (cv {summary['step_seconds_cv']:.1%}), "
+              f"p50 {summary['step_seconds_p50']:.3f}s, p95 {summary['step_seconds_p95']:.3f}s, "
+              f"max {summary['step_seconds_max']:.3f}s")
+        print(f"  หน่วยความจำสูงสุด (RSS): {summary['peak_rss_mb']:,.0f} MB")
+        print(f"  บันทึกที่ {os.path.join(self.log_dir, self.file_name)}")